@@ -10,22 +10,29 @@ import time
 import datetime
 import getpass
 from optparse import OptionParser
-import random
 import uuid
-from xml.dom import minidom as dom
 import multiprocessing
 import shutil
 import difflib
+import copy
+import functools
+import random
 
+from infaketure import actions
 from infaketure import check
+from infaketure import checkin
 from infaketure import hostnames
 from infaketure import store
 from infaketure import spaceapi
 from infaketure import loadproc
 from infaketure.pcp import pcpconn
 from infaketure import procpool
+from infaketure import engine
+from infaketure import netalloc
+from infaketure import scheduler
 from infaketure.cmdbmeta import HardwareInfo
 from infaketure.cmdbmeta import SoftwareInfo
+from infaketure.sysid import XMLData
 
 sys.path.append("/usr/share/rhn/")
 
@@ -34,7 +41,6 @@ from up2date_client import hardware
 from up2date_client import pkgUtils
 from up2date_client import up2dateErrors
 from suseRegister.info import getProductProfile as get_suse_product_profile
-from up2date_client import rhnserver
 
 
 class CMDBProfile(store.CMDBBaseProfile):
@@ -47,6 +53,9 @@ class CMDBProfile(store.CMDBBaseProfile):
         CMDBProfile-specific exceptions.
         """
 
+    _template = None  # Packages, hardware and virt info of this machine, probed once per run
+    allocator = netalloc.AddressAllocator()  # MAC and IP addresses of the hosts by their index
+
     def __init__(self, hostname, idx=0):
         """
         Constructor.
@@ -60,17 +69,33 @@ class CMDBProfile(store.CMDBBaseProfile):
         self.params = dict()
         self.hostname = hostname
         self.id = self.hostname
-        self.packages = pkgUtils.getInstalledPackageList(
-            getArch=(rhnreg.cfg['supportsExtendedPackageProfile'] and 1 or 0))
+        self.stage = None  # Last finished registration stage
+        self.packages = list(self._get_template()["packages"])  # Package dictionaries are shared
         self.src = None
         self._gen_hardware()
         self._get_virtuid()
 
+    @classmethod
+    def _get_template(cls):
+        """
+        Get the profile template of this machine.
+        Every fake host is a clone of it, so the rpmdb and hardware are probed only once.
+        """
+        if cls._template is None:
+            cls._template = {
+                "packages": pkgUtils.getInstalledPackageList(
+                    getArch=(rhnreg.cfg['supportsExtendedPackageProfile'] and 1 or 0)),
+                "hardware": hardware.Hardware(),
+                "virt_info": rhnreg.get_virt_info(),
+            }
+
+        return cls._template
+
     def _get_virtuid(self):
         """
         Get virt UUID
         """
-        (virt_uuid, virt_type) = rhnreg.get_virt_info()
+        (virt_uuid, virt_type) = self._get_template()["virt_info"]
         if virt_uuid is not None:
             self.params['virt_uuid'] = virt_uuid
             self.params['virt_type'] = virt_type
@@ -79,7 +104,9 @@ class CMDBProfile(store.CMDBBaseProfile):
         """
         Generate hardware information.
         """
-        self.hardware = hardware.Hardware()
+        # Only the network entries are changed per host, other entries are shared
+        self.hardware = [h.get('class') in ['NETINFO', 'NETINTERFACES'] and copy.deepcopy(h) or h
+                         for h in self._get_template()["hardware"]]
         self.primary_ip = self._gen_ip()
         for h in self.hardware:
             if h['class'] == 'NETINFO':
@@ -102,44 +129,13 @@ class CMDBProfile(store.CMDBBaseProfile):
         """
         Generate a fake MAC address.
         """
-        slots = hex(int(str(self.idx).zfill(4))).split("x")[-1].zfill(4)
-        return "de:af:be:ef:{0}:{1}".format(*[slots[:2], slots[2:]])
+        return self.allocator.get_mac(self.idx)
 
     def _gen_ip(self, ipv6=False):
         """
-        Generate random IP address.
+        Generate a fake IP address.
         """
-        adr = list()
-        for x in range(ipv6 and 8 or 4):
-            adr.append(random.randint(0xa, ipv6 and 0xffff or 0xff))
-
-        return (ipv6 and ":" or ".").join([ipv6 and hex(e).split("x")[-1] or str(e) for e in adr])
-
-
-class XMLData(object):
-    """
-    Parse SID data.
-    """
-    def __init__(self):
-        self.dom = None
-        self.members = None
-
-    def load(self, src):
-        self.dom = dom.parseString(src)
-        self._get_members()
-
-    def _get_members(self):
-        self.members = dict()
-        for member_node in self.dom.getElementsByTagName('member'):
-            name = member_node.getElementsByTagName('name')[0].childNodes[0].nodeValue
-            if member_node.getElementsByTagName('value')[0].getElementsByTagName('string'):
-                self.members[name] = member_node.getElementsByTagName('string')[0].childNodes[0].nodeValue
-
-    def get_member(self, name):
-        """
-        Get SID member.
-        """
-        return str(self.members.get(name)) or 'N/A'
+        return ipv6 and self.allocator.get_ipv6(self.idx) or self.allocator.get_ipv4(self.idx)
 
 
 class Infaketure(object):
@@ -152,18 +148,29 @@ class Infaketure(object):
         VirtualRegistration-specific exceptions.
         """
 
+    class RegistrationError(VRException):
+        """
+        System was not registered.
+        """
+
+    REGISTRATION_STAGES = ("register", "hardware", "packages", "virtinfo", "checkin",)
+    RHNSD_INTERVAL = 240  # Minutes
+    RHNSD_REPORT = 60  # Seconds between the check-in reports of --rhnsd
+    JOURNAL_ATTEMPTS = 3  # Registration attempts of a journaled host, before it is given up
+
     def __init__(self):
         """
         Constructor.
         """
-        self.procpool = procpool.Pool()
         self.verbose = False
+        self.workers = None
         self._pcp_metrics_path = None
 
         if self._initialize():
             self.api = spaceapi.SpaceAPI("http://{0}/rpc/api".format(self.options.fqdn))
             rhnreg.cfg.set("serverURL", "https://{0}/XMLRPC".format(self.options.fqdn))
             rhnreg.getCaps()
+        self.procpool = procpool.Pool(size=self.workers)
 
         def _getProductProfile():
             '''
@@ -195,14 +202,62 @@ class Infaketure(object):
         opt.add_option("-c", "--sslCACert", action="store", dest="cacert",
                        help="Specify a file to use as the ssl CA cert.")
         opt.add_option("-a", "--hosts-amount", action="store", dest="amount",
-                       help="Specify an amount of fake hosts to be registered. Default 5.")
+                       help="Specify an amount of fake hosts to be registered. Default 5. "
+                            "If the previous run was interrupted, its unfinished hosts are resumed first "
+                            "and count towards the amount.")
         opt.add_option("-b", "--base-name", action="store", dest="base",
                        help="Specify a base name for a fake hosts, so it will go incrementally, "
                             "like FAKE0, FAKE1 ... . By default random host names if cracklib is installed "
                             "or 'test' as base name.")
+        opt.add_option("-w", "--workers", action="store", dest="workers",
+                       help="Maximum amount of workers running at the same time: processes, "
+                            "or requests in flight for the 'async' engine. "
+                            "Default {0} processes.".format(procpool.Pool.DEFAULT_SIZE))
+        opt.add_option("-g", "--engine", action="store", dest="engine", type="choice",
+                       choices=["process", "prefork", "async", "pipeline"], default="process",
+                       help="Engine for registrations and check-ins: 'process' runs each host in its own process, "
+                            "'prefork' passes hosts to long-lived worker processes, "
+                            "'async' runs them concurrently from one process with up to "
+                            "{0} requests in flight, unless --workers says otherwise, "
+                            "'pipeline' is like 'async', but registration stages have their own limits. "
+                            "Default is 'process'.".format(engine.ConcurrentEngine.DEFAULT_SIZE))
+        opt.add_option("--adaptive", action="store_true", dest="adaptive",
+                       help="Adapt requests in flight of the 'async' engine to the server: increase them while "
+                            "the latency and errors are under the targets, cut them when they are not. "
+                            "--workers is the maximum. Sustainable concurrency is reported at the end.")
+        opt.add_option("--target-p95", action="store", dest="target_p95",
+                       help="Target p95 latency of the requests, in seconds, for --adaptive. "
+                            "Default is {0}.".format(engine.AdaptiveLimiter.DEFAULT_TARGET_P95))
+        opt.add_option("--target-errors", action="store", dest="target_errors",
+                       help="Target error rate of the requests, from 0 to 1, for --adaptive. "
+                            "Default is {0}.".format(engine.AdaptiveLimiter.DEFAULT_TARGET_ERRORS))
+        opt.add_option("--stage-limits", action="store", dest="stage_limits",
+                       help="Requests in flight per registration stage for the 'pipeline' engine, "
+                            "e.g. 'register:20,packages:5'. Stages are: {0}. "
+                            "Stages that are not listed get --workers.".format(", ".join(self.REGISTRATION_STAGES)))
         opt.add_option("-e", "--database-file", action="store", dest="dbfile",
                        help="Specify a path to SQLite3 database. "
                             "Default is '{0}'.".format(_dbstore_file))
+        opt.add_option("-s", "--store", action="store", dest="store", type="choice",
+                       choices=["direct", "queue", "memory"], default="direct",
+                       help="How workers write to the database: 'direct' writes over a shared connection, "
+                            "'queue' sends the writes to one writer process that commits them in batches, "
+                            "'memory' keeps the database in memory and saves its snapshots to the file "
+                            "(requires the 'async' or 'pipeline' engine). Default is 'direct'.")
+        opt.add_option("-i", "--snapshot-interval", action="store", dest="snapshot_interval",
+                       help="Seconds between the snapshots of the in-memory database to the file. "
+                            "Default is {0}.".format(store.DBMemory.DEFAULT_INTERVAL))
+        opt.add_option("--seed", action="store", dest="seed",
+                       help="Seed of the MAC and IP addresses, so other runs get other addresses. Default 0.")
+        opt.add_option("--mac-prefix", action="store", dest="mac_prefix",
+                       help="Prefix of the MAC addresses. "
+                            "Default is '{0}'.".format(netalloc.AddressAllocator.DEFAULT_MAC_PREFIX))
+        opt.add_option("--ipv4-range", action="store", dest="ipv4_range",
+                       help="Network of the IPv4 addresses. "
+                            "Default is '{0}'.".format(netalloc.AddressAllocator.DEFAULT_IPV4_RANGE))
+        opt.add_option("--ipv6-range", action="store", dest="ipv6_range",
+                       help="Network of the IPv6 addresses. "
+                            "Default is '{0}'.".format(netalloc.AddressAllocator.DEFAULT_IPV6_RANGE))
         opt.add_option("-t", "--pcp-metrics", action="store", dest="pcp_path",
                        help="Specify a path to PCP metrics dump. "
                             "Default is '{0}'.".format(self._pcp_metrics_path))
@@ -210,8 +265,25 @@ class Infaketure(object):
                        help="Path to a scenario that simulates particular load.")
         opt.add_option("-r", "--refresh", action="store_true", dest="refresh",
                        help="Run rhn_check on registered systems.")
+        opt.add_option("--rhnsd", action="store_true", dest="rhnsd",
+                       help="Keep running rhn_check on registered systems, each at its own rhnsd interval, "
+                            "until interrupted. Check-ins run from one process, as with the 'async' engine.")
+        opt.add_option("--interval", action="store", dest="interval",
+                       help="Minutes between the check-ins of a system for --rhnsd. "
+                            "Default is {0}, as of rhnsd.".format(self.RHNSD_INTERVAL))
+        opt.add_option("--jitter", action="store", dest="jitter",
+                       help="Maximum minutes a check-in for --rhnsd is moved earlier or later from its interval. "
+                            "Default is 0.")
+        opt.add_option("--service-times", action="store", dest="service_times",
+                       help="Seconds the fake clients spend on the actions before they respond, drawn from "
+                            "'const:SECONDS', 'uniform:MIN:MAX' or 'exp:MEAN', e.g. "
+                            "'reboot.reboot=const:6,packages.update=uniform:1:5'. Check-ins from one process "
+                            "submit such responses later without waiting for them. "
+                            "Default is 'reboot.reboot=const:6', other actions respond at once.")
         opt.add_option("-v", "--verbose", action="store_true", dest="verbose",
                        help="Talk to me!")
+        opt.add_option("--discard-journal", action="store_true", dest="discard_journal",
+                       help="Discard the unfinished hosts of the interrupted run, instead of resuming them.")
         opt.add_option("-f", "--flush", action="store_true", dest="flush",
                        help="Flush all the systems on the SUSE Manager.")
         opt.add_option("-u", "--user", action="store", dest="user",
@@ -235,6 +307,7 @@ class Infaketure(object):
 
         # Check the required parameters
         if not self.options.fqdn or ((not self.options.refresh
+                                      and not self.options.rhnsd
                                       and not self.options.flush
                                       and not self.options.scenario)
                                      and (not self.options.key)):
@@ -254,6 +327,72 @@ class Infaketure(object):
         except Exception as error:
             raise Infaketure.VRException("Wrong amount of fake hosts: {0}".format(self.options.amount))
 
+        try:
+            self.workers = self.options.workers and int(self.options.workers) or None
+        except Exception as error:
+            raise Infaketure.VRException("Wrong amount of workers: {0}".format(self.options.workers))
+
+        if self.workers is not None and self.workers < 1:
+            raise Infaketure.VRException("Amount of workers should be at least one")
+
+        try:
+            self.snapshot_interval = (float(self.options.snapshot_interval)
+                                      if self.options.snapshot_interval is not None else None)
+        except Exception as error:
+            raise Infaketure.VRException("Wrong snapshot interval: {0}".format(self.options.snapshot_interval))
+
+        try:
+            CMDBProfile.allocator = netalloc.AddressAllocator(seed=self.options.seed,
+                                                              mac_prefix=self.options.mac_prefix,
+                                                              ipv4_range=self.options.ipv4_range,
+                                                              ipv6_range=self.options.ipv6_range)
+        except ValueError as error:
+            raise Infaketure.VRException(str(error))
+
+        if self.options.store == "memory" and (self.options.engine not in ["async", "pipeline"]
+                                               or self.options.scenario):
+            raise Infaketure.VRException("In-memory store works only with the 'async' or 'pipeline' engine "
+                                         "and without scenarios")
+
+        try:
+            self.target_p95 = float(self.options.target_p95) if self.options.target_p95 is not None else None
+            self.target_errors = (float(self.options.target_errors)
+                                  if self.options.target_errors is not None else None)
+        except ValueError:
+            raise Infaketure.VRException("Wrong adaptive targets: {0}, {1}".format(self.options.target_p95,
+                                                                                   self.options.target_errors))
+
+        if self.options.adaptive and self.options.engine != "async":
+            raise Infaketure.VRException("Adaptive concurrency works only with the 'async' engine")
+
+        self.stage_limits = dict()
+        for limit in (self.options.stage_limits or "").split(","):
+            if not limit.strip():
+                continue
+            try:
+                stage, size = [item.strip() for item in limit.split(":")]
+                size = int(size)
+            except ValueError:
+                raise Infaketure.VRException("Wrong stage limit: {0}".format(limit))
+            if stage not in self.REGISTRATION_STAGES or size < 1:
+                raise Infaketure.VRException("Wrong stage limit: {0}. Stages are: {1}".format(
+                    limit, ", ".join(self.REGISTRATION_STAGES)))
+            self.stage_limits[stage] = size
+
+        try:
+            self.interval = float(self.options.interval or self.RHNSD_INTERVAL) * 60
+            self.jitter = float(self.options.jitter or 0) * 60
+        except ValueError:
+            raise Infaketure.VRException("Wrong rhnsd interval or jitter: {0}, {1}".format(
+                self.options.interval, self.options.jitter))
+        if self.interval <= 0 or not 0 <= self.jitter < self.interval:
+            raise Infaketure.VRException("Interval should be positive, jitter should be less than the interval")
+
+        try:
+            actions.SERVICE_TIMES.update(actions.parse_service_times(self.options.service_times))
+        except ValueError as error:
+            raise Infaketure.VRException(str(error))
+
         if self.options.dbfile:
             _dbstore_file = self.options.dbfile
 
@@ -268,7 +407,13 @@ class Infaketure(object):
                 raise Infaketure.VRException(
                     "User and/or password must be given to authorise against SUSE Manager.")
 
-        self.db = store.DBOperations(_dbstore_file)
+        self.dbfile = _dbstore_file
+        if self.options.store == "queue":
+            self.db = store.DBQueueClient(self.dbfile)
+        elif self.options.store == "memory":
+            self.db = store.DBMemory(self.dbfile, interval=self.snapshot_interval)
+        else:
+            self.db = store.DBOperations(self.dbfile)
         self.db.open()
 
         return True
@@ -327,7 +472,7 @@ class Infaketure(object):
         """
         db_meta_h = open(os.path.join(conf_path, "db-meta.conf"), "w")
         db_meta_h.write("# Number of registered hosts\n"
-                        "registered hosts = {0}\n".format(len(self.db.get_host_profiles())))
+                        "registered hosts = {0}\n".format(self.db.get_hosts_count()))
         db_meta_h.close()
 
     def _save_scenario(self, conf_path):
@@ -448,16 +593,35 @@ class Infaketure(object):
             self.scenario()
         elif self.options.refresh:
             self.refresh()
+        elif self.options.rhnsd:
+            self.rhnsd()
         elif self.options.flush:
             self.flush()
         else:
-            fh = hostnames.FakeNames(fqdn=True)
-            for profile in self.db.get_host_profiles():
-                fh.add_history(profile.hostname)
-            idx_offset = self.db.get_next_id("hosts") - 1
-            for idx in range(vr.amount):
-                self.procpool.run(multiprocessing.Process(
-                    target=self.register, args=(CMDBProfile(fh(), idx=(idx + idx_offset)),)), join=True)
+            hosts = self._get_registration_hosts()
+            if self.options.engine == "async":
+                runner = self._get_engine()
+                for host in hosts:
+                    runner.submit(self.register, self._get_profile(host), raise_errors=True)
+                runner.join()
+                self._print_capacity(runner)
+            elif self.options.engine == "pipeline":
+                runner = engine.Pipeline(self._get_registration_steps(), limits=self.stage_limits, size=self.workers)
+                runner.start()
+                for host in hosts:
+                    runner.submit(self._get_profile(host))
+                runner.join()
+                self._print_pipeline_stats(runner)
+            elif self.options.engine == "prefork":
+                CMDBProfile._get_template()  # Probe once, before the workers are forked
+                workers = procpool.WorkerPool(self._register_host, initializer=self._init_worker, size=self.workers)
+                workers.start()
+                for host in hosts:
+                    workers.put(host)
+                workers.join()
+            else:
+                for host in hosts:
+                    self.procpool.run(multiprocessing.Process(target=self.register, args=(self._get_profile(host),)))
         self.procpool.join()
         self.db.vacuum()
         self.db.close()
@@ -469,7 +633,7 @@ class Infaketure(object):
         try:
             self.api.system.delete_system_by_sid(sid)
             self.db.delete_host_by_id(sid)
-            self.db.connection.commit()
+            self.db.commit()
         except Exception as ex:
             print "Error deleting host:", ex
 
@@ -479,67 +643,318 @@ class Infaketure(object):
         """
         self.api.login(self.options.user, self.options.password)
 
-        host_sids = ["ID-{0}".format(host.sid) for host in self.db.get_host_profiles()]
+        host_sids = set(["ID-{0}".format(host.sid) for host in self.db.iter_host_profiles(fields=())])
         # Flush hosts in SUMA
         systems = self.api.system.get_systems()
-        batch = 0
+        removed = 0
         for system in systems:
             if not wipe and system['sid'] in host_sids or wipe:
                 if self.verbose:
                     print "Removing {0} ({1})".format(system['name'], system['sid'])
-                self.procpool.run(multiprocessing.Process(target=self._flush_host_by_sid, args=(system['id'],)))
-                batch += 1
-            if batch == 30:
-                self.procpool.join()
-                print "Removed {0} machines".format(batch)
-                batch = 0
+                if self.options.store == "memory":
+                    self._flush_host_by_sid(system['id'])  # Forked processes do not share the in-memory database
+                else:
+                    self.procpool.run(multiprocessing.Process(target=self._flush_host_by_sid,
+                                                              args=(system['id'],)))
+                removed += 1
+        self.procpool.join()
+        print "Removed {0} machines".format(removed)
         if self.verbose and systems:
             print "Done"
 
+    def _init_worker(self):
+        """
+        Initialize pre-forked worker: its own database connection and a server it keeps for all the hosts.
+        """
+        self.db.reconnect()
+
+        return check.get_server(rhnreg.cfg)
+
+    def _register_host(self, server, host):
+        """
+        Register one host in the pre-forked worker.
+        """
+        self.register(self._get_profile(host), server=server)
+
+    def _get_registration_hosts(self):
+        """
+        Get hosts to register. The unfinished hosts of an interrupted run are resumed first,
+        unless the journal is discarded or they ran out of attempts. The rest of the amount
+        are new hosts, added to the registration journal before they are registered.
+
+        :return: List of (hostname, host index, last finished stage, SID)
+        """
+        resumed = list()
+        with self.db.lock:
+            for idx, hostname, stage, sid, attempts in self.db.get_journal_hosts():
+                if self.options.discard_journal or attempts >= self.JOURNAL_ATTEMPTS:
+                    if not self.options.discard_journal:
+                        print "Giving up on {0} after {1} attempts".format(hostname, attempts)
+                    self.db.delete_journal_host(idx)
+                else:
+                    self.db.add_journal_attempt(idx)
+                    resumed.append((hostname, idx, stage, sid))
+            self.db.commit()
+        if resumed:
+            print "Resuming {0} unfinished hosts of the interrupted run".format(len(resumed))
+
+        fh = hostnames.FakeNames(fqdn=True)
+        for profile in self.db.iter_host_profiles(fields=()):
+            fh.add_history(profile.hostname)
+        for hostname, idx, stage, sid in resumed:
+            fh.add_history(hostname)
+        next_idx = self.db.get_next_idx()
+        hosts = [(fh(), next_idx + idx, None, None) for idx in range(max(self.amount - len(resumed), 0))]
+        if hosts:
+            with self.db.lock:
+                self.db.add_journal_hosts([(idx, hostname) for hostname, idx, stage, sid in hosts])
+                self.db.commit()
+
+        return resumed + hosts
+
+    def _get_profile(self, host):
+        """
+        Get profile of the host to register: stored profile for the hosts that are already registered.
+
+        :param host: (hostname, host index, last finished stage, SID)
+        """
+        hostname, idx, stage, sid = host
+        profile = None
+        if stage is not None:
+            with self.db.lock:
+                profile = self.db.get_host_profiles(host_id=sid)
+        if profile is None:
+            profile = CMDBProfile(hostname, idx=idx)
+        else:
+            profile.idx = idx
+            profile.stage = stage
+
+        return profile
+
+    def _refresh_host(self, server, sid):
+        """
+        Refresh one host in the pre-forked worker.
+        """
+        self._get_check_cli(self.db.get_host_profiles(host_id=sid, fields=()), server=server).main()
+
+    def _get_check_cli(self, profile, server=None):
+        """
+        Get rhn_check for the stored profile.
+        """
+        if self.verbose:
+            print "Refreshing {0} ({1})".format(profile.hostname, profile.sid)
+
+        # TODO: pass the entire profile instead of its pieces!
+        with self.db.lock:  # Check-in workers use the same cursor meanwhile
+            config = self.db.get_host_config(profile.id)
+        cli = check.CheckCli(config, profile.src, self.db, profile.sid, profile,
+                             hostname=profile.hostname, server=server)
+        cli.verbose = self.verbose
+
+        return cli
+
     def refresh(self):
         """
         Refresh profiles by running rhn_check over them.
         """
-        for profile in self.db.get_host_profiles():
-            if self.verbose:
-                print "Refreshing {0} ({1})".format(profile.hostname, profile.sid)
+        if self.options.engine in ["async", "pipeline"] and not self.options.adaptive:
+            runner = checkin.CheckInEngine(size=self.workers)
+            runner.start()
+            for profile in self.db.iter_host_profiles(fields=()):
+                runner.submit(self._get_check_cli(profile))
+            runner.join()
+            print "Checked in {0} machines, {1} errors".format(runner.done, runner.errors)
+        elif self.options.engine == "async":
+            runner = self._get_engine()
+            for profile in self.db.iter_host_profiles(fields=()):
+                runner.submit(self._get_check_cli(profile).main)
+            runner.join()
+            self._print_capacity(runner)
+        elif self.options.engine == "prefork":
+            workers = procpool.WorkerPool(self._refresh_host, initializer=self._init_worker, size=self.workers)
+            workers.start()
+            for profile in self.db.iter_host_profiles(fields=()):
+                workers.put(profile.sid)
+            workers.join()
+        else:
+            for profile in self.db.iter_host_profiles(fields=()):
+                self.procpool.run(multiprocessing.Process(target=self._get_check_cli(profile).main))
 
-            # TODO: pass the entire profile instead of its pieces!
-            cli = check.CheckCli(self.db.get_host_config(profile.id), profile.src, self.db, profile.sid, profile,
-                                 hostname=profile.hostname)
-            cli.verbose = self.verbose
-            self.procpool.run(multiprocessing.Process(target=cli.main))
+    def rhnsd(self):
+        """
+        Keep checking in the stored profiles, each at its own interval, as rhnsd does, until interrupted.
+        Only SIDs are kept on the timer heap, profiles are loaded when their check-in is due.
+        """
+        runner = checkin.CheckInEngine(size=self.workers)
+        runner.start()
+        timers = scheduler.Scheduler()
+        for profile in self.db.iter_host_profiles(fields=()):
+            timers.schedule_in(random.uniform(0, self.interval), self._rhnsd_checkin, timers, runner, profile.sid)
+        if not len(timers):
+            print "No registered systems to check in"
+            return
 
-    def register(self, profile):
+        print "Checking in {0} machines every {1:.0f}+/-{2:.0f} minutes, press Ctrl+C to stop".format(
+            len(timers), self.interval / 60, self.jitter / 60)
+        timers.schedule_in(self.RHNSD_REPORT, self._rhnsd_report, timers, runner)
+        try:
+            timers.run()
+        except KeyboardInterrupt:
+            timers.stop()
+        runner.join()
+        self._rhnsd_report(None, runner)
+
+    def _rhnsd_checkin(self, timers, runner, sid):
         """
-        Register one system based on profile.
+        Check in the host and schedule its next check-in.
+        Blocks the scheduler, while the check-in engine is full, so the late check-ins are not piled up.
+        """
+        with self.db.lock:
+            profile = self.db.get_host_profiles(host_id=sid, fields=())
+        if profile is None:
+            return  # Flushed meanwhile
+
+        timers.schedule_in(self.interval + random.uniform(-self.jitter, self.jitter),
+                           self._rhnsd_checkin, timers, runner, sid)
+        runner.submit(self._get_check_cli(profile))
+
+    def _rhnsd_report(self, timers, runner):
+        """
+        Print the check-ins so far and schedule the next report.
+        """
+        print "Checked in {0} machines, {1} errors".format(runner.done, runner.errors)
+        if timers is not None:
+            timers.schedule_in(self.RHNSD_REPORT, self._rhnsd_report, timers, runner)
+
+    def _register_system(self, profile, server=None):
+        """
+        Register the system and store its profile.
         """
         xmldata = XMLData()
         try:
             profile.src = rhnreg.registerSystem(token=self.options.key,
                                                 profileName=profile.id,
                                                 other=profile.params)
-            profile.login_info = rhnserver.RhnServer().up2date.login(profile.src)
+            rhn_server = check.get_rhn_server(server is not None and server or check.get_cached_server(rhnreg.cfg))
+            profile.login_info = rhn_server.up2date.login(profile.src)
             xmldata.load(profile.src)
             profile.sid = xmldata.get_member('system_id')
             profile.name = xmldata.get_member('profile_name')
-            self.db.create_profile(profile)
-            self.db.connection.commit()
+            with self.db.lock:
+                try:
+                    self.db.create_profile(profile)
+                    self.db.commit()
+                except Exception:
+                    self.db.rollback()  # Do not leave a half-written profile to the next commit
+                    raise
             print "Registered {0} with System ID {1}".format(xmldata.get_member('profile_name'),
                                                              xmldata.get_member('system_id'))
         except (up2dateErrors.AuthenticationTicketError,
                 up2dateErrors.RhnUuidUniquenessError,
                 up2dateErrors.CommunicationError,
                 up2dateErrors.AuthenticationOrAccountCreationError), e:
-            print "WARNING: Registration error: {0}".format(e.errmsg)
-            return
+            raise Infaketure.RegistrationError(e.errmsg)
 
-        rhnreg.sendHardware(profile.src, profile.hardware)
-        rhnreg.sendPackages(profile.src, profile.packages)
+    def _start_rhnsd(self, profile):
+        """
+        Send virtualization info and start rhnsd.
+        """
         rhnreg.sendVirtInfo(profile.src)
         rhnreg.startRhnsd()
 
-        check.CheckCli(rhnreg.cfg, profile.src, self.db, profile.sid, profile, hostname=profile.hostname).main()
+    def _checkin(self, profile, server=None):
+        """
+        Run the first rhn_check of the registered system.
+        """
+        check.CheckCli(rhnreg.cfg, profile.src, self.db, profile.sid, profile, hostname=profile.hostname,
+                       server=server).main()
+
+    def _get_registration_steps(self, server=None):
+        """
+        Get registration steps of one system, in the order of REGISTRATION_STAGES.
+
+        :param server: Server that is kept by the worker, if any.
+        :return: List of (stage name, function of the profile) pairs.
+        """
+        return [(stage, self._journaled(stage, step)) for stage, step in zip(self.REGISTRATION_STAGES, [
+            functools.partial(self._register_system, server=server),
+            lambda profile: rhnreg.sendHardware(profile.src, profile.hardware),
+            lambda profile: rhnreg.sendPackages(profile.src, profile.packages),
+            self._start_rhnsd,
+            functools.partial(self._checkin, server=server),
+        ])]
+
+    def _journaled(self, stage, step):
+        """
+        Wrap the registration step, so it is skipped, if the host has finished it already,
+        and recorded in the registration journal, when it is done.
+        """
+        position = self.REGISTRATION_STAGES.index(stage)
+
+        def _step(profile):
+            if profile.stage is not None and self.REGISTRATION_STAGES.index(profile.stage) >= position:
+                return
+            step(profile)
+            profile.stage = stage
+            with self.db.lock:
+                if stage == self.REGISTRATION_STAGES[-1]:
+                    self.db.delete_journal_host(profile.idx)
+                else:
+                    self.db.set_journal_stage(profile.idx, stage, sid=profile.sid)
+                self.db.commit()
+
+        return _step
+
+    def register(self, profile, server=None, raise_errors=False):
+        """
+        Register one system based on profile.
+
+        :param raise_errors: Raise registration errors to the engine instead of only reporting them.
+        """
+        try:
+            for stage, step in self._get_registration_steps(server=server):
+                step(profile)
+        except Infaketure.RegistrationError as error:
+            if raise_errors:
+                raise
+            print "WARNING: Registration error: {0}".format(error)
+
+    def _get_engine(self):
+        """
+        Get concurrent engine, with the adaptive concurrency, if requested.
+        """
+        limiter = None
+        if self.options.adaptive:
+            limiter = engine.AdaptiveLimiter(maximum=self.workers, target_p95=self.target_p95,
+                                             target_errors=self.target_errors)
+
+        return engine.ConcurrentEngine(size=self.workers, limiter=limiter)
+
+    def _print_capacity(self, runner):
+        """
+        Print the sustainable concurrency, which the adaptive engine settled at.
+        """
+        if not self.options.adaptive:
+            return
+
+        capacity = runner.limiter.capacity()
+        if capacity is None:
+            print "Not enough requests to find the sustainable concurrency"
+        else:
+            print "Sustainable concurrency: {0:.1f} requests in flight (p95 latency {1:.2f}s, errors {2:.1f}%)".format(
+                capacity[0], capacity[1], capacity[2] * 100)
+
+    def _print_pipeline_stats(self, pipeline):
+        """
+        Print how busy the pipeline stages were.
+        """
+        print "{0:<10} {1:>6} {2:>8} {3:>7} {4:>9} {5:>12}".format("Stage", "Limit", "Done", "Errors",
+                                                                   "Average", "Utilization")
+        for stage in pipeline.stats():
+            print "{0:<10} {1:>6} {2:>8} {3:>7} {4:>8.2f}s {5:>11.1f}%".format(
+                stage["name"], stage["limit"], stage["done"], stage["errors"], stage["average"],
+                stage["utilization"] * 100)
+        print "Bottleneck: {0}".format(pipeline.bottleneck())
 
 
 if __name__ == '__main__':
@@ -3,23 +3,10 @@
 #
 # Author: BOFH <bo@suse.de>
 
+import random
 import pkgactions
 
 
-class Action(object):
-    def __init__(self, **returners):
-        self.__returners__ = returners
-        self.__target__ = None
-
-    def __getattr__(self, item):
-        self.__target__ = item
-        return self
-
-    def __call__(self, *args, **kwargs):
-        obj = self.__returners__.get(self.__target__)
-        return callable(obj) and obj(*args, **kwargs) or obj or Dispatcher.success_response()
-
-
 class Dispatcher(object):
     def __init__(self, parent, sid, path=None):
         """
@@ -27,13 +14,12 @@ class Dispatcher(object):
         """
         self.parent = parent
         self.sid = sid
-        self.__traverse_path__ = []
-        for element in (path or "").split("."):
-            getattr(self, element)
+        self.path = path or ""
 
     def __getattr__(self, item):
-        self.__traverse_path__.append(item)
-        return self
+        if item.startswith("__"):
+            raise AttributeError(item)
+        return Dispatcher(self.parent, self.sid, self.path and "{0}.{1}".format(self.path, item) or item)
 
     @staticmethod
     def no_ops_response(*args, **kwargs):
@@ -43,33 +29,109 @@ class Dispatcher(object):
     def success_response(*args, **kwargs):
         return 0, "Success", {}
 
-    def __get_action(self):
-        action = Action()
-        action.packages = Action(checkNeedUpdate=(0, "rpm database not modified since last update "
-                                                     "(or package list recently updated)", {}),
-                                 setLocks=(0, "Wrote /etc/zypp/locks", {}),
-                                 remove=Dispatcher.no_ops_response,
-                                 update=pkgactions.PackageActions(self.parent, self.sid).update,
-                                 patch_install=Dispatcher.no_ops_response,
-                                 runTransaction=Dispatcher.no_ops_response,
-                                 fullUpdate=Dispatcher.no_ops_response,
-                                 refresh_list=(0, "rpmlist refreshed", {}),
-                                 touch_time_stamp=(0, "unable to open the timestamp file", {}),
-                                 verify=Dispatcher.no_ops_response,
-                                 verifyAll=Dispatcher.no_ops_response,)
-        action.reboot = Action()
-        action.rhnsd = Action()
-        action.script = Action()
-        action.scap = Action()
-        action.systemid = Action()
-        action.errata = Action()
-        action.distupgrade = Action()
-        action.configfiles = Action()
-
-        return action
-
     def __call__(self, *args, **kwargs):
-        action = self.__get_action()
-        for p_elm in self.__traverse_path__:
-            action = getattr(action, p_elm)
-        return action(*args, **kwargs)
+        route = ROUTES.get(self.path)
+        if route is None:
+            return Dispatcher.success_response()
+        elif callable(route):
+            return route(self.parent, self.sid, *args, **kwargs)
+        return route
+
+
+def _no_ops(parent, sid, *args, **kwargs):
+    return Dispatcher.no_ops_response()
+
+
+def _update_packages(parent, sid, *args, **kwargs):
+    return pkgactions.PackageActions(parent, sid).update(*args, **kwargs)
+
+
+def _remove_packages(parent, sid, *args, **kwargs):
+    return pkgactions.PackageActions(parent, sid).remove(*args, **kwargs)
+
+
+# Handlers by the full action name: either a static response, or a function of
+# (rhn_check, system ID, action parameters). Other actions simply succeed.
+ROUTES = {
+    "packages.checkNeedUpdate": (0, "rpm database not modified since last update "
+                                    "(or package list recently updated)", {}),
+    "packages.setLocks": (0, "Wrote /etc/zypp/locks", {}),
+    "packages.remove": _remove_packages,
+    "packages.update": _update_packages,
+    "packages.patch_install": _no_ops,
+    "packages.runTransaction": _no_ops,
+    "packages.fullUpdate": _no_ops,
+    "packages.refresh_list": (0, "rpmlist refreshed", {}),
+    "packages.touch_time_stamp": (0, "unable to open the timestamp file", {}),
+    "packages.verify": _no_ops,
+    "packages.verifyAll": _no_ops,
+}
+
+
+class ServiceTime(object):
+    """
+    Time in seconds, that the client spends on an action before it responds,
+    drawn from a distribution: "const:SECONDS", "uniform:MIN:MAX" or "exp:MEAN".
+    """
+    DISTRIBUTIONS = {
+        "const": (1, lambda seconds: seconds),
+        "uniform": (2, random.uniform),
+        "exp": (1, lambda mean: random.expovariate(1.0 / mean)),
+    }
+
+    def __init__(self, spec):
+        self.spec = spec
+        name = spec.split(":")[0]
+        if name not in self.DISTRIBUTIONS:
+            raise ValueError("Unknown distribution '{0}' in '{1}'. Distributions are: {2}".format(
+                name, spec, ", ".join(sorted(self.DISTRIBUTIONS))))
+        arity, self._func = self.DISTRIBUTIONS[name]
+        try:
+            self._args = [float(arg) for arg in spec.split(":")[1:]]
+        except ValueError:
+            raise ValueError("Wrong service time: {0}".format(spec))
+        if len(self._args) != arity or [arg for arg in self._args if arg < 0]:
+            raise ValueError("Distribution '{0}' takes {1} non-negative number(s): {2}".format(name, arity, spec))
+        if name == "uniform" and self._args[0] > self._args[1]:
+            raise ValueError("Minimum is greater than maximum: {0}".format(spec))
+        if name == "exp" and not self._args[0]:
+            raise ValueError("Mean should be positive: {0}".format(spec))
+
+    def __call__(self):
+        return max(self._func(*self._args), 0)
+
+
+def parse_service_times(spec):
+    """
+    Parse service times of the actions.
+
+    :param spec: Comma separated pairs of action and distribution, e.g. "reboot.reboot=const:6,packages.update=exp:2"
+    :return: dict of ServiceTime by the full action name
+    """
+    times = dict()
+    for item in (spec or "").split(","):
+        if not item.strip():
+            continue
+        if "=" not in item:
+            raise ValueError("Wrong service time: {0}".format(item))
+        action, distribution = [part.strip() for part in item.split("=", 1)]
+        times[action] = ServiceTime(distribution)
+
+    return times
+
+
+def get_service_time(action):
+    """
+    Get service time of the action.
+
+    :param action: Full action name.
+    :return: Seconds to wait before the response is submitted.
+    """
+    service_time = SERVICE_TIMES.get(action)
+    return service_time is not None and service_time() or 0
+
+
+# Service times by the full action name. Other actions respond at once.
+SERVICE_TIMES = {
+    "reboot.reboot": ServiceTime("const:6"),  # Make sure SUMA accepts the reboot
+}
@@ -29,6 +29,7 @@
 import os
 import sys
 import time
+import threading
 import xmlrpclib
 import urlparse
 
@@ -46,6 +47,7 @@ from up2date_client import capabilities
 from up2date_client import rhncli, rhnserver
 
 import actions
+from infaketure import transport
 
 del sys.modules['sgmlop']
 
@@ -60,6 +62,119 @@ DISABLE_FILE = "/etc/sysconfig/rhn/disable"
 # Actions that will run each time we execute.
 LOCAL_ACTIONS = [("packages.checkNeedUpdate", ("rhnsd=1",))]
 
+# Servers of the current thread, so connections and capabilities are reused
+_local = threading.local()
+_caps_headers = list()
+_caps_lock = threading.Lock()
+
+
+def get_server(cfg, refreshCallback=None, serverOverride=None, timeout=None):
+    """
+    Moved from rpcServer.
+    """
+    ca = cfg["sslCACert"]
+    if isinstance(ca, basestring):
+        ca = [ca]
+
+    rhns_ca_certs = ca or ["/usr/share/rhn/RHNS-CA-CERT"]
+    if cfg["enableProxy"]:
+        proxy_host = config.getProxySetting()
+    else:
+        proxy_host = None
+
+    if not serverOverride:
+        server_urls = config.getServerlURL()
+    else:
+        server_urls = serverOverride
+    server_list = rpcServer.ServerList(server_urls)
+
+    proxy_user = None
+    proxy_password = None
+    if cfg["enableProxyAuth"]:
+        proxy_user = cfg["proxyUser"] or None
+        proxy_password = cfg["proxyPassword"] or None
+
+    lang = None
+    for env in 'LANGUAGE', 'LC_ALL', 'LC_MESSAGES', 'LANG':
+        if os.environ.get(env):
+            lang = os.environ[env].split(':')[0].split('.')[0]
+            break
+        else:
+            continue
+
+    # Connections are kept open between the requests of the server
+    retry_server_class = transport.keep_alive(rpcServer.RetryServer)
+    retry_server = retry_server_class(server_list.server(),
+                                      refreshCallback=refreshCallback,
+                                      proxy=proxy_host,
+                                      username=proxy_user,
+                                      password=proxy_password)
+    retry_server.addServerList(server_list)
+    retry_server.add_header("X-Up2date-Version", up2dateUtils.version())
+
+    if lang:
+        retry_server.setlang(lang)
+
+    # require RHNS-CA-CERT file to be able to authenticate the SSL connections
+    need_ca = [True for i in retry_server.serverList.serverList if urlparse.urlparse(i)[0] == 'https']
+    if need_ca:
+        for rhns_ca_cert in rhns_ca_certs:
+            if not os.access(rhns_ca_cert, os.R_OK):
+                msg = "%s: %s" % ("ERROR: can not find RHNS CA file", rhns_ca_cert)
+                log.log_me("%s" % msg)
+                raise up2dateErrors.SSLCertificateFileNotFound(msg)
+
+            # force the validation of the SSL cert
+            retry_server.add_trusted_cert(rhns_ca_cert)
+
+    # send up the capabality info, loaded only once
+    with _caps_lock:
+        if not _caps_headers:
+            clientCaps.loadLocalCaps()
+            _caps_headers.extend(clientCaps.caps.headerFormat())
+    for (headerName, value) in _caps_headers:
+        retry_server.add_header(headerName, value)
+
+    return retry_server
+
+
+def _get_local_cache(name):
+    """
+    Get cache of the current thread, empty in a forked process.
+    """
+    if getattr(_local, "pid", None) != os.getpid():
+        _local.__dict__.clear()
+        _local.pid = os.getpid()
+    if not hasattr(_local, name):
+        setattr(_local, name, dict())
+
+    return getattr(_local, name)
+
+
+def get_cached_server(cfg):
+    """
+    Get server of the current thread, created once per server URL.
+    All the fake clients of the thread share it.
+    """
+    servers = _get_local_cache("servers")
+    key = (str(cfg["serverURL"]), str(cfg["sslCACert"]))
+    if key not in servers:
+        servers[key] = get_server(cfg)
+
+    return servers[key]
+
+
+def get_rhn_server(server):
+    """
+    Get RHN server over the given server, so server capabilities are asked only once.
+    """
+    rhn_servers = _get_local_cache("rhn_servers")
+    cached = rhn_servers.get(id(server))
+    if cached is None or cached[0] is not server:
+        cached = rhn_servers[id(server)] = (server, FakeRHNServer(server))
+
+    return cached[1]
+
 
 class FakeRHNServer(rhnserver.RhnServer):
 
@@ -70,11 +185,11 @@ class FakeRHNServer(rhnserver.RhnServer):
 
 class CheckCli(rhncli.RhnCli):
 
-    def __init__(self, cfg, sid, dbconn, system_id, profile, hostname=None):
+    def __init__(self, cfg, sid, dbconn, system_id, profile, hostname=None, server=None):
         self.cfg = cfg
         self.db = dbconn
         self.rhns_ca_cert = self.cfg['sslCACert']
-        self.server = None
+        self.server = server  # Given server, used by all the steps instead of the server of their thread
         self.options = list()
         self.args = list()
         self.sid = sid              # This is the entire XML source, not a System ID
@@ -82,6 +197,9 @@ class CheckCli(rhncli.RhnCli):
         self.verbose = False
         self.hostname = hostname and hostname.split(".")[0] or None
         self.profile = profile
+        self.caps = None
+        self.status_report = None
+        self.defer = None  # Function of (seconds, response), that submits the response later without waiting
 
     def initialize(self):
         pass
@@ -90,29 +208,113 @@ class CheckCli(rhncli.RhnCli):
         """
         Process all the actions we have in the queue.
         """
+        self.start()
+        action = self.poll_action()
+        while action:
+            response = self.process_action(action)
+            if response is not None:
+                self.submit_response(*response)
+            action = self.poll_action()
+        self.finish()
+
+    def _get_server(self):
+        """
+        Get the given server, or the server of the current thread.
+        Steps of one check-in can run in different threads at the same time, e.g. a deferred
+        response and the next poll, so each step gets its own server and passes it down.
+        """
+        if self.server is not None:
+            return self.server
+
+        return get_cached_server(self.cfg)
+
+    def get_rhn_server(self):
+        """
+        Get RHN server over the server of the current step.
+        """
+        return get_rhn_server(self._get_server())
+
+    def start(self):
+        """
+        Start the check-in.
+        """
         CheckCli.__check_instance_lock()
         CheckCli.__check_rhn_disabled()
         CheckCli.__check_has_system_id()
 
-        self.server = self.get_server()
+        # the list of caps the client needs
+        self.caps = capabilities.Capabilities()
 
-        self.__run_remote_actions()
+        sysname, nodename, release, version, machine = os.uname()
+        self.status_report = {
+            'uname': (sysname, (self.hostname and self.hostname or nodename), release, version, machine),
+            'uptime': [0, 0],  # Just rebooted
+        }
+
+    def poll_action(self):
+        """
+        Get the next action from the queue.
+
+        :return: Action or None, if the queue is empty.
+        """
+        server = self._get_server()
+        action = self.__get_action(server, self.status_report)
+        if action:
+            self.__verify_server_capabilities(server, self.caps)  # Headers of the response with the action
+
+        return action
+
+    def process_action(self, action):
+        """
+        Run the action.
+
+        :return: Response to submit: (action ID, status, message, data), or None.
+        """
+        if not self.is_valid_action(action):
+            if self.verbose:
+                print "Action '{0}' is invalid".format(str(action))
+            return None
+
+        log.log_debug("handle_action", action)
+        (method, params) = self.__parse_action_data(action)
+        (status, message, data) = self.__run_action(method, params, {'cache_only': None})
+        response = action['id'], status, message, data
+        delay = actions.get_service_time(method)
+        if delay and self.defer is not None:
+            if self.verbose:
+                print "Action ID {0} takes {1:.1f}s, the response is deferred".format(action["id"], delay)
+            self.defer(delay, response)
+            return None
+        elif delay:
+            if self.verbose:
+                print "Action ID {0} takes {1:.1f}s, pausing...".format(action["id"], delay)
+            time.sleep(delay)
+        if self.verbose:
+            print "Sending back response for action ID {0}".format(action["id"])
+
+        return response
+
+    def finish(self):
+        """
+        Run local and future actions, once the queue is empty.
+        """
         self.__run_local_actions()
 
-        s = rhnserver.RhnServer()
+        server = self._get_server()
+        s = get_rhn_server(server)
         if s.capabilities.hasCapability('staging_content', 1) and self.cfg['stagingContent'] != 0:
-            self.__check_future_actions()
+            self.__check_future_actions(server)
 
-    def __get_action(self, status_report):
+    def __get_action(self, server, status_report):
         try:
-            return self.server.queue.get(self.sid, ACTION_VERSION, status_report)
+            return server.queue.get(self.sid, ACTION_VERSION, status_report)
         except Exception as ex:
             if self.verbose:
                 print "Action execution error:", ex
 
-    def __query_future_actions(self, time_window):
+    def __query_future_actions(self, server, time_window):
         try:
-            return self.server.queue.get_future_actions(self.sid, time_window)
+            return server.queue.get_future_actions(self.sid, time_window)
         except Exception as ex:
             if self.verbose:
                 print "Future actions error:", ex
@@ -122,36 +324,15 @@ class CheckCli(rhncli.RhnCli):
         Fetch one specific action from rhnParent
         """
 
-    def __check_future_actions(self):
+    def __check_future_actions(self, server):
         """ Retrieve scheduled actions and cache them if possible """
         time_window = self.cfg['stagingContentWindow'] or 24
-        actions = self.__query_future_actions(time_window)
+        actions = self.__query_future_actions(server, time_window)
         for action in actions:
             self.handle_action(action, cache_only=1)
 
-    def __run_remote_actions(self):
-        # the list of caps the client needs
-        caps = capabilities.Capabilities()
-
-        sysname, nodename, release, version, machine = os.uname()
-        status_report = {
-            'uname': (sysname, (self.hostname and self.hostname or nodename), release, version, machine),
-            'uptime': [0, 0],  # Just rebooted
-        }
-
-        action = self.__get_action(status_report)
-        while action:
-            self.__verify_server_capabilities(caps)
-            if self.is_valid_action(action):
-                self.handle_action(action)
-            else:
-                if self.verbose:
-                    print "Action '{0}' is invalid".format(str(action))
-
-            action = self.__get_action(status_report)
-
-    def __verify_server_capabilities(self, caps):
-        response_headers = self.server.get_response_headers()
+    def __verify_server_capabilities(self, server, caps):
+        response_headers = server.get_response_headers()
         caps.populate(response_headers)
         try:
             caps.validate()
@@ -172,11 +353,9 @@ class CheckCli(rhncli.RhnCli):
     def submit_response(self, action_id, status, message, data):
         """ Submit a response for an action_id. """
 
-        # get a new server object with fresh headers
-        self.server = self.get_server()
-
+        server = self._get_server()
         try:
-            return self.server.queue.submit(self.sid, action_id, status, message, data)
+            return server.queue.submit(self.sid, action_id, status, message, data)
         except Exception as ex:
             print ex
 
@@ -239,14 +418,8 @@ class CheckCli(rhncli.RhnCli):
     def __run_action(self, method, params, kwargs={}):
         try:
             retval = actions.Dispatcher(self, self.system_id, method)(*params, **kwargs)
-            if method == "reboot.reboot":
-                # Make sure SUMA accepts the reboot
-                if self.verbose:
-                    print "\tINFO: Reboot scheduled. Pausing for a few seconds..."
-                time.sleep(6)
-            else:
-                if self.verbose:
-                    print "Call: '{0}', return: {1}".format(method, retval)
+            if self.verbose:
+                print "Call: '{0}', return: {1}".format(method, retval)
             return retval
         except Exception as ex:
             import traceback
@@ -274,66 +447,6 @@ class CheckCli(rhncli.RhnCli):
 
     def get_server(self, refreshCallback=None, serverOverride=None, timeout=None):
         """
-        Moved from rpcServer.
+        Get a new server object with fresh headers.
         """
-        ca = self.cfg["sslCACert"]
-        if isinstance(ca, basestring):
-            ca = [ca]
-
-        rhns_ca_certs = ca or ["/usr/share/rhn/RHNS-CA-CERT"]
-        if self.cfg["enableProxy"]:
-            proxy_host = config.getProxySetting()
-        else:
-            proxy_host = None
-
-        if not serverOverride:
-            server_urls = config.getServerlURL()
-        else:
-            server_urls = serverOverride
-        server_list = rpcServer.ServerList(server_urls)
-
-        proxy_user = None
-        proxy_password = None
-        if self.cfg["enableProxyAuth"]:
-            proxy_user = self.cfg["proxyUser"] or None
-            proxy_password = self.cfg["proxyPassword"] or None
-
-        lang = None
-        for env in 'LANGUAGE', 'LC_ALL', 'LC_MESSAGES', 'LANG':
-            if os.environ.get(env):
-                lang = os.environ[env].split(':')[0].split('.')[0]
-                break
-            else:
-                continue
-
-        retry_server = rpcServer.RetryServer(server_list.server(),
-                                             refreshCallback=refreshCallback,
-                                             proxy=proxy_host,
-                                             username=proxy_user,
-                                             password=proxy_password)
-        retry_server.addServerList(server_list)
-        retry_server.add_header("X-Up2date-Version", up2dateUtils.version())
-
-        if lang:
-            retry_server.setlang(lang)
-
-        # require RHNS-CA-CERT file to be able to authenticate the SSL connections
-        need_ca = [True for i in retry_server.serverList.serverList if urlparse.urlparse(i)[0] == 'https']
-        if need_ca:
-            for rhns_ca_cert in rhns_ca_certs:
-                if not os.access(rhns_ca_cert, os.R_OK):
-                    msg = "%s: %s" % ("ERROR: can not find RHNS CA file", rhns_ca_cert)
-                    log.log_me("%s" % msg)
-                    raise up2dateErrors.SSLCertificateFileNotFound(msg)
-
-                # force the validation of the SSL cert
-                retry_server.add_trusted_cert(rhns_ca_cert)
-
-        clientCaps.loadLocalCaps()
-
-        # send up the capabality info
-        header_list = clientCaps.caps.headerFormat()
-        for (headerName, value) in header_list:
-            retry_server.add_header(headerName, value)
-
-        return retry_server
+        return get_server(self.cfg, refreshCallback=refreshCallback, serverOverride=serverOverride, timeout=timeout)
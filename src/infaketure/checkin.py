@@ -0,0 +1,162 @@
+#
+# Check-in engine. Serves action queues of many fake hosts from one process.
+#
+# Author: BOFH <bo@suse.de>
+#
+
+import functools
+import threading
+import Queue
+
+from infaketure import scheduler
+
+
+class CheckInEngine(object):
+    """
+    Runs check-ins of many hosts as steps: start, poll an action, submit
+    its response, ..., finish. Steps of all the hosts go through one queue,
+    served by "size" worker threads, so there are never more than "size"
+    requests in flight, and no worker waits for one host only. Workers
+    keep their own server connections (see check.get_cached_server).
+
+    Only "hosts" check-ins are in progress at the same time. When the engine
+    is full, submit() blocks until one of the check-ins is finished.
+
+    Actions that take time (see actions.SERVICE_TIMES) are parked on a timer
+    and their responses are submitted when the time is over, so neither a
+    worker nor a host slot waits for them.
+    """
+    DEFAULT_SIZE = 50
+    HOSTS_PER_WORKER = 10
+
+    def __init__(self, size=None, hosts=None):
+        self.size = int(size or self.DEFAULT_SIZE)
+        self.done = 0
+        self.errors = 0
+        self.__steps = Queue.Queue()
+        self.__hosts = threading.BoundedSemaphore(int(hosts or self.size * self.HOSTS_PER_WORKER))
+        self.__lock = threading.Lock()
+        self.__workers = list()
+        self.__timers = scheduler.Scheduler()
+        self.__timer_thread = None
+        self.__pending = 0  # Check-ins and deferred responses, that are not over yet
+        self.__idle = threading.Condition(self.__lock)
+
+    def start(self):
+        """
+        Start the workers and the timers of the deferred responses.
+        """
+        while len(self.__workers) < self.size:
+            worker = threading.Thread(target=self.__work)
+            worker.daemon = True
+            worker.start()
+            self.__workers.append(worker)
+        if self.__timer_thread is None:
+            self.__timer_thread = self.__timers.start()
+
+    def submit(self, cli):
+        """
+        Check in the host.
+
+        :param cli: CheckCli of the host.
+        """
+        self.__hosts.acquire()
+        with self.__lock:
+            self.__pending += 1
+        cli.defer = functools.partial(self.__defer, cli)
+        self.__steps.put((cli, self._start, None))
+
+    def __defer(self, cli, delay, response):
+        """
+        Park the response of the host and submit it after the delay.
+        """
+        with self.__lock:
+            self.__pending += 1
+        self.__timers.schedule_in(delay, self.__steps.put, (cli, self._complete, response))
+
+    def __work(self):
+        """
+        Worker loop: run one step and queue the next step of the same host.
+        """
+        while True:
+            cli, step, data = self.__steps.get()
+            try:
+                next_step = step(cli, data)
+            except Exception as error:
+                print "Check-in error: {0}".format(error)
+                next_step = None
+                self.__finish(failed=True)
+            if next_step is not None:
+                self.__steps.put((cli,) + next_step)
+            self.__steps.task_done()
+
+    def __finish(self, failed=False):
+        """
+        Check-in of the host is over.
+        """
+        with self.__lock:
+            if failed:
+                self.errors += 1
+            else:
+                self.done += 1
+        self.__hosts.release()
+        self.__release()
+
+    def __release(self):
+        """
+        Check-in or deferred response is over.
+        """
+        with self.__lock:
+            self.__pending -= 1
+            if not self.__pending:
+                self.__idle.notify_all()
+
+    def _start(self, cli, data):
+        """
+        Start the check-in and poll the first action.
+        """
+        cli.start()
+        return self._poll(cli, None)
+
+    def _poll(self, cli, data):
+        """
+        Get the next action and run it.
+        """
+        action = cli.poll_action()
+        if not action:
+            return self._finish, None
+
+        response = cli.process_action(action)
+        return response is not None and (self._submit, response) or (self._poll, None)
+
+    def _submit(self, cli, response):
+        """
+        Submit response of the action.
+        """
+        cli.submit_response(*response)
+        return self._poll, None
+
+    def _finish(self, cli, data):
+        """
+        Run the local actions and finish the check-in.
+        """
+        cli.finish()
+        self.__finish()
+
+    def _complete(self, cli, response):
+        """
+        Submit the deferred response. The check-in of the host may be over already.
+        """
+        try:
+            cli.submit_response(*response)
+        except Exception as error:
+            print "Deferred response error: {0}".format(error)
+        self.__release()
+
+    def join(self):
+        """
+        Wait for all the submitted check-ins and their deferred responses.
+        """
+        with self.__lock:
+            while self.__pending:
+                self.__idle.wait(1)  # With a timeout, so a KeyboardInterrupt is not held up
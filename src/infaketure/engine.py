@@ -0,0 +1,269 @@
+#
+# Concurrent engine. Runs many network-bound jobs from one process.
+#
+# Author: BOFH <bo@suse.de>
+#
+
+import threading
+import Queue
+import time
+
+
+class Limiter(object):
+    """
+    Limit of the jobs in flight.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.active = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """
+        Wait for a free slot and take it.
+        """
+        with self._cond:
+            while self.active >= int(self.limit):
+                self._cond.wait()
+            self.active += 1
+
+    def release(self, latency=None, failed=False):
+        """
+        Give the slot back.
+
+        :param latency: Seconds the job took.
+        :param failed: True, if the job failed.
+        """
+        with self._cond:
+            self.active -= 1
+            self._cond.notify_all()
+
+
+class AdaptiveLimiter(Limiter):
+    """
+    Limit of the jobs in flight that follows the server capacity (AIMD).
+
+    After every "window" of finished jobs, the limit is increased by one,
+    if their p95 latency and error rate are under the targets. Otherwise
+    it is cut by the "decrease" factor.
+    """
+    WINDOW = 20
+    DEFAULT_TARGET_P95 = 2.0
+    DEFAULT_TARGET_ERRORS = 0.01
+
+    def __init__(self, limit=None, minimum=1, maximum=None, target_p95=None, target_errors=None, decrease=0.5):
+        self.maximum = int(maximum or ConcurrentEngine.DEFAULT_SIZE)
+        self.minimum = min(minimum, self.maximum)
+        Limiter.__init__(self, min(max(limit or self.minimum, self.minimum), self.maximum))
+        self.target_p95 = target_p95 or self.DEFAULT_TARGET_P95
+        self.target_errors = self.DEFAULT_TARGET_ERRORS if target_errors is None else target_errors
+        self.decrease = decrease
+        self.decisions = list()  # (limit, p95, error rate) of every window
+        self._latencies = list()
+        self._failures = 0
+
+    def release(self, latency=None, failed=False):
+        """
+        Give the slot back and adjust the limit, once the window is full.
+        """
+        with self._cond:
+            self._latencies.append(latency or 0.0)
+            self._failures += failed and 1 or 0
+            if len(self._latencies) >= self.WINDOW:
+                self._adjust()
+            Limiter.release(self)
+
+    def _adjust(self):
+        """
+        Increase the limit additively or decrease it multiplicatively.
+        """
+        latencies = sorted(self._latencies)
+        p95 = latencies[int(0.95 * (len(latencies) - 1))]
+        errors = float(self._failures) / len(latencies)
+        self.decisions.append((int(self.limit), p95, errors))
+        if p95 > self.target_p95 or errors > self.target_errors:
+            self.limit = max(self.limit * self.decrease, self.minimum)
+        else:
+            self.limit = min(self.limit + 1, self.maximum)
+        self._latencies = list()
+        self._failures = 0
+
+    def capacity(self, last=10):
+        """
+        Get the sustainable concurrency: the average limit over the last windows.
+
+        :param last: Amount of the last windows.
+        :return: (limit, p95 latency, error rate), or None, if no window was finished.
+        """
+        with self._cond:
+            decisions = self.decisions[-last:]
+        if not decisions:
+            return None
+
+        return tuple([sum(values) / float(len(decisions)) for values in zip(*decisions)])
+
+
+class ConcurrentEngine(object):
+    """
+    Runs jobs in threads of one process, keeping only "size" of them in flight,
+    or as many as the limiter allows. When the engine is full, submit() blocks
+    until one of the jobs is finished.
+    """
+    DEFAULT_SIZE = 50
+
+    def __init__(self, size=None, limiter=None):
+        self.size = int(size or self.DEFAULT_SIZE)
+        self.limiter = limiter or Limiter(self.size)
+        self.done = 0
+        self.errors = 0
+        self.__cond = threading.Condition()
+        self.__active = 0
+
+    def submit(self, func, *args, **kwargs):
+        """
+        Run a job in the engine.
+        """
+        self.limiter.acquire()
+        with self.__cond:
+            self.__active += 1
+        thread = threading.Thread(target=self.__run, args=(func, args, kwargs))
+        thread.daemon = True
+        try:
+            thread.start()
+        except Exception:
+            self.__finish(failed=True)
+            raise
+
+    def __run(self, func, args, kwargs):
+        """
+        Job wrapper.
+        """
+        failed = False
+        start = time.time()
+        try:
+            func(*args, **kwargs)
+        except Exception as error:
+            failed = True
+            print "Job error: {0}".format(error)
+        finally:
+            self.__finish(latency=time.time() - start, failed=failed)
+
+    def __finish(self, latency=None, failed=False):
+        """
+        Give the slot back to the engine.
+        """
+        self.limiter.release(latency=latency, failed=failed)
+        with self.__cond:
+            self.__active -= 1
+            if failed:
+                self.errors += 1
+            else:
+                self.done += 1
+            self.__cond.notify_all()
+
+    def join(self):
+        """
+        Wait for all the submitted jobs.
+        """
+        with self.__cond:
+            while self.__active:
+                self.__cond.wait()
+
+
+class Pipeline(object):
+    """
+    Runs jobs through the stages, connected by queues.
+
+    Every stage has its own limit of the jobs in flight, so the cheap stages
+    are not waiting behind the heavy ones. A job is a stage function, called
+    with the item. If it fails, the item does not go to the next stages.
+    """
+
+    def __init__(self, stages, limits=None, size=None):
+        """
+        :param stages: List of (name, function) pairs.
+        :param limits: Limits of the jobs in flight by the stage name.
+        :param size: Limit of the stages that are not in the limits.
+        """
+        limits = limits or dict()
+        self.stages = list()
+        for name, func in stages:
+            limit = int(limits.get(name) or size or ConcurrentEngine.DEFAULT_SIZE)
+            self.stages.append({"name": name, "func": func, "limit": limit, "done": 0, "errors": 0, "busy": 0.0,
+                                "queue": Queue.Queue(limit * 2)})  # put() blocks when the stage is behind
+        self.__lock = threading.Lock()
+        self.__started = self.__elapsed = None
+
+    def start(self):
+        """
+        Start the stage workers.
+        """
+        self.__started = time.time()
+        for idx, stage in enumerate(self.stages):
+            for worker in range(stage["limit"]):
+                thread = threading.Thread(target=self.__work, args=(idx,))
+                thread.daemon = True
+                thread.start()
+
+    def __work(self, idx):
+        """
+        Stage worker loop.
+        """
+        stage = self.stages[idx]
+        while True:
+            item = stage["queue"].get()
+            start = time.time()
+            failed = False
+            try:
+                stage["func"](item)
+            except Exception as error:
+                failed = True
+                print "Stage {0} error: {1}".format(stage["name"], error)
+            with self.__lock:
+                stage["busy"] += time.time() - start
+                if failed:
+                    stage["errors"] += 1
+                else:
+                    stage["done"] += 1
+            if not failed and idx + 1 < len(self.stages):
+                self.stages[idx + 1]["queue"].put(item)
+            stage["queue"].task_done()
+
+    def submit(self, item):
+        """
+        Pass an item to the first stage.
+        """
+        self.stages[0]["queue"].put(item)
+
+    def join(self):
+        """
+        Wait until all the items went through all the stages.
+        """
+        for stage in self.stages:
+            stage["queue"].join()
+        self.__elapsed = time.time() - self.__started
+
+    def stats(self):
+        """
+        Get stage statistics: processed items, errors, average time
+        and utilization, which is the share of the time the stage workers were busy.
+
+        :return: List of the dictionaries, in the order of the stages.
+        """
+        stats = list()
+        for stage in self.stages:
+            stats.append({
+                "name": stage["name"], "limit": stage["limit"],
+                "done": stage["done"], "errors": stage["errors"],
+                "average": stage["busy"] / max(stage["done"] + stage["errors"], 1),
+                "utilization": stage["busy"] / (stage["limit"] * max(self.__elapsed or 0, 1e-6)),
+            })
+
+        return stats
+
+    def bottleneck(self):
+        """
+        Get the name of the stage that saturates first, i.e. the busiest one.
+        """
+        return sorted(self.stats(), key=lambda stage: stage["utilization"])[-1]["name"]
@@ -4,63 +4,128 @@
 #
 
 import os
-import string
 import random
 import re
 import socket
+import json
+import tempfile
 
 
 class FakeNames(object):
     CRACKLIB = "/usr/share/cracklib"
+    CACHE = os.path.join(os.path.expanduser("~"), ".cache", "infaketure", "cracklib.json")
+    ATTEMPTS = 10  # Random names to try, before a colliding name gets a numeric suffix
 
-    def __init__(self, fqdn=False):
-        self._history = list()
-        self._crack_dict = list()
+    def __init__(self, fqdn=False, cache=None):
+        self._history = set()
+        self._suffixes = dict()
+        self._crack_dict = dict()  # Pairs of (words ending with "y", other words) by the first letter
+        self._letters = list()
         self._idx = 0
+        self._cache = cache or self.CACHE
         if fqdn:
             self._domain = "." + ".".join(socket.getfqdn().split(".")[1:])
         else:
             self._domain = ""
 
         if os.path.exists(self.CRACKLIB):
-            self._unpack_cracklib()
-            self._stub = None
-        else:
-            self._stub = 'base'
+            self._load_cracklib()
+        self._stub = not self._letters and 'base' or None
+
+    def _get_cracklib_mtime(self):
+        """
+        Get time of the last cracklib dictionary change.
+        """
+        return max([os.path.getmtime(os.path.join(self.CRACKLIB, name)) for name in os.listdir(self.CRACKLIB)] or [0])
+
+    def _load_cracklib(self):
+        """
+        Load the indexed cracklib dictionary from the cache, unpacking it if the cache is outdated.
+        """
+        mtime = self._get_cracklib_mtime()
+        try:
+            with open(self._cache, "rb") as cache:
+                cached_mtime, index = json.load(cache)
+            if cached_mtime == mtime:
+                self._crack_dict = dict([(self._to_str(letter), (self._to_str(prefs), self._to_str(posts)))
+                                         for letter, (prefs, posts) in index.items()])
+        except (IOError, ValueError, TypeError):
+            self._crack_dict = dict()
+
+        if not self._crack_dict:
+            self._crack_dict = self._index_cracklib()
+            self._save_cache(mtime)
+
+        self._letters = sorted([letter for letter, (prefs, posts) in self._crack_dict.items() if prefs and posts])
+
+    def _to_str(self, data):
+        """
+        Get UTF-8 string or list of strings from the decoded JSON cache.
+        """
+        if isinstance(data, list):
+            return [self._to_str(item) for item in data]
+
+        return data.encode("utf-8")
+
+    def _save_cache(self, mtime):
+        """
+        Save the indexed cracklib dictionary as JSON, so the next runs do not unpack it again.
+        Unlike marshal, it is read the same by any Python version.
+        """
+        try:
+            if not os.path.exists(os.path.dirname(self._cache)):
+                os.makedirs(os.path.dirname(self._cache))
+            fd, path = tempfile.mkstemp(dir=os.path.dirname(self._cache))
+            with os.fdopen(fd, "wb") as cache:
+                json.dump((mtime, self._crack_dict), cache)
+            os.rename(path, self._cache)
+        except (IOError, OSError, ValueError):  # Words that are not UTF-8 are not JSON
+            pass  # No cache, just slower next time
 
     def _unpack_cracklib(self):
         """
         Unpack cracklib, if installed.
         """
+        return os.popen("/usr/sbin/cracklib-unpacker {0}/pw_dict".format(self.CRACKLIB))
+
+    def _index_cracklib(self):
+        """
+        Index the cracklib words by their first letter and the trailing "y".
+        """
         rnum = re.compile(r"\d")
-        for line in os.popen("/usr/sbin/cracklib-unpacker {0}/pw_dict".format(self.CRACKLIB)):
+        index = dict()
+        for line in self._unpack_cracklib():
             line = rnum.sub("", line).strip()
             if len(line) < 3 or len(line) > 12:
                 continue
-            self._crack_dict.append(line)
+            index.setdefault(line[0], ([], []))[line[-1] != "y" and 1 or 0].append(line)
+
+        return index
 
     def add_history(self, hostname):
         """
         Add hostname to the history.
         """
-        hostname = hostname.split(".")[0]
-        if hostname not in self._history:
-            self._history.append(hostname)
+        self._history.add(hostname.split(".")[0])
 
     def ubuntify(self):
         """
         Msidling with a rock-n-roll! \m/
         """
-        choice = string.lowercase[random.randint(0, len(string.lowercase) - 1)]
-        prefs = list()
-        posts = list()
-        for word in self._crack_dict:
-            if word[0] == choice:
-                if word[-1] == "y":
-                    prefs.append(word)
-                else:
-                    posts.append(word)
-        return prefs[random.randint(0, len(prefs) - 1)], posts[random.randint(0, len(posts) - 1)]
+        prefs, posts = self._crack_dict[random.choice(self._letters)]
+        return random.choice(prefs), random.choice(posts)
+
+    def _get_unique(self, name):
+        """
+        Get a name that is not in the history yet, adding a numeric suffix.
+        """
+        while name in self._history:
+            suffix = self._suffixes.get(name, 1) + 1
+            self._suffixes[name] = suffix
+            if "{0}-{1}".format(name, suffix) not in self._history:
+                name = "{0}-{1}".format(name, suffix)
+
+        return name
 
     def __call__(self, *args, **kwargs):
         """
@@ -68,14 +133,17 @@ class FakeNames(object):
         """
         pattern = "{0}-{1}"
         if self._stub:  # No crack lib around. :-(
+            name = pattern.format(self._stub, self._idx)
+            while name in self._history:
+                self._idx += 1
+                name = pattern.format(self._stub, self._idx)
             self._idx += 1
-            return pattern.format(self._stub, self._idx - 1)
-
-        # Yay!
-        name = pattern.format(*self.ubuntify())
-        if name in self._history:
-            while name not in self._history:
+        else:  # Yay!
+            for attempt in range(self.ATTEMPTS):
                 name = pattern.format(*self.ubuntify())
+                if name not in self._history:
+                    break
+            name = self._get_unique(name)
         self.add_history(name)
 
         return name + self._domain
@@ -190,7 +190,7 @@ class LoadScheduleProcessor(object):
         :param options: Additional options for the install
         :return:
         """
-        for profile in self.db.get_host_profiles():
+        for profile in self.db.iter_host_profiles(fields=()):
             self.pool.run(multiprocessing.Process(target=self.__install_one, args=(profile,), kwargs=options))
 
     def __install_one(self, profile, **options):
@@ -0,0 +1,154 @@
+#
+# Network address allocator. Gives every fake host its own MAC, IPv4
+# and IPv6 address, computed from the host index in constant time.
+#
+# Author: BOFH <bo@suse.de>
+#
+
+import socket
+import struct
+
+
+def _gcd(a, b):
+    """
+    Greatest common divisor.
+    """
+    while b:
+        a, b = b, a % b
+
+    return a
+
+
+class _Range(object):
+    """
+    Range of "size" addresses, starting at "first".
+
+    Host index "idx" is mapped to the slot (multiplier * idx + seed) mod size.
+    The multiplier is coprime with the size, so the mapping is a bijection:
+    two hosts never get the same slot until the range is exhausted.
+    """
+    GOLDEN = 0.6180339887  # Spreads neighbour indexes over the whole range
+
+    def __init__(self, name, first, size, seed=0):
+        if size < 1:
+            raise ValueError("Address range {0} is empty".format(name))
+        self.name = name
+        self.first = first
+        self.size = size
+        self.seed = seed % size
+        self.multiplier = max(int(size * self.GOLDEN), 1)
+        while _gcd(self.multiplier, size) != 1:
+            self.multiplier += 1
+
+    def __getitem__(self, idx):
+        """
+        Get address of the host, as an integer.
+        """
+        if not 0 <= idx < self.size:
+            raise ValueError("Address range {0} has only {1} addresses, host index {2} is out of it".format(
+                self.name, self.size, idx))
+
+        return self.first + (self.multiplier * idx + self.seed) % self.size
+
+
+class AddressAllocator(object):
+    """
+    Allocates MAC, IPv4 and IPv6 addresses by the host index.
+    The same seed and index always give the same addresses.
+    """
+    DEFAULT_MAC_PREFIX = "de:af:be"
+    DEFAULT_IPV4_RANGE = "10.0.0.0/8"
+    DEFAULT_IPV6_RANGE = "fd00:dead:beef::/64"
+
+    def __init__(self, seed=0, mac_prefix=None, ipv4_range=None, ipv6_range=None):
+        seed = int(seed or 0)
+        self.mac_prefix = (mac_prefix or self.DEFAULT_MAC_PREFIX).lower()
+        self._mac = self._get_mac_range(self.mac_prefix, seed)
+        self._ipv4 = self._get_ip_range(ipv4_range or self.DEFAULT_IPV4_RANGE, socket.AF_INET, seed)
+        self._ipv6 = self._get_ip_range(ipv6_range or self.DEFAULT_IPV6_RANGE, socket.AF_INET6, seed)
+
+    def _get_mac_range(self, prefix, seed):
+        """
+        Get MAC addresses range after the prefix.
+        """
+        try:
+            octets = [int(octet, 16) for octet in prefix.split(":")]
+        except ValueError:
+            raise ValueError("Wrong MAC prefix: {0}".format(prefix))
+        if not 0 < len(octets) < 6 or [octet for octet in octets if not 0 <= octet <= 0xff]:
+            raise ValueError("MAC prefix should be one to five octets: {0}".format(prefix))
+        if octets[0] & 1:
+            raise ValueError("MAC prefix is a multicast address: {0}".format(prefix))
+
+        first = 0
+        for octet in octets:
+            first = first << 8 | octet
+        bits = 8 * (6 - len(octets))
+
+        return _Range(prefix, first << bits, 1 << bits, seed)
+
+    def _get_ip_range(self, cidr, family, seed):
+        """
+        Get IP addresses range of the network, except its network and broadcast addresses.
+        """
+        bits = family == socket.AF_INET and 32 or 128
+        try:
+            address, prefix = cidr.split("/")
+            prefix = int(prefix)
+            packed = socket.inet_pton(family, address)
+        except (ValueError, socket.error):
+            raise ValueError("Wrong network: {0}".format(cidr))
+        if not 0 <= prefix <= bits:
+            raise ValueError("Wrong network prefix: {0}".format(cidr))
+
+        network = 0
+        for chunk in struct.unpack("!{0}I".format(bits // 32), packed):
+            network = network << 32 | chunk
+        host_bits = bits - prefix
+        network = network >> host_bits << host_bits
+        size = 1 << host_bits
+        if family == socket.AF_INET:
+            size -= 2  # No network and broadcast addresses
+        else:
+            size -= 1  # No subnet-router anycast address
+
+        return _Range(cidr, network + 1, size, seed)
+
+    def _format_ip(self, address, family):
+        """
+        Format IP address from an integer.
+        """
+        chunks = list()
+        for idx in range(family == socket.AF_INET and 1 or 4):
+            chunks.insert(0, address & 0xffffffff)
+            address >>= 32
+
+        return socket.inet_ntop(family, struct.pack("!{0}I".format(len(chunks)), *chunks))
+
+    def get_mac(self, idx):
+        """
+        Get MAC address of the host.
+
+        :param idx: Host index
+        :return: MAC address
+        """
+        address = "{0:012x}".format(self._mac[idx])
+        return ":".join([address[pos:pos + 2] for pos in range(0, 12, 2)])
+
+    def get_ipv4(self, idx):
+        """
+        Get IPv4 address of the host.
+
+        :param idx: Host index
+        :return: IPv4 address
+        """
+        return self._format_ip(self._ipv4[idx], socket.AF_INET)
+
+    def get_ipv6(self, idx):
+        """
+        Get IPv6 address of the host.
+
+        :param idx: Host index
+        :return: IPv6 address
+        """
+        return self._format_ip(self._ipv6[idx], socket.AF_INET6)
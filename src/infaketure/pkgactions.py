@@ -3,60 +3,141 @@
 # Author: bo@suse.de
 #
 
-import check
+import xmlrpclib
+
+from up2date_client import up2dateErrors
 
 
 class PackageActions(object):
     """
     Package actions responder.
     """
+    DELTA_RATIO = 0.5  # Changes of more than this part of the package list are uploaded in full
+
     def __init__(self, caller, sid):
         self.caller = caller
         self.sid = sid
 
+    def _get_profile(self):
+        """
+        Get profile of the host with its packages: the one cached by the caller, or the stored one.
+        The profile of a just registered host may still wait in the writer queue of the store:
+        then the caller's one is used, as the store finds it by SID when updating.
+
+        :return: CMDBBaseProfile or None, if the host has no profile at all.
+        """
+        profile = self.caller.profile
+        with self.caller.db.lock:
+            if profile is None or not isinstance(profile.id, (int, long)):  # Not the stored one yet
+                stored = self.caller.db.get_host_profiles(host_id=self.sid, fields=("packages",))
+                if stored is not None:
+                    profile = self.caller.profile = stored
+            if profile is not None:
+                profile.packages  # Lazy packages are loaded under the lock
+
+        return profile
+
+    def _get_package(self, n_pkg_meta):
+        """
+        Get package dictionary from the requested (name, version, release, epoch, arch).
+        """
+        n, v, r, e, a = n_pkg_meta[:5]
+        return {"name": n, "epoch": e, "version": v, "release": r, "arch": a}
+
+    def _save(self, profile, added, removed):
+        """
+        Store the packages in one transaction and upload the change.
+        """
+        with self.caller.db.lock:
+            self.caller.db.update_profile(profile)
+            self.caller.db.commit()
+        self._upload(profile, added, removed)
+
+    def _upload(self, profile, added, removed):
+        """
+        Upload only the added and removed packages, unless the change is too big
+        or the server refuses it: then upload the whole package list.
+        """
+        if not added and not removed:
+            return
+
+        registration = self.caller.get_rhn_server().registration
+        if len(added) + len(removed) <= len(profile.packages) * self.DELTA_RATIO:
+            try:
+                if removed:
+                    registration.delete_packages(profile.src, [self._get_upload(pkg) for pkg in removed])
+                if added:
+                    registration.add_packages(profile.src, [self._get_upload(pkg) for pkg in added])
+                return
+            except (xmlrpclib.Fault, up2dateErrors.Error) as fault:  # RhnServer turns the faults into errors
+                if self.caller.verbose:
+                    print "Package delta was not accepted, uploading all packages: {0}".format(fault)
+        registration.update_packages(profile.src, profile.packages)
+
+    def _get_upload(self, pkg):
+        """
+        Get package dictionary without the store internals.
+        """
+        return dict([(key, value) for key, value in pkg.items() if not key.startswith("__")])
+
     def update(self, *packages, **kwargs):
         """
-        Install/update fake packages.
+        Install/update fake packages. Installed packages of the same name are replaced.
 
-        :param args:
+        :param packages: List of requested (name, version, release, epoch, arch).
         :param kwargs:
-        :return:
+        :return: Action response
         """
         if not packages:
             return 1, "No packages has been requested", {}
 
-        profile = self.caller.db.get_host_profiles(host_id=self.sid)
+        profile = self._get_profile()
+        if profile is None:
+            return 1, "No profile of the host {0}".format(self.sid), {}
         packages = packages[0]
-        for n_pkg_meta in packages:
-            n, v, r, e, a = n_pkg_meta
-            package = dict()
-            package["name"] = n
-            package["epoch"] = e
-            package["version"] = v
-            package["release"] = r
-            package["arch"] = a
-
-            # Existing package update
-            prf_pkgs = list()
-            for p_pkg in profile.packages:
-                if p_pkg.get('name') != n:
-                    prf_pkgs.append(p_pkg)
-
-            prf_pkgs.append(package)
-            profile.packages = prf_pkgs[:]
-            del prf_pkgs
-
-        self.caller.db.update_profile(profile)
-        self.caller.db.connection.commit()
-        check.FakeRHNServer(self.caller.get_server()).registration.update_packages(profile.src, profile.packages)
+        requested = [self._get_package(n_pkg_meta) for n_pkg_meta in packages]
+        updates = dict([(package["name"], package) for package in requested])
+        added = [package for package in requested if updates[package["name"]] is package]
+        removed = [p_pkg for p_pkg in profile.packages if p_pkg.get("name") in updates]
+        profile.packages = [p_pkg for p_pkg in profile.packages if p_pkg.get("name") not in updates] + added
+        self._save(profile, added, removed)
 
         return 0, "{0} Fake package{1} has been updated".format(len(packages), len(packages) > 1 and "s" or ""), {}
 
-    def remove(self, *args, **kwargs):
+    def remove(self, *packages, **kwargs):
         """
-        Remove fake packages.
+        Remove fake packages. Version, release and arch of the requested packages are matched, if given.
 
-        :param args:
+        :param packages: List of requested (name, version, release, epoch, arch).
         :param kwargs:
-        :return:
+        :return: Action response
         """
+        if not packages:
+            return 1, "No packages has been requested", {}
+
+        profile = self._get_profile()
+        if profile is None:
+            return 1, "No profile of the host {0}".format(self.sid), {}
+        packages = packages[0]
+        removals = dict()
+        for n_pkg_meta in packages:
+            package = self._get_package(n_pkg_meta)
+            removals.setdefault(package["name"], list()).append(package)
+
+        def _is_removed(p_pkg):
+            for package in removals.get(p_pkg.get("name"), ()):
+                if not [field for field in ("version", "release", "arch")
+                        if package[field] and package[field] != p_pkg.get(field)]:
+                    return True
+            return False
+
+        kept, removed = list(), list()
+        for p_pkg in profile.packages:
+            if _is_removed(p_pkg):
+                removed.append(p_pkg)
+            else:
+                kept.append(p_pkg)
+        profile.packages = kept
+        self._save(profile, list(), removed)
+
+        return 0, "{0} Fake package{1} has been removed".format(len(packages), len(packages) > 1 and "s" or ""), {}
@@ -1,9 +1,12 @@
 #
-# Process pool. Similar to multiprocess.Pool, but with no limits
+# Process pool. Similar to multiprocess.Pool, but runs arbitrary processes
+# with a limited amount of them at the same time.
 #
 # Author: BOFH <bo@suse.de>
 #
 
+import multiprocessing
+
 
 class Singleton(type):
     _instances = dict()
@@ -18,18 +21,55 @@ class Singleton(type):
 class Pool(object):
     """
     Pool object.
+
+    Only "size" processes are running at the same time. When the pool is full,
+    run() blocks until one of the running processes finishes. Slots are counted
+    by the parent when it reaps the processes, so a process that is killed or
+    crashes gives its slot back as well.
     """
     __metaclass__ = Singleton
 
-    def __init__(self):
+    DEFAULT_SIZE = multiprocessing.cpu_count() * 4
+    REAP_INTERVAL = 1  # Seconds between checks for processes that died without a notice
+
+    def __init__(self, size=None):
+        self.size = int(size or self.DEFAULT_SIZE)
+        self.__finished = multiprocessing.Semaphore(0)  # Released by each exiting process to wake up run()
         self.__processes = list()
 
+    def _notifying(self, run):
+        """
+        Wrap process run, so the pool is woken up when the process is done.
+        """
+        finished = self.__finished
+
+        def _run():
+            try:
+                run()
+            finally:
+                finished.release()
+
+        return _run
+
+    def _reap(self):
+        """
+        Forget the processes that are over, freeing their slots.
+        """
+        self.__processes = [proc for proc in self.__processes if proc.is_alive()]
+
     def run(self, process, join=False):
         """
         Run a process
         """
+        self._reap()
+        while len(self.__processes) >= self.size:
+            self.__finished.acquire(True, self.REAP_INTERVAL)
+            self._reap()
+
+        process.run = self._notifying(process.run)
         process.daemon = not join
         process.start()
+
         if process.daemon:
             self.__processes.append(process)
         else:
@@ -41,8 +81,59 @@ class Pool(object):
         :return:
         """
         while self.__processes:
-            buff = list()
-            for process in self.__processes:
-                if process.is_alive():
-                    buff.append(process)
-            self.__processes = buff[:]
+            self.__processes.pop(0).join()
+
+
+class WorkerPool(object):
+    """
+    Pre-forked pool of long-lived worker processes.
+
+    Each worker calls "initializer" once to build its state, then takes items
+    from the queue and calls "handler(state, item)" for each of them.
+    """
+
+    def __init__(self, handler, initializer=None, size=None):
+        self.size = int(size or Pool.DEFAULT_SIZE)
+        self._handler = handler
+        self._initializer = initializer
+        self.__queue = multiprocessing.Queue(self.size * 2)  # put() blocks when workers are behind
+        self.__workers = list()
+
+    def _work(self):
+        """
+        Worker loop.
+        """
+        state = self._initializer is not None and self._initializer() or None
+        while True:
+            item = self.__queue.get()
+            if item is None:
+                break
+            try:
+                self._handler(state, item)
+            except Exception as error:
+                print "Worker error: {0}".format(error)
+
+    def start(self):
+        """
+        Fork the workers.
+        """
+        while len(self.__workers) < self.size:
+            worker = multiprocessing.Process(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self.__workers.append(worker)
+
+    def put(self, item):
+        """
+        Pass an item to the next free worker.
+        """
+        self.__queue.put(item)
+
+    def join(self):
+        """
+        Stop the workers, once they are done with all the items in the queue.
+        """
+        for worker in self.__workers:
+            self.__queue.put(None)
+        while self.__workers:
+            self.__workers.pop(0).join()
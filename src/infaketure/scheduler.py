@@ -0,0 +1,95 @@
+#
+# Timer scheduler. Fires many timers from one thread, keeping
+# only one heap entry per pending timer.
+#
+# Author: BOFH <bo@suse.de>
+#
+
+import heapq
+import itertools
+import threading
+import time
+
+
+class Scheduler(object):
+    """
+    Timers on a heap, fired by the thread that runs the scheduler.
+    Timers can be scheduled from any thread, also while it runs.
+    """
+    IDLE_WAIT = 1  # Seconds to wait without timers, so a KeyboardInterrupt is not held up
+
+    def __init__(self):
+        self._heap = list()
+        self._order = itertools.count()  # Timers of the same time fire in the order they were scheduled
+        self._cond = threading.Condition()
+        self._running = False
+
+    def __len__(self):
+        with self._cond:
+            return len(self._heap)
+
+    def schedule(self, when, func, *args):
+        """
+        Schedule a timer.
+
+        :param when: Unix time to fire at.
+        :param func: Function to call with the args.
+        """
+        with self._cond:
+            heapq.heappush(self._heap, (when, next(self._order), func, args))
+            self._cond.notify()
+
+    def schedule_in(self, delay, func, *args):
+        """
+        Schedule a timer after the delay in seconds.
+        """
+        self.schedule(time.time() + max(delay, 0), func, *args)
+
+    def run(self, until=None, idle=False):
+        """
+        Fire the timers, until stopped, until the given time or until there are no timers left.
+
+        :param until: Unix time to stop at.
+        :param idle: Keep waiting for new timers, when there are no timers left.
+        """
+        with self._cond:
+            self._running = True
+        while True:
+            timer = None
+            with self._cond:
+                while self._running and timer is None and (self._heap or idle):
+                    now = time.time()
+                    if until is not None and now >= until:
+                        break
+                    if self._heap and self._heap[0][0] <= now:
+                        timer = heapq.heappop(self._heap)
+                    else:
+                        wake = min([when for when in [self._heap and self._heap[0][0] or None, until]
+                                    if when is not None] or [now + self.IDLE_WAIT])
+                        self._cond.wait(wake - now)
+                if timer is None:
+                    self._running = False
+                    return
+            when, order, func, args = timer
+            try:
+                func(*args)
+            except Exception as error:
+                print "Timer error: {0}".format(error)
+
+    def start(self):
+        """
+        Run the scheduler in a background thread, waiting for new timers when there are none.
+        """
+        worker = threading.Thread(target=self.run, kwargs={"idle": True})
+        worker.daemon = True
+        worker.start()
+
+        return worker
+
+    def stop(self):
+        """
+        Stop running the scheduler. Pending timers are kept.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify()
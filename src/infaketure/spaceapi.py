@@ -3,17 +3,18 @@
 # Author: BOFH <bo@suse.de>
 #
 
-import xmlrpclib
 import datetime
 import time
 
+from infaketure import transport
+
 
 class _BaseSpaceAPI(object):
     """
     Base API for Spacewalk.
     """
     def __init__(self, url):
-        self.conn = xmlrpclib.ServerProxy(url)
+        self.conn = transport.get_server_proxy(url)  # Keep-alive connections, shared by all the APIs
         self.token = None
 
     def login(self, user, password):
@@ -4,8 +4,17 @@
 #
 
 import sqlite3
+import ast
+import marshal
+import json
 import re
 import os
+import threading
+import time
+import functools
+import hashlib
+import multiprocessing
+import Queue
 from infaketure import cli_msg
 from infaketure import ERROR
 import pickle
@@ -24,6 +33,30 @@ class CMDBBaseProfile(object):
     def __init__(self):
         self.sid = self.__sid = None
         self.name = None  # Profile name
+        self._loaders = dict()  # Fields that are loaded on the first access
+
+    def __getattr__(self, item):
+        """
+        Load lazy field.
+        """
+        loader = self.__dict__.get("_loaders", {}).pop(item, None)
+        if loader is None:
+            raise AttributeError(item)
+        setattr(self, item, loader())
+
+        return getattr(self, item)
+
+    def __getstate__(self):
+        """
+        Load all lazy fields before the profile is pickled.
+        """
+        state = dict(self.__dict__)
+        for item, loader in state.pop("_loaders", {}).items():
+            if item not in state:
+                state[item] = loader()
+        state["_loaders"] = dict()
+
+        return state
 
     @property
     def sid(self):
@@ -38,20 +71,81 @@ class CMDBBaseProfile(object):
 
 
 class DBStorage(object):
+    SCHEMA_VERSION = 1  # 1: blobs are JSON
+
     def __init__(self, path):
         self._path = path
-        self.connection = None
-        self.cursor = None
+        self._pid = None
+        self._connection = None
+        self._cursor = None
+        self.lock = threading.RLock()  # Serializes threads sharing this connection
 
         self.init_queries = list()
-        self.init_queries.append("CREATE TABLE hosts "
-                                 "(id INTEGER PRIMARY KEY, SID CHAR(255), HOSTNAME CHAR(255), SID_XML BLOB)")
-        self.init_queries.append("CREATE TABLE configs "
-                                 "(id INTEGER PRIMARY KEY, hid INTEGER, BODY BLOB)")
-        self.init_queries.append("CREATE TABLE hardware "
-                                 "(id INTEGER PRIMARY KEY, hid INTEGER, BODY BLOB)")
-        self.init_queries.append("CREATE TABLE credentials "
-                                 "(HID INTEGER, S_BODY BLOB)")
+        self.init_queries.append("CREATE TABLE IF NOT EXISTS hosts "
+                                 "(id INTEGER PRIMARY KEY, SID CHAR(255), HOSTNAME CHAR(255), SID_XML BLOB, "
+                                 "BASE INTEGER, IDX INTEGER)")
+        self.init_queries.append("CREATE INDEX IF NOT EXISTS hosts_sid ON hosts (SID)")
+
+        # Configs, hardware and credentials refer to the content-addressed blobs
+        self.init_queries.append("CREATE TABLE IF NOT EXISTS blobs "
+                                 "(DIGEST CHAR(40) PRIMARY KEY, BODY BLOB)")
+        self.init_queries.append("CREATE TABLE IF NOT EXISTS configs "
+                                 "(id INTEGER PRIMARY KEY, hid INTEGER, DIGEST CHAR(40))")
+        self.init_queries.append("CREATE TABLE IF NOT EXISTS hardware "
+                                 "(id INTEGER PRIMARY KEY, hid INTEGER, DIGEST CHAR(40))")
+        self.init_queries.append("CREATE TABLE IF NOT EXISTS credentials "
+                                 "(HID INTEGER, DIGEST CHAR(40))")
+        self.init_queries.append("CREATE INDEX IF NOT EXISTS configs_hid ON configs (HID)")
+        self.init_queries.append("CREATE INDEX IF NOT EXISTS hardware_hid ON hardware (HID)")
+        self.init_queries.append("CREATE INDEX IF NOT EXISTS credentials_hid ON credentials (HID)")
+
+        # Package catalog, shared by all hosts
+        self.init_queries.append("CREATE TABLE IF NOT EXISTS packages "
+                                 "(id INTEGER PRIMARY KEY, NAME CHAR(255), EPOCH CHAR(255), VERSION CHAR(255), "
+                                 "RELEASE CHAR(255), ARCH CHAR(255))")
+        self.init_queries.append("CREATE UNIQUE INDEX IF NOT EXISTS packages_nevra "
+                                 "ON packages (NAME, EPOCH, VERSION, RELEASE, ARCH)")
+
+        # Base package profiles, shared by hosts that have the same packages
+        self.init_queries.append("CREATE TABLE IF NOT EXISTS base_profiles "
+                                 "(id INTEGER PRIMARY KEY, DIGEST CHAR(40))")
+        self.init_queries.append("CREATE UNIQUE INDEX IF NOT EXISTS base_profiles_digest ON base_profiles (DIGEST)")
+        self.init_queries.append("CREATE TABLE IF NOT EXISTS base_packages "
+                                 "(BID INTEGER, PID INTEGER, INSTALLTIME INTEGER)")
+        self.init_queries.append("CREATE INDEX IF NOT EXISTS base_packages_bid ON base_packages (BID)")
+
+        # Host packages as an overlay over its base profile: added (+) or removed (-) packages
+        self.init_queries.append("CREATE TABLE IF NOT EXISTS host_packages "
+                                 "(HID INTEGER, PID INTEGER, INSTALLTIME INTEGER, OP CHAR(1))")
+        self.init_queries.append("CREATE INDEX IF NOT EXISTS host_packages_hid ON host_packages (HID)")
+
+        # Registration journal: hosts that are not fully registered yet and their last finished stage
+        self.init_queries.append("CREATE TABLE IF NOT EXISTS journal "
+                                 "(IDX INTEGER PRIMARY KEY, HOSTNAME CHAR(255), STAGE CHAR(32), SID CHAR(255), "
+                                 "ATTEMPTS INTEGER DEFAULT 1)")
+
+    def _get_own(self, item):
+        """
+        Get connection or cursor of the current process.
+        A forked process never uses the connection it has inherited, but opens its own.
+        """
+        if self._connection is not None and self._pid != os.getpid():
+            self._connection = self._cursor = None
+            self._open_own()
+
+        return getattr(self, item)
+
+    def _set_own(self, item, value):
+        """
+        Set connection or cursor of the current process.
+        """
+        setattr(self, item, value)
+        self._pid = os.getpid()
+
+    connection = property(lambda self: self._get_own("_connection"),
+                          lambda self, value: self._set_own("_connection", value))
+    cursor = property(lambda self: self._get_own("_cursor"),
+                      lambda self, value: self._set_own("_cursor", value))
 
     def open(self, new=False):
         """
@@ -63,33 +157,111 @@ class DBStorage(object):
         if new and os.path.exists(self._path):
             os.unlink(self._path)  # As simple as that
 
-        self.connection = sqlite3.connect(self._path, timeout=1200.0)  # 20 minutes timeout
+        self.connection = self._connect()
         self.connection.text_factory = str
         self.cursor = self.connection.cursor()
 
         self.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        if self.cursor.fetchall():
-            return
+        tables = [table_name[0] for table_name in self.cursor.fetchall()]
 
         self._run_init_queries()
+        if tables:
+            self._migrate(tables)
+        self.cursor.execute("PRAGMA user_version = {0}".format(self.SCHEMA_VERSION))
+        self.connection.commit()
+
+    def _open_own(self):
+        """
+        Open own connection of a forked process.
+        The parent has created and migrated the schema already, so nothing is written.
+        """
+        self.connection = self._connect()
+        self.connection.text_factory = str
+        self.cursor = self.connection.cursor()
+
+    def _connect(self):
+        """
+        Connect to the database.
+        """
+        return sqlite3.connect(self._path, timeout=1200.0,  # 20 minutes timeout
+                               check_same_thread=False)
+
+    def reconnect(self):
+        """
+        Open a new connection in a forked process.
+        The inherited connection is left to the parent.
+        """
+        self.connection = self.cursor = None
+        self._open_own()
+
+    def commit(self):
+        """
+        Commit the current transaction.
+        """
         self.connection.commit()
 
-    def _serialize64(self, obj):
+    def rollback(self):
         """
-        Serialize an object to a string.
-        :param obj: An object
-        :return: Base64 encoded string
+        Roll back the current transaction.
         """
-        return base64.encodestring(pickle.dumps(obj, 0)).replace(os.linesep, '').strip()
+        self.connection.rollback()
 
     def _deserialize64(self, data64):
         """
         Deserialize an object from a base64 string.
+        Used only to migrate credentials of the older databases.
+
         :param data64: Base64 encoded string
         :return: A Python object
         """
         return pickle.loads(base64.decodestring(data64))
 
+    def _put_blob(self, obj):
+        """
+        Store an object once, addressed by the digest of its content.
+        Objects are encoded as canonical JSON, so equal objects always get the same digest.
+
+        :param obj: An object of the JSON types
+        :return: Digest of the blob
+        """
+        body = json.dumps(obj, sort_keys=True, separators=(",", ":"))
+        digest = hashlib.sha1(body).hexdigest()
+        self.cursor.execute("INSERT OR IGNORE INTO blobs (DIGEST, BODY) VALUES (?, ?)",
+                            (digest, sqlite3.Binary(body),))
+
+        return digest
+
+    def _get_blob(self, body):
+        """
+        Get an object from the blob body.
+
+        :param body: Blob body
+        :return: A Python object
+        """
+        return None if body is None else self._to_str(json.loads(str(body)))
+
+    def _to_str(self, obj):
+        """
+        Convert decoded JSON strings to UTF-8 byte strings, as the rest of the data is read.
+        """
+        if isinstance(obj, unicode):
+            return obj.encode("utf-8")
+        elif isinstance(obj, list):
+            return [self._to_str(item) for item in obj]
+        elif isinstance(obj, dict):
+            return dict([(self._to_str(key), self._to_str(value)) for key, value in obj.items()])
+
+        return obj
+
+    def _drop_orphan_blobs(self):
+        """
+        Delete blobs that are not referred anymore.
+        """
+        self.cursor.execute("DELETE FROM blobs WHERE DIGEST NOT IN ("
+                            "SELECT DIGEST FROM configs WHERE DIGEST IS NOT NULL UNION "
+                            "SELECT DIGEST FROM hardware WHERE DIGEST IS NOT NULL UNION "
+                            "SELECT DIGEST FROM credentials WHERE DIGEST IS NOT NULL)")
+
     def _run_init_queries(self):
         """
         Initialization queries
@@ -97,6 +269,13 @@ class DBStorage(object):
         for query in self.init_queries:
             self.cursor.execute(query)
 
+    def _migrate(self, tables):
+        """
+        Convert data of an existing database to the current layout.
+
+        :param tables: Table names of the existing database.
+        """
+
     def purge(self):
         """
         Purge whole database.
@@ -112,6 +291,7 @@ class DBStorage(object):
     def get_next_id(self, table, field="id"):
         """
         Get the max of the ID field.
+        Only for the main process: keys written by concurrent workers are given by SQLite.
         """
         self.cursor.execute("SELECT max({0}) FROM {1}".format(field, table))
         data = self.cursor.fetchall()
@@ -128,6 +308,8 @@ class DBStorage(object):
         """
         Vacuum the database.
         """
+        self._drop_orphan_blobs()
+        self.connection.commit()
         self.cursor.execute("VACUUM")
         self.close()
         self.open()
@@ -153,39 +335,331 @@ class DBOperations(DBStorage):
     """
     Operations over the database.
     """
+    PKG_FIELDS = ("name", "epoch", "version", "release", "arch",)
+    PROFILE_FIELDS = ("packages", "login_info", "hardware",)
+    CHUNK_SIZE = 500
+    PKG_ADDED = "+"
+    PKG_REMOVED = "-"
+
+    def __init__(self, path):
+        DBStorage.__init__(self, path)
+        # Catalog entries and base profiles are never changed, so they are cached
+        self._package_ids = dict()  # Package catalog IDs by NEVRA
+        self._base_ids = dict()  # Base profile IDs by digest
+        self._base_packages = dict()  # Base profile packages by base profile ID
+
+    def _migrate_marshal_blobs(self):
+        """
+        Re-encode marshal blobs as JSON and point their references to the new digests.
+        """
+        self.cursor.execute("SELECT DIGEST, BODY FROM blobs")
+        for digest, body in self.cursor.fetchall():
+            try:
+                json.loads(str(body))
+                continue
+            except ValueError:
+                pass
+            new_digest = self._put_blob(marshal.loads(str(body)))
+            for table_name in ("configs", "hardware", "credentials",):
+                self.cursor.execute("UPDATE {0} SET DIGEST = ? WHERE DIGEST = ?".format(table_name),
+                                    (new_digest, digest,))
+            if new_digest != digest:
+                self.cursor.execute("DELETE FROM blobs WHERE DIGEST = ?", (digest,))
+
+    def rollback(self):
+        """
+        Roll back the current transaction.
+        Cached IDs may refer to the rows that are rolled back, so they are dropped.
+        """
+        self._package_ids.clear()
+        self._base_ids.clear()
+        self._base_packages.clear()
+        DBStorage.rollback(self)
+
+    def purge(self):
+        """
+        Purge whole database.
+        """
+        self._package_ids.clear()
+        self._base_ids.clear()
+        self._base_packages.clear()
+        DBStorage.purge(self)
+
+    def _migrate(self, tables):
+        """
+        Add columns of the base profiles and move packages from the per-host
+        SYS<sid>PKG tables to the shared package catalog.
+
+        :param tables: Table names of the existing database.
+        """
+        for table_name, column, definition in (("hosts", "BASE", "INTEGER"),
+                                               ("hosts", "IDX", "INTEGER"),
+                                               ("host_packages", "OP", "CHAR(1) DEFAULT '+'"),
+                                               ("configs", "DIGEST", "CHAR(40)"),
+                                               ("hardware", "DIGEST", "CHAR(40)"),
+                                               ("credentials", "DIGEST", "CHAR(40)"),
+                                               ("journal", "ATTEMPTS", "INTEGER DEFAULT 1"),):
+            self.cursor.execute("PRAGMA table_info({0})".format(table_name))
+            if column not in [info[1].upper() for info in self.cursor.fetchall()]:
+                self.cursor.execute("ALTER TABLE {0} ADD COLUMN {1} {2}".format(table_name, column, definition))
+
+        # Re-encode marshal blobs of the older databases as JSON
+        self.cursor.execute("PRAGMA user_version")
+        if "blobs" in tables and self.cursor.fetchall()[0][0] < 1:
+            self._migrate_marshal_blobs()
+
+        # Move bodies of the older databases to the blobs
+        for table_name, column, loader in (("configs", "BODY", self._literal),
+                                           ("hardware", "BODY", self._literal),
+                                           ("credentials", "S_BODY", self._deserialize64),):
+            self.cursor.execute("PRAGMA table_info({0})".format(table_name))
+            if column in [info[1].upper() for info in self.cursor.fetchall()]:
+                self.cursor.execute("SELECT ROWID, {0} FROM {1} WHERE DIGEST IS NULL AND {0} IS NOT NULL".format(
+                    column, table_name))
+                for rowid, body in self.cursor.fetchall():
+                    self.cursor.execute("UPDATE {0} SET DIGEST = ?, {1} = NULL WHERE ROWID = ?".format(
+                        table_name, column), (self._put_blob(loader(body)), rowid,))
+
+        for table_name in tables:
+            sid = re.match(r"^SYS(\d+)PKG$", table_name)
+            if not sid:
+                continue
+            self.cursor.execute("SELECT ID FROM hosts WHERE SID = ?", (sid.group(1),))
+            host = self.cursor.fetchall()
+            if host:
+                self.cursor.execute("SELECT NAME, EPOCH, VERSION, RELEASE, ARCH, INSTALLTIME "
+                                    "FROM {0} ORDER BY ID".format(table_name))
+                self._add_host_packages(host[0][0], [dict(zip(self.PKG_FIELDS + ("installtime",), db_pkg))
+                                                     for db_pkg in self.cursor.fetchall()])
+            self.cursor.execute("DROP TABLE {0}".format(table_name))
+
+    def _literal(self, body):
+        """
+        Parse a Python literal, as older databases stored str() of the objects.
+        Bodies that are not literals are kept as strings.
+        """
+        try:
+            return ast.literal_eval(body)
+        except (ValueError, SyntaxError):
+            return body
+
+    def _nevra(self, pkg):
+        """
+        Get package key for the catalog.
+        """
+        nevra = list()
+        for field in self.PKG_FIELDS:
+            value = pkg.get(field)
+            nevra.append("" if value is None else value)
+
+        return tuple(nevra)
+
+    def _get_package_ids(self, packages):
+        """
+        Get catalog IDs of the packages, adding those that are not in the catalog yet.
+        """
+        nevras = [self._nevra(pkg) for pkg in packages]
+        missing = [nevra for nevra in set(nevras) if nevra not in self._package_ids]
+        if missing:
+            self.cursor.executemany("INSERT OR IGNORE INTO packages (NAME, EPOCH, VERSION, RELEASE, ARCH) "
+                                    "VALUES (?, ?, ?, ?, ?)", missing)
+            for nevra in missing:
+                self.cursor.execute("SELECT ID FROM packages WHERE NAME = ? AND EPOCH = ? AND VERSION = ? "
+                                    "AND RELEASE = ? AND ARCH = ?", nevra)
+                self._package_ids[nevra] = self.cursor.fetchall()[0][0]
+
+        return [self._package_ids[nevra] for nevra in nevras]
+
+    def _add_host_packages(self, host_id, packages, operation=PKG_ADDED):
+        """
+        Add packages to the host overlay.
+
+        :param host_id: Internal DB id of the host (not the SID).
+        :param packages: List of the package dictionaries.
+        :param operation: Whether packages are added to the base profile or removed from it.
+        """
+        self.cursor.executemany("INSERT INTO host_packages (HID, PID, INSTALLTIME, OP) VALUES (?, ?, ?, ?)",
+                                [(host_id, pkg_id, pkg.get("installtime") or 0, operation)
+                                 for pkg_id, pkg in zip(self._get_package_ids(packages), packages)])
+
+    def _get_base_id(self, packages):
+        """
+        Get base profile with exactly these packages, adding it if there is none yet.
+
+        :param packages: List of the package dictionaries.
+        :return: Base profile ID
+        """
+        digest = hashlib.sha1(repr(sorted(set([self._nevra(pkg) for pkg in packages])))).hexdigest()
+        if digest not in self._base_ids:
+            # Other processes may add the same base profile meanwhile: only the one that adds it adds its packages
+            self.cursor.execute("INSERT OR IGNORE INTO base_profiles (DIGEST) VALUES (?)", (digest,))
+            created = self.cursor.rowcount == 1
+            self.cursor.execute("SELECT ID FROM base_profiles WHERE DIGEST = ?", (digest,))
+            base_id = self.cursor.fetchall()[0][0]
+            if created:
+                self.cursor.executemany("INSERT INTO base_packages (BID, PID, INSTALLTIME) VALUES (?, ?, ?)",
+                                        [(base_id, pkg_id, pkg.get("installtime") or 0)
+                                         for pkg_id, pkg in zip(self._get_package_ids(packages), packages)])
+            self._base_ids[digest] = base_id
+
+        return self._base_ids[digest]
+
+    def _get_base_packages(self, base_id):
+        """
+        Get packages of the base profile.
+
+        :param base_id: Base profile ID
+        :return: List of the package dictionaries
+        """
+        if base_id is None:
+            return list()
+
+        if base_id not in self._base_packages:
+            self.cursor.execute("SELECT P.ID, BP.BID, P.NAME, P.EPOCH, P.VERSION, P.RELEASE, P.ARCH, BP.INSTALLTIME "
+                                "FROM BASE_PACKAGES BP JOIN PACKAGES P ON P.ID = BP.PID "
+                                "WHERE BP.BID = ? ORDER BY BP.ROWID", (base_id,))
+            self._base_packages[base_id] = [self._get_package(db_pkg) for db_pkg in self.cursor.fetchall()]
+
+        return self._base_packages[base_id]
+
+    def _merge_packages(self, host_id, base_id, overlay):
+        """
+        Rebuild packages of the host from its base profile and its overlay.
+
+        :param host_id: Internal DB id of the host (not the SID).
+        :param base_id: Base profile ID
+        :param overlay: Overlay rows of the host.
+        :return: List of the package dictionaries
+        """
+        removed = set([db_pkg[0] for db_pkg in overlay if db_pkg[8] == self.PKG_REMOVED])
+        pkgs = list()
+        for pkg in self._get_base_packages(base_id):
+            if pkg["__pkg_id"] not in removed:
+                pkg = dict(pkg)
+                pkg["__host_id"] = host_id
+                pkgs.append(pkg)
+        for db_pkg in overlay:
+            if db_pkg[8] == self.PKG_ADDED:
+                pkgs.append(self._get_package(db_pkg[:8]))
 
-    def get_host_profiles(self, host_id=None):
+        return pkgs
+
+    def get_host_profiles(self, host_id=None, fields=None):
         """
         Return all hosts, or specific one.
+
+        :param host_id: SID of the host. All hosts, if not specified.
+        :param fields: Related fields ("packages", "login_info", "hardware") that are loaded
+                       with the hosts in bulk. All, if not specified. The rest are loaded on the first access.
+        :return: List of CMDBBaseProfile or one CMDBBaseProfile, if host_id is specified.
         """
-        data = list()
-        if host_id:
-            self.cursor.execute("SELECT ID, SID, HOSTNAME, SID_XML FROM HOSTS WHERE SID = ?", (host_id,))
-        else:
-            self.cursor.execute("SELECT ID, SID, HOSTNAME, SID_XML FROM HOSTS")
+        if host_id is not None:
+            data = self._get_profiles("H.SID = ?", (host_id,), fields)
+            return data and data[0] or None
+
+        return list(self.iter_host_profiles(fields=fields))
+
+    def iter_host_profiles(self, fields=None, chunk_size=None):
+        """
+        Iterate over all hosts, reading them from the database in chunks.
+        No cursor is left open between the chunks, so the caller may write to the database meanwhile.
+
+        :param fields: Related fields that are loaded in bulk, as in get_host_profiles.
+        :param chunk_size: Amount of hosts in one chunk.
+        :return: Generator of CMDBBaseProfile
+        """
+        last_id = 0
+        while True:
+            with self.lock:
+                data = self._get_profiles("H.ID > ? ORDER BY H.ID LIMIT ?",
+                                          (last_id, chunk_size or self.CHUNK_SIZE), fields)
+            if not data:
+                break
+            for host in data:
+                yield host
+            last_id = data[-1].id
 
-        for hid, sid, hostname, profile in self.cursor.fetchall():
+    def get_hosts_count(self):
+        """
+        Get amount of the stored hosts.
+        """
+        self.cursor.execute("SELECT count(*) FROM HOSTS")
+        return self.cursor.fetchall()[0][0]
+
+    def _get_profiles(self, condition, params, fields):
+        """
+        Get hosts and their related fields in bulk.
+
+        :param condition: SQL condition over the hosts table "H".
+        :param params: Parameters of the condition.
+        :param fields: Related fields that are loaded in bulk, as in get_host_profiles.
+        :return: List of CMDBBaseProfile
+        """
+        fields = self.PROFILE_FIELDS if fields is None else fields
+        columns = ["H.ID", "H.SID", "H.HOSTNAME", "H.SID_XML", "H.BASE"]
+        joins = list()
+        if "hardware" in fields:
+            columns.append("HWB.BODY")
+            joins.append("LEFT JOIN HARDWARE HW ON HW.HID = H.ID LEFT JOIN BLOBS HWB ON HWB.DIGEST = HW.DIGEST")
+        if "login_info" in fields:
+            columns.append("CB.BODY")
+            joins.append("LEFT JOIN CREDENTIALS C ON C.HID = H.ID LEFT JOIN BLOBS CB ON CB.DIGEST = C.DIGEST")
+        self.cursor.execute("SELECT {0} FROM HOSTS H {1} WHERE {2}".format(
+            ", ".join(columns), " ".join(joins), condition), params)
+        rows = self.cursor.fetchall()
+
+        overlays = dict()
+        if "packages" in fields and rows:
+            host_ids = [row[0] for row in rows]
+            self.cursor.execute("SELECT P.ID, HP.HID, P.NAME, P.EPOCH, P.VERSION, P.RELEASE, P.ARCH, HP.INSTALLTIME, "
+                                "HP.OP FROM HOST_PACKAGES HP JOIN PACKAGES P ON P.ID = HP.PID "
+                                "WHERE HP.HID >= ? AND HP.HID <= ? ORDER BY HP.HID, HP.ROWID",
+                                (min(host_ids), max(host_ids),))
+            for db_pkg in self.cursor.fetchall():
+                overlays.setdefault(db_pkg[1], list()).append(db_pkg)
+
+        data = list()
+        for row in rows:
+            hid, sid, hostname, profile, base_id = row[:5]
+            related = list(row[5:])
             host = CMDBBaseProfile()
             host.id = hid
             host.sid = sid
             host.src = profile
             host.hostname = hostname
             host.name = host.hostname
-            host.packages = self.get_host_packages(sid)
-            host.login_info = self.get_host_login_info(hid)
-            host.hardware = self.get_host_hardware(hid)
+            if "hardware" in fields:
+                host.hardware = self._get_blob(related.pop(0))
+            else:
+                host._loaders["hardware"] = functools.partial(self._load, self.get_host_hardware, hid)
+            if "login_info" in fields:
+                host.login_info = self._get_blob(related.pop(0))
+            else:
+                host._loaders["login_info"] = functools.partial(self._load, self.get_host_login_info, hid)
+            if "packages" in fields:
+                host.packages = self._merge_packages(hid, base_id, overlays.get(hid, list()))
+            else:
+                host._loaders["packages"] = functools.partial(self._load, self.get_host_packages, hid)
 
             data.append(host)
 
-        return data[0] if host_id is not None else data
+        return data
+
+    def _load(self, method, host_id):
+        """
+        Load lazy field of the host.
+        """
+        with self.lock:
+            return method(host_id)
 
     def get_host_config(self, host_id):
         """
         Get up2date configuration for the host by db ID.
         """
-        self.cursor.execute("SELECT BODY FROM configs WHERE HID = ?", (host_id,))
+        self.cursor.execute("SELECT B.BODY FROM CONFIGS CFG JOIN BLOBS B ON B.DIGEST = CFG.DIGEST "
+                            "WHERE CFG.HID = ?", (host_id,))
         for cfg in self.cursor.fetchall():
-            return eval(cfg[0])
+            return self._get_blob(cfg[0])
 
     def get_host_login_info(self, host_id):
         """
@@ -193,15 +667,16 @@ class DBOperations(DBStorage):
         :param host_id:
         :return:
         """
-        self.cursor.execute("SELECT S_BODY FROM CREDENTIALS WHERE HID = ?", (host_id,))
+        self.cursor.execute("SELECT B.BODY FROM CREDENTIALS C JOIN BLOBS B ON B.DIGEST = C.DIGEST "
+                            "WHERE C.HID = ?", (host_id,))
         for nfo in self.cursor.fetchall():
-            return self._deserialize64(nfo[0])
+            return self._get_blob(nfo[0])
 
     def delete_host_by_id(self, host_id):
         """
         Delete host by id.
         """
-        host = self.get_host_profiles(host_id=host_id)
+        host = self.get_host_profiles(host_id=host_id, fields=())
         if not host:
             raise Exception("Unable to find host with SID '{0}'".format(host_id))
 
@@ -209,25 +684,98 @@ class DBOperations(DBStorage):
         self.cursor.execute("DELETE FROM CONFIGS WHERE HID = ?", (host.id,))
         self.cursor.execute("DELETE FROM HARDWARE WHERE HID = ?", (host.id,))
         self.cursor.execute("DELETE FROM CREDENTIALS WHERE HID = ?", (host.id,))
-        self.cursor.execute("DROP TABLE IF EXISTS SYS{0}PKG".format(host.id))
+        self.cursor.execute("DELETE FROM HOST_PACKAGES WHERE HID = ?", (host.id,))
+
+    def get_next_idx(self):
+        """
+        Get the next host index, that is not taken by the stored or the journaled hosts.
+        Hosts stored without their index count by their ID, which was never less than the index.
+
+        :return: Host index
+        """
+        self.cursor.execute("SELECT max(coalesce(IDX, id)) FROM hosts")
+        hosts = self.cursor.fetchall()
+        self.cursor.execute("SELECT max(IDX) FROM journal")
+        journal = self.cursor.fetchall()
+
+        return max(hosts and hosts[0][0] or 0, journal and journal[0][0] or 0) + 1
 
-    def get_host_packages(self, sid):
+    def add_journal_hosts(self, hosts):
+        """
+        Add hosts to the registration journal, before they are registered.
+
+        :param hosts: List of (host index, hostname) pairs.
+        """
+        self.cursor.executemany("INSERT OR REPLACE INTO journal (IDX, HOSTNAME) VALUES (?, ?)", hosts)
+
+    def set_journal_stage(self, idx, stage, sid=None):
+        """
+        Record the last finished registration stage of the host.
+
+        :param idx: Host index
+        :param stage: Stage name
+        :param sid: System ID, once the host is registered.
+        """
+        self.cursor.execute("UPDATE journal SET STAGE = ?, SID = coalesce(?, SID) WHERE IDX = ?", (stage, sid, idx,))
+
+    def delete_journal_host(self, idx):
+        """
+        Remove fully registered host from the registration journal.
+
+        :param idx: Host index
+        """
+        self.cursor.execute("DELETE FROM journal WHERE IDX = ?", (idx,))
+
+    def add_journal_attempt(self, idx):
+        """
+        Count one more registration attempt of the host, when it is resumed.
+
+        :param idx: Host index
+        """
+        self.cursor.execute("UPDATE journal SET ATTEMPTS = ATTEMPTS + 1 WHERE IDX = ?", (idx,))
+
+    def get_journal_hosts(self):
+        """
+        Get hosts that are not fully registered.
+
+        :return: List of (host index, hostname, last finished stage, SID, registration attempts)
+        """
+        self.cursor.execute("SELECT IDX, HOSTNAME, STAGE, SID, ATTEMPTS FROM journal ORDER BY IDX")
+        return self.cursor.fetchall()
+
+    def get_host_packages(self, host_id):
         """
         Return packages for a client.
+
+        :param host_id: Internal DB id of the host (not the SID).
+        :return: List of the package dictionaries
         """
-        pkgs = list()
-        self.cursor.execute("SELECT ID, HID, NAME, EPOCH, VERSION, RELEASE, ARCH, INSTALLTIME "
-                            "FROM {0}".format("SYS{0}PKG".format(sid)))
-        for db_pkg in self.cursor.fetchall():
-            pkg_id, hid, name, epoch, version, release, arch, installtime = db_pkg
-            pkgs.append({
-                "__pkg_id": pkg_id, "__host_id": hid,
-                "epoch": epoch, "version": version,
-                "release": release, "arch": arch,
-                "installtime": installtime, "name": name,
-            })
+        self.cursor.execute("SELECT BASE FROM HOSTS WHERE ID = ?", (host_id,))
+        base = self.cursor.fetchall()
+        return self._merge_packages(host_id, base and base[0][0] or None, self._get_overlay(host_id))
 
-        return pkgs
+    def _get_overlay(self, host_id):
+        """
+        Get overlay rows of the host.
+
+        :param host_id: Internal DB id of the host (not the SID).
+        """
+        self.cursor.execute("SELECT P.ID, HP.HID, P.NAME, P.EPOCH, P.VERSION, P.RELEASE, P.ARCH, HP.INSTALLTIME, "
+                            "HP.OP FROM HOST_PACKAGES HP JOIN PACKAGES P ON P.ID = HP.PID "
+                            "WHERE HP.HID = ? ORDER BY HP.ROWID", (host_id,))
+        return self.cursor.fetchall()
+
+    def _get_package(self, db_pkg):
+        """
+        Get package dictionary from the database row.
+        """
+        pkg_id, hid, name, epoch, version, release, arch, installtime = db_pkg
+        return {
+            "__pkg_id": pkg_id, "__host_id": hid,
+            "epoch": epoch, "version": version,
+            "release": release, "arch": arch,
+            "installtime": installtime, "name": name,
+        }
 
     def get_host_hardware(self, host_id):
         """
@@ -236,92 +784,328 @@ class DBOperations(DBStorage):
         :param host_id: Internal DB id of the host (not the SID).
         :return: Hardware description
         """
-        self.cursor.execute("SELECT BODY FROM HARDWARE WHERE HID = ?", (host_id,))
+        self.cursor.execute("SELECT B.BODY FROM HARDWARE HW JOIN BLOBS B ON B.DIGEST = HW.DIGEST "
+                            "WHERE HW.HID = ?", (host_id,))
         hardware = self.cursor.fetchall()
-        return hardware and hardware[0][0] or None
+        return hardware and self._get_blob(hardware[0][0]) or None
 
-    def create_profile(self, profile):
+    def create_profile(self, profile, config=None):
         """
         Create profile for the system.
         If exists, remove previous.
+        All the changes are done in one transaction, committed by the caller.
+
+        :param profile: System profile
+        :param config: up2date configuration of the system. Current one, if not specified.
         """
-        host_id = self.get_next_id("hosts")
-        self.cursor.execute("INSERT INTO hosts (ID, SID, HOSTNAME, SID_XML) VALUES (?, ?, ?, ?)",
-                            (host_id, profile.sid, profile.name, profile.src,))
-        hardware_id = self.get_next_id("hardware")
-        self.cursor.execute("INSERT INTO hardware (ID, HID, BODY) VALUES (?, ?, ?)",
-                            (hardware_id, host_id, str(profile.hardware),))
-        cfg_id = self.get_next_id("configs")
-        self.cursor.execute("INSERT INTO configs (ID, HID, BODY) VALUES (?, ?, ?)",
-                            (cfg_id, host_id, str(dict(rhnreg.cfg.items()))))
+        if config is None:
+            config = dict(rhnreg.cfg.items())
+        # Host ID is given by SQLite under the write lock, so concurrent processes never take the same ones
+        self.cursor.execute("INSERT INTO hosts (SID, HOSTNAME, SID_XML, BASE, IDX) VALUES (?, ?, ?, ?, ?)",
+                            (profile.sid, profile.name, profile.src, self._get_base_id(profile.packages),
+                             getattr(profile, "idx", None),))
+        host_id = self.cursor.lastrowid
+        self.cursor.execute("INSERT INTO hardware (HID, DIGEST) VALUES (?, ?)",
+                            (host_id, self._put_blob(profile.hardware),))
+        self.cursor.execute("INSERT INTO configs (HID, DIGEST) VALUES (?, ?)",
+                            (host_id, self._put_blob(config),))
 
         # Credentials
-        self.cursor.execute("INSERT INTO credentials (HID, S_BODY) VALUES (?, ?)",
-                            (host_id, self._serialize64(profile.login_info),))
-
-        # Packages
-        table_name = "SYS{0}PKG".format(profile.sid)
-        self.cursor.execute("DROP TABLE IF EXISTS {0}".format(table_name))
-        self.cursor.execute("CREATE TABLE {0} (id INTEGER PRIMARY KEY, HID INTEGER, NAME CHAR(255), "
-                            "EPOCH CHAR(255), VERSION CHAR(255), RELEASE CHAR(255), ARCH CHAR(255), "
-                            "INSTALLTIME INTEGER)".format(table_name))
-        idx = 0
-        for pkg in profile.packages:
-            self.cursor.execute("INSERT INTO {0} (ID, HID, NAME, EPOCH, VERSION, RELEASE, ARCH, INSTALLTIME) "
-                                "VALUES (?, ?, ?, ?, ?, ?, ?, ?)".format(table_name),
-                                (idx, host_id, pkg.get("name", ""), pkg.get("epoch", ""), pkg.get("version", ""),
-                                 pkg.get("release", ""), pkg.get("arch", ""), pkg.get("installtime", 0),))
-            idx += 1
+        self.cursor.execute("INSERT INTO credentials (HID, DIGEST) VALUES (?, ?)",
+                            (host_id, self._put_blob(profile.login_info),))
 
     def update_profile(self, profile):
         """
         Update profile data.
+
+        Packages are kept as an overlay over the base profile of the host.
+        Overlays are compared as sets, so only the difference is written.
+        All the changes are done in one transaction, committed by the caller.
+        Profiles that are not read from the store are found by their SID.
         """
-        # XXX: Currently packages only
-        pkg_table = "SYS{0}PKG".format(profile.sid)
-
-        def _in(pkg, pkgs, field="name"):
-            """
-            Is pkg in pkgs by name.
-            """
-            for pkg_ in pkgs:
-                if pkg[field] == pkg_[field]:
-                    return pkg_
-            return False
-
-        def _diff(pkg, src_pkg, *fields):
-            """
-            Compare pkg against src_pkg by fields.
-            """
-            for field in fields:
-                if pkg.get(field) != src_pkg.get(field):
-                    return True
-            return False
+        host_id = profile.id
+        if not isinstance(host_id, (int, long)):
+            self.cursor.execute("SELECT ID FROM hosts WHERE SID = ?", (profile.sid,))
+            data = self.cursor.fetchall()
+            if not data:
+                return
+            host_id = data[0][0]
 
+        # XXX: Currently packages only
         # Login info credentials
-        self.cursor.execute("UPDATE credentials SET S_BODY = ? WHERE HID = ?)",
-                            (self._serialize64(profile.login_info), profile.sid))
-
-        current_packages = self.get_host_packages(profile.sid)
-        # Remove packages that was uninstalled
-        for pkg in current_packages:
-            if not _in(pkg, profile.packages):
-                # print "DELETE:", pkg["name"]
-                self.cursor.execute("DELETE FROM {0} WHERE NAME = ?".format(pkg_table), (pkg['name'],))
-
-        # Add packages that were installed
-        for pkg in profile.packages:
-            if not _in(pkg, current_packages):
-                # print "ADD:", pkg["name"]
-                idx = self.get_next_id(pkg_table)
-                self.cursor.execute("INSERT INTO {0} (ID, HID, NAME, EPOCH, VERSION, RELEASE, ARCH, INSTALLTIME) "
-                                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)".format(pkg_table),
-                                    (idx, 0, pkg.get("name", ""), pkg.get("epoch", ""), pkg.get("version", ""),
-                                     pkg.get("release", ""), pkg.get("arch", ""), pkg.get("installtime", 0),))
-
-        # Update packages that were changed
-        for pkg in profile.packages:
-            if _diff(pkg, _in(pkg, current_packages) or {}, "epoch", "version", "release", "arch"):
-                self.cursor.execute("UPDATE {0} SET EPOCH = ?, VERSION = ?, "
-                                    "RELEASE = ?, ARCH = ? WHERE NAME = ?".format(pkg_table),
-                                    (pkg["epoch"], pkg["version"], pkg["release"], pkg["arch"], pkg["name"]))
+        self.cursor.execute("UPDATE credentials SET DIGEST = ? WHERE HID = ?",
+                            (self._put_blob(profile.login_info), host_id))
+
+        self.cursor.execute("SELECT BASE FROM HOSTS WHERE ID = ?", (host_id,))
+        base = self.cursor.fetchall()
+        base_packages = dict([(self._nevra(pkg), pkg) for pkg in self._get_base_packages(base and base[0][0] or None)])
+        packages = dict([(self._nevra(pkg), pkg) for pkg in profile.packages])
+
+        overlay = dict()
+        for nevra, pkg in packages.items():
+            if nevra not in base_packages:
+                overlay[(self.PKG_ADDED, nevra)] = pkg
+        for nevra, pkg in base_packages.items():
+            if nevra not in packages:
+                overlay[(self.PKG_REMOVED, nevra)] = pkg
+
+        current_overlay = dict()
+        for db_pkg in self._get_overlay(host_id):
+            current_overlay[(db_pkg[8], self._nevra(self._get_package(db_pkg[:8])))] = db_pkg[0]
+
+        # Drop overlay entries that are no longer valid
+        self.cursor.executemany("DELETE FROM host_packages WHERE HID = ? AND PID = ? AND OP = ?",
+                                [(host_id, pkg_id, operation)
+                                 for (operation, nevra), pkg_id in current_overlay.items()
+                                 if (operation, nevra) not in overlay])
+
+        # Add new overlay entries
+        for operation in (self.PKG_ADDED, self.PKG_REMOVED,):
+            self._add_host_packages(host_id, [pkg for (pkg_op, nevra), pkg in overlay.items()
+                                              if pkg_op == operation and (pkg_op, nevra) not in current_overlay],
+                                    operation=operation)
+
+
+class DBWriter(multiprocessing.Process):
+    """
+    The only process that writes to the database.
+
+    Takes write operations from the queue and commits them in batches,
+    so the workers never wait for each other on the database lock.
+    """
+    BATCH_SIZE = 500
+    LINGER = 0.05  # Seconds to wait for more writes before committing a batch
+
+    def __init__(self, path, queue):
+        multiprocessing.Process.__init__(self)
+        self._path = path
+        self._queue = queue
+        self.daemon = True
+
+    def run(self):
+        """
+        Writer loop.
+        """
+        db = DBOperations(self._path)
+        db.open()
+        db.cursor.execute("PRAGMA synchronous=NORMAL")
+
+        running = True
+        while running:
+            batch = [self._queue.get()]
+            while batch[-1] is not None and len(batch) < self.BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get(timeout=self.LINGER))
+                except Queue.Empty:
+                    break
+
+            running = batch[-1] is not None
+            self._apply([operation for operation in batch if operation is not None], db)
+            db.commit()
+        db.close()
+
+    def _apply(self, batch, db):
+        """
+        Apply the operations of the batch in one transaction.
+        An operation that fails may have written a part of its changes: then the transaction is rolled back
+        and the batch is applied again without the failed operations.
+
+        :param batch: List of (method name, args)
+        :param db: DBOperations of the writer
+        """
+        failed = set()
+        position = 0
+        while position < len(batch):
+            if position not in failed:
+                method, args = batch[position]
+                try:
+                    getattr(db, method)(*args)
+                except Exception as error:
+                    cli_msg(ERROR, "Unable to {0}: {1}".format(method.replace("_", " "), error))
+                    failed.add(position)
+                    db.rollback()
+                    position = 0
+                    continue
+            position += 1
+
+
+class DBQueueClient(DBOperations):
+    """
+    Operations over the database, where profile writes are sent
+    to the single writer process instead of being written directly.
+    Reads are done over an own connection as usual.
+    """
+
+    def __init__(self, path):
+        DBOperations.__init__(self, path)
+        self._queue = multiprocessing.Queue(DBWriter.BATCH_SIZE * 4)
+        self._writer = None
+        self._owner = None
+
+    def open(self, new=False):
+        """
+        Open the database in WAL mode and start the writer.
+        """
+        DBOperations.open(self, new=new)
+        self.cursor.execute("PRAGMA journal_mode=WAL")
+        self.cursor.fetchall()
+        if self._writer is None:
+            self._writer = DBWriter(self._path, self._queue)
+            self._writer.start()
+            self._owner = os.getpid()
+
+    def close(self):
+        """
+        Stop the writer, once all the queued writes are committed, and close the database.
+        """
+        if self._writer is not None and self._owner == os.getpid():
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = self._owner = None
+        DBOperations.close(self)
+
+    def commit(self):
+        """
+        Writes are committed by the writer in batches.
+        """
+
+    def create_profile(self, profile, config=None):
+        """
+        Queue profile creation.
+        """
+        if config is None:
+            config = dict(rhnreg.cfg.items())
+        self._queue.put(("create_profile", (profile, config,)))
+
+    def update_profile(self, profile):
+        """
+        Queue profile update.
+        """
+        self._queue.put(("update_profile", (profile,)))
+
+    def delete_host_by_id(self, host_id):
+        """
+        Queue host removal.
+        """
+        self._queue.put(("delete_host_by_id", (host_id,)))
+
+    def add_journal_hosts(self, hosts):
+        """
+        Queue hosts to the registration journal.
+        """
+        self._queue.put(("add_journal_hosts", (hosts,)))
+
+    def set_journal_stage(self, idx, stage, sid=None):
+        """
+        Queue registration stage of the host.
+        """
+        self._queue.put(("set_journal_stage", (idx, stage, sid,)))
+
+    def delete_journal_host(self, idx):
+        """
+        Queue removal of the host from the registration journal.
+        """
+        self._queue.put(("delete_journal_host", (idx,)))
+
+    def add_journal_attempt(self, idx):
+        """
+        Queue one more registration attempt of the host.
+        """
+        self._queue.put(("add_journal_attempt", (idx,)))
+
+
+class DBMemory(DBOperations):
+    """
+    Operations over an in-memory copy of the database.
+
+    The database file is loaded on open. The whole copy is written back to it
+    as a snapshot on the first commit after "interval" seconds, and on close.
+    Only the threads of the process that opened the database see its data.
+    """
+    DEFAULT_INTERVAL = 60
+
+    def __init__(self, path, interval=None):
+        DBOperations.__init__(self, path)
+        self.interval = self.DEFAULT_INTERVAL if interval is None else interval
+        self._snapshot_time = None
+
+    def _connect(self):
+        """
+        Connect to the in-memory database.
+        """
+        return sqlite3.connect(":memory:", check_same_thread=False)
+
+    def open(self, new=False):
+        """
+        Open the in-memory database and load the database file into it.
+        """
+        if self.connection and self.cursor:
+            return
+
+        # Create or migrate the file first, so both have the same tables
+        disk = DBOperations(self._path)
+        disk.open(new=new)
+        disk.close()
+
+        DBOperations.open(self)
+        self._copy("disk", "main")
+
+    def _open_own(self):
+        """
+        Load the database file into own in-memory database of a forked process.
+        """
+        DBOperations._open_own(self)
+        self._run_init_queries()
+        self._copy("disk", "main")
+
+    def _copy(self, source, target):
+        """
+        Copy all the tables between the in-memory database and the file.
+
+        :param source: Source schema: "main" for the in-memory database or "disk" for the file.
+        :param target: Target schema.
+        """
+        self.connection.commit()
+        self.cursor.execute("ATTACH DATABASE ? AS disk", (self._path,))
+        try:
+            self.cursor.execute("SELECT name FROM main.sqlite_master WHERE type='table'")
+            for table_name in [table_name[0] for table_name in self.cursor.fetchall()]:
+                self.cursor.execute("PRAGMA main.table_info({0})".format(table_name))
+                columns = ", ".join([info[1] for info in self.cursor.fetchall()])
+                self.cursor.execute("DELETE FROM {0}.{1}".format(target, table_name))
+                self.cursor.execute("INSERT INTO {0}.{1} ({2}) SELECT {2} FROM {3}.{1}".format(
+                    target, table_name, columns, source))
+            self.connection.commit()
+        finally:
+            self.cursor.execute("DETACH DATABASE disk")
+        self._snapshot_time = time.time()
+
+    def snapshot(self):
+        """
+        Write the in-memory database to the file in one transaction.
+        """
+        with self.lock:
+            self._copy("main", "disk")
+
+    def commit(self):
+        """
+        Commit the current transaction and write a snapshot, if it is time to.
+        """
+        DBOperations.commit(self)
+        if time.time() - self._snapshot_time >= self.interval:
+            self.snapshot()
+
+    def vacuum(self):
+        """
+        Only drop orphan blobs: the in-memory database is not vacuumed.
+        """
+        self._drop_orphan_blobs()
+        self.connection.commit()
+
+    def close(self):
+        """
+        Write the last snapshot and close the database.
+        """
+        if self.cursor is not None and self.connection is not None:
+            self.snapshot()
+        DBOperations.close(self)
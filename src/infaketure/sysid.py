@@ -0,0 +1,56 @@
+#
+# Parse the system ID document, given by the registration
+# Author: bo@suse.de
+#
+
+from xml.parsers import expat
+
+
+class XMLData(object):
+    """
+    Parse SID data.
+    """
+    def __init__(self):
+        self.members = None
+        self._names = None
+        self._text = None
+
+    def load(self, src):
+        """
+        Get string members of the SID in one pass, without building the DOM.
+        """
+        self.members = dict()
+        self._names = list()  # Names of the members, that are being parsed
+        self._text = list()
+        parser = expat.ParserCreate()
+        parser.StartElementHandler = self._start
+        parser.EndElementHandler = self._end
+        parser.CharacterDataHandler = self._text.append
+        parser.Parse(src, True)
+
+    def _start(self, tag, attrs):
+        """
+        Element started.
+        """
+        if tag == 'member':
+            self._names.append(None)
+        del self._text[:]
+
+    def _end(self, tag):
+        """
+        Element ended.
+        """
+        if tag == 'member':
+            self._names.pop()
+        elif self._names:
+            if tag == 'name' and self._names[-1] is None:
+                self._names[-1] = "".join(self._text)
+            elif tag == 'string' and self._names[-1] not in self.members:
+                self.members[self._names[-1]] = "".join(self._text)
+        del self._text[:]
+
+    def get_member(self, name):
+        """
+        Get SID member.
+        """
+        return str(self.members.get(name)) or 'N/A'
@@ -0,0 +1,197 @@
+#
+# Keep-alive XML-RPC transport, shared by all the API clients of a worker.
+#
+# Author: BOFH <bo@suse.de>
+#
+
+import os
+import socket
+import httplib
+import threading
+import urlparse
+import xmlrpclib
+
+
+class KeepAliveTransport(object):
+    """
+    XML-RPC transport that keeps one HTTP/1.1 connection per thread open
+    and reuses it for all the calls of that thread.
+
+    Python 2 SSL has no TLS session reuse, so the kept connection is what saves the handshakes.
+    Forked processes open their own connections. On Python 2.6 xmlrpclib opens
+    a connection per request, so only the transport object is reused there.
+
+    Used by the SpaceAPI clients. Check-ins keep their connections
+    in the rhnlib transports of their RetryServer (see keep_alive).
+    """
+
+    def __init__(self, use_https=False):
+        self._use_https = use_https
+        self._local = threading.local()
+
+    def _get_transport(self):
+        """
+        Get transport of the current thread.
+        """
+        if getattr(self._local, "pid", None) != os.getpid():
+            self._local.transport = self._use_https and xmlrpclib.SafeTransport() or xmlrpclib.Transport()
+            self._local.pid = os.getpid()
+
+        return self._local.transport
+
+    def request(self, host, handler, request_body, verbose=0):
+        """
+        Send the request over the kept connection.
+        """
+        return self._get_transport().request(host, handler, request_body, verbose)
+
+    def close(self):
+        """
+        Close the connection of the current thread, if it is kept.
+        """
+        close = getattr(self._get_transport(), "close", None)  # No kept connections on Python 2.6
+        if close is not None:
+            close()
+
+
+class _KeptConnection(object):
+    """
+    Connection of an rhnlib transport, that stays open after the request.
+    rhnlib connects and closes the connection for each request: both are skipped,
+    while the connection is open and the server keeps it alive.
+    """
+
+    def __init__(self, connection, host):
+        self._connection = connection
+        self.host = host
+
+    def __getattr__(self, item):
+        return getattr(self._connection, item)
+
+    def connect(self):
+        """
+        Connect, unless the connection is open.
+        """
+        if self._connection.sock is None:
+            self._connection.connect()
+
+    def close(self):
+        """
+        Keep the connection for the next request.
+        """
+
+    def shut(self):
+        """
+        Close the connection.
+        """
+        self._connection.close()
+
+
+class _KeepAliveRhnTransport(object):
+    """
+    Mixin over an rhnlib transport, that sends all the requests over one kept connection.
+    Each RetryServer has its own transport, used only by the thread or the process that owns the server.
+    """
+    _base = None  # The rhnlib transport class
+    _kept = None
+
+    def get_connection(self, host):
+        """
+        Get the kept connection to the host, or open a new one.
+        """
+        if self._kept is None or self._kept.host != host:
+            self._shut()
+            self._kept = _KeptConnection(self._base.get_connection(self, host), host)
+
+        return self._kept
+
+    def _shut(self):
+        """
+        Close the kept connection, if any.
+        """
+        if self._kept is not None:
+            self._kept.shut()
+            self._kept = None
+
+    def request(self, host, handler, request_body, verbose=0):
+        """
+        Send the request over the kept connection.
+        If the server has closed the kept connection meanwhile, the request is sent again over a new one,
+        as RetryServer would give up on the first failure.
+        """
+        reused = self._kept is not None and self._kept.sock is not None
+        try:
+            return self._base.request(self, host, handler, request_body, verbose)
+        except (socket.error, httplib.HTTPException):
+            self._shut()
+            if not reused:
+                raise
+
+        return self._base.request(self, host, handler, request_body, verbose)
+
+    def _process_response(self, fd, connection):
+        """
+        Parse the response. A file stream reads from the connection, so it is not kept but closed with the file.
+        """
+        response = self._base._process_response(self, fd, connection)
+        if not isinstance(response, tuple):
+            self._kept = None
+            response.close = connection.shut
+
+        return response
+
+
+_transports = dict()
+_servers = dict()
+_lock = threading.Lock()
+
+
+def _get_keep_alive_class(base):
+    """
+    Get the keep-alive class over the rhnlib transport class.
+    """
+    return type("KeepAlive{0}".format(base.__name__), (_KeepAliveRhnTransport, base), {"_base": base})
+
+
+def keep_alive(server_class):
+    """
+    Get the server class, that keeps the connections of its direct transports open between the requests.
+    Transports over a proxy are left to rhnlib.
+
+    :param server_class: rhnlib server class, e.g. RetryServer.
+    :return: Subclass of the server class, created once.
+    """
+    with _lock:
+        if server_class not in _servers:
+            # Old-style rhnlib servers stay old-style: their __getattr__ takes any method name
+            _servers[server_class] = type(server_class)("KeepAlive{0}".format(server_class.__name__), (server_class,), {
+                "_transport_class": _get_keep_alive_class(server_class._transport_class),
+                "_transport_class_https": _get_keep_alive_class(server_class._transport_class_https),
+            })
+
+        return _servers[server_class]
+
+
+def get_transport(url):
+    """
+    Get the shared transport for the URL.
+
+    :param url: URL of the XML-RPC API.
+    :return: KeepAliveTransport
+    """
+    use_https = urlparse.urlparse(url)[0] == "https"
+    with _lock:
+        if use_https not in _transports:
+            _transports[use_https] = KeepAliveTransport(use_https=use_https)
+
+        return _transports[use_https]
+
+
+def get_server_proxy(url):
+    """
+    Get XML-RPC server proxy over the shared transport.
+
+    :param url: URL of the XML-RPC API.
+    :return: xmlrpclib.ServerProxy
+    """
+    return xmlrpclib.ServerProxy(url, transport=get_transport(url))
@@ -1,9 +1,8 @@
 __author__ = 'bo'
 
 import unittest
-import uuid
 from infaketure.actions import Dispatcher
-from infaketure.actions import Action
+from infaketure import actions
 
 
 class TestActions(unittest.TestCase):
@@ -15,17 +14,6 @@ class TestActions(unittest.TestCase):
         """
         self.dispatcher = Dispatcher(None, None)
 
-    def test_action_object(self):
-        """
-        Test action object.
-
-        :return:
-        """
-        value = uuid.uuid4().hex
-        action = Action()
-        action.one.two.three.four.five = value
-        self.assertEqual(action.one.two.three.four.five, value)
-
     def test_dispatcher(self):
         """
         Test dispatcher object.
@@ -35,3 +23,33 @@ class TestActions(unittest.TestCase):
         for action in ['reboot', 'rhnsd', 'script', 'scap', 'systemid',
                        'errata', 'distupgrade', 'configfiles', 'packages']:
             self.assertTrue(hasattr(self.dispatcher, action))
+
+    def test_routes(self):
+        """
+        Test actions are routed by their full name.
+
+        :return:
+        """
+        self.assertEqual(Dispatcher(None, None, "packages.refresh_list")(), (0, "rpmlist refreshed", {}))
+        self.assertEqual(self.dispatcher.packages.verify(), Dispatcher.no_ops_response())
+        self.assertEqual(self.dispatcher.reboot.reboot(), Dispatcher.success_response())
+        self.assertEqual(self.dispatcher.packages.path, "packages")
+        self.assertEqual(self.dispatcher.path, "")
+
+    def test_service_times(self):
+        """
+        Test service times of the actions are parsed and drawn from their distributions.
+
+        :return:
+        """
+        times = actions.parse_service_times("reboot.reboot=const:6, packages.update=uniform:1:5,errata.update=exp:2")
+        self.assertEqual(sorted(times), ["errata.update", "packages.update", "reboot.reboot"])
+        self.assertEqual(times["reboot.reboot"](), 6)
+        for idx in range(100):
+            self.assertTrue(1 <= times["packages.update"]() <= 5)
+            self.assertTrue(times["errata.update"]() >= 0)
+        self.assertEqual(actions.parse_service_times(""), {})
+        self.assertEqual(actions.get_service_time("reboot.reboot"), 6)
+        self.assertEqual(actions.get_service_time("packages.verify"), 0)
+        for spec in ["reboot.reboot", "a=const", "a=const:x", "a=uniform:5:1", "a=exp:0", "a=normal:1", "a=const:-1"]:
+            self.assertRaises(ValueError, actions.parse_service_times, spec)
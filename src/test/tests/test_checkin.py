@@ -0,0 +1,101 @@
+"""
+Check-in engine tests
+"""
+__author__ = 'bo'
+
+import unittest
+import threading
+import time
+
+from infaketure import checkin
+
+
+class _FakeCheckCli(object):
+    """
+    Check-in of a host with a few actions in its queue.
+    """
+    lock = threading.Lock()
+    in_flight = 0
+    peak = 0
+
+    def __init__(self, actions, fail=False):
+        self.actions = list(actions)
+        self.fail = fail
+        self.submitted = list()
+        self.threads = set()
+        self.finished = False
+
+    def _request(self):
+        with _FakeCheckCli.lock:
+            _FakeCheckCli.in_flight += 1
+            _FakeCheckCli.peak = max(_FakeCheckCli.peak, _FakeCheckCli.in_flight)
+        self.threads.add(threading.current_thread().name)
+        time.sleep(0.002)
+        with _FakeCheckCli.lock:
+            _FakeCheckCli.in_flight -= 1
+
+    def start(self):
+        pass
+
+    def poll_action(self):
+        self._request()
+        if self.fail:
+            raise Exception("Failed on purpose")
+        return self.actions and self.actions.pop(0) or None
+
+    def process_action(self, action):
+        if action.startswith("slow"):
+            self.defer(0.05, (action, 0, "Success", {}))
+            return None
+        return action != "invalid" and (action, 0, "Success", {}) or None
+
+    def submit_response(self, action_id, status, message, data):
+        self._request()
+        self.submitted.append(action_id)
+
+    def finish(self):
+        self.finished = True
+
+
+class TestCheckInEngine(unittest.TestCase):
+    def test_checkins(self):
+        """
+        Actions of all the hosts are handled and submitted, with the requests in flight under the limit.
+
+        :return: void
+        """
+        runner = checkin.CheckInEngine(size=3, hosts=5)
+        runner.start()
+        clis = [_FakeCheckCli(["a{0}".format(idx), "invalid", "b{0}".format(idx)]) for idx in range(10)]
+        clis.append(_FakeCheckCli([], fail=True))
+        for cli in clis:
+            runner.submit(cli)
+        runner.join()
+
+        self.assertEqual((runner.done, runner.errors), (10, 1))
+        for idx, cli in enumerate(clis[:-1]):
+            self.assertTrue(cli.finished)
+            self.assertEqual(cli.submitted, ["a{0}".format(idx), "b{0}".format(idx)])
+        self.assertFalse(clis[-1].finished)
+        self.assertTrue(_FakeCheckCli.peak <= 3)
+        self.assertTrue(len(set().union(*[cli.threads for cli in clis])) > 1)
+
+    def test_deferred(self):
+        """
+        Responses of the slow actions are submitted later, without holding the workers and host slots.
+
+        :return: void
+        """
+        runner = checkin.CheckInEngine(size=1, hosts=1)
+        runner.start()
+        clis = [_FakeCheckCli(["slow{0}".format(idx), "a{0}".format(idx)]) for idx in range(5)]
+        started = time.time()
+        for cli in clis:
+            runner.submit(cli)
+        runner.join()
+
+        self.assertTrue(time.time() - started < 0.2)
+        self.assertEqual((runner.done, runner.errors), (5, 0))
+        for idx, cli in enumerate(clis):
+            self.assertTrue(cli.finished)
+            self.assertEqual(cli.submitted, ["a{0}".format(idx), "slow{0}".format(idx)])
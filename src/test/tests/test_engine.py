@@ -0,0 +1,168 @@
+"""
+Concurrent engine tests
+"""
+__author__ = 'bo'
+
+import unittest
+import threading
+import time
+
+from infaketure import engine
+
+
+class TestConcurrentEngine(unittest.TestCase):
+    def setUp(self):
+        """
+        Setup the engine test.
+
+        :return: void
+        """
+        self.engine = engine.ConcurrentEngine(size=3)
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+
+    def _job(self, fail=False):
+        """
+        Track how many jobs are in flight at once.
+        """
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+        time.sleep(0.02)
+        with self.lock:
+            self.running -= 1
+        if fail:
+            raise Exception("Failed on purpose")
+
+    def test_bounded(self):
+        """
+        Engine never has more jobs in flight than its size.
+
+        :return: void
+        """
+        for idx in range(12):
+            self.engine.submit(self._job)
+        self.engine.join()
+
+        self.assertEqual(self.engine.done, 12)
+        self.assertEqual(self.running, 0)
+        self.assertTrue(1 < self.peak <= 3)
+
+    def test_errors(self):
+        """
+        Failed jobs are counted and do not leak slots.
+
+        :return: void
+        """
+        for idx in range(6):
+            self.engine.submit(self._job, fail=bool(idx % 2))
+        self.engine.join()
+
+        self.assertEqual(self.engine.done, 3)
+        self.assertEqual(self.engine.errors, 3)
+
+
+class TestAdaptiveLimiter(unittest.TestCase):
+    def setUp(self):
+        """
+        Setup the adaptive limiter test.
+
+        :return: void
+        """
+        self.limiter = engine.AdaptiveLimiter(limit=4, maximum=6, target_p95=1.0, target_errors=0.1)
+
+    def _window(self, latency=0.1, failures=0):
+        """
+        Finish one window of jobs.
+        """
+        for idx in range(self.limiter.WINDOW):
+            self.limiter.acquire()
+            self.limiter.release(latency=latency, failed=idx < failures)
+
+    def test_aimd(self):
+        """
+        Limit grows by one under the targets and is cut in half over them.
+
+        :return: void
+        """
+        self._window()
+        self.assertEqual(self.limiter.limit, 5)
+        self._window(latency=2.0)
+        self.assertEqual(self.limiter.limit, 2.5)
+        self._window(failures=3)
+        self.assertEqual(self.limiter.limit, 1.25)
+        for idx in range(10):
+            self._window()
+        self.assertEqual(self.limiter.limit, 6)
+        self.assertEqual(self.limiter.active, 0)
+
+        limit, p95, errors = self.limiter.capacity(last=2)
+        self.assertEqual(limit, 6)
+        self.assertEqual(errors, 0)
+
+    def test_engine(self):
+        """
+        Engine keeps the jobs in flight under the adaptive limit.
+
+        :return: void
+        """
+        runner = engine.ConcurrentEngine(limiter=engine.AdaptiveLimiter(maximum=3))
+        for idx in range(self.limiter.WINDOW * 3):
+            runner.submit(time.sleep, 0.001)
+        runner.join()
+        self.assertEqual(runner.done, self.limiter.WINDOW * 3)
+        self.assertTrue(runner.limiter.limit > 1)
+        self.assertTrue(runner.limiter.capacity() is not None)
+
+
+class TestPipeline(unittest.TestCase):
+    def setUp(self):
+        """
+        Setup the pipeline test.
+
+        :return: void
+        """
+        self.lock = threading.Lock()
+        self.running = dict()
+        self.peak = dict()
+        self.finished = list()
+
+    def _stage(self, name, delay):
+        """
+        Get a stage function that tracks how many of its jobs are in flight at once.
+        """
+        def _run(item):
+            with self.lock:
+                self.running[name] = self.running.get(name, 0) + 1
+                self.peak[name] = max(self.peak.get(name, 0), self.running[name])
+            time.sleep(delay)
+            with self.lock:
+                self.running[name] -= 1
+            if name == "slow" and item % 5 == 0:
+                raise Exception("Failed on purpose")
+            if name == "last":
+                self.finished.append(item)
+
+        return _run
+
+    def test_stages(self):
+        """
+        Each stage keeps its own limit, failed items do not go further.
+
+        :return: void
+        """
+        pipeline = engine.Pipeline([("fast", self._stage("fast", 0.001)), ("slow", self._stage("slow", 0.02)),
+                                    ("last", self._stage("last", 0.001))], limits={"slow": 4}, size=2)
+        pipeline.start()
+        for item in range(20):
+            pipeline.submit(item)
+        pipeline.join()
+
+        self.assertEqual(sorted(self.finished), [item for item in range(20) if item % 5])
+        self.assertTrue(self.peak["fast"] <= 2)
+        self.assertTrue(1 < self.peak["slow"] <= 4)
+        stats = dict([(stage["name"], stage) for stage in pipeline.stats()])
+        self.assertEqual((stats["slow"]["done"], stats["slow"]["errors"]), (16, 4))
+        self.assertEqual(stats["last"]["done"], 16)
+        self.assertEqual(pipeline.bottleneck(), "slow")
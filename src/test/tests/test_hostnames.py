@@ -0,0 +1,96 @@
+"""
+Fake host names tests
+"""
+__author__ = 'bo'
+
+import unittest
+import tempfile
+import shutil
+import os
+
+from infaketure import hostnames
+
+
+class _FakeNames(hostnames.FakeNames):
+    """
+    Fake names over a small dictionary.
+    """
+    unpacked = 0
+
+    def _get_cracklib_mtime(self):
+        return 1
+
+    def _unpack_cracklib(self):
+        _FakeNames.unpacked += 1
+        return ["lazy\n", "lamp2\n", "la\n", "sunny\n", "salt\n"]
+
+
+class TestFakeNames(unittest.TestCase):
+    def setUp(self):
+        """
+        Setup the fake names test.
+
+        :return: void
+        """
+        self._cracklib = hostnames.FakeNames.CRACKLIB
+        self._tmp = tempfile.mkdtemp()
+        self._cache = os.path.join(self._tmp, "cache", "cracklib.json")
+        _FakeNames.CRACKLIB = self._tmp
+        _FakeNames.unpacked = 0
+
+    def tearDown(self):
+        """
+        Teardown the fake names test.
+
+        :return: void
+        """
+        _FakeNames.CRACKLIB = self._cracklib
+        shutil.rmtree(self._tmp)
+
+    def test_cache(self):
+        """
+        Dictionary is unpacked once and then loaded from the cache.
+
+        :return: void
+        """
+        names = _FakeNames(cache=self._cache)
+        self.assertEqual(names._crack_dict, {"l": (["lazy"], ["lamp"]), "s": (["sunny"], ["salt"])})
+        self.assertTrue(os.path.exists(self._cache))
+
+        names = _FakeNames(cache=self._cache)
+        self.assertEqual(_FakeNames.unpacked, 1)
+        self.assertEqual(names._letters, ["l", "s"])
+        self.assertEqual(names._crack_dict, {"l": (["lazy"], ["lamp"]), "s": (["sunny"], ["salt"])})
+        self.assertTrue(isinstance(names._crack_dict["l"][0][0], str))
+
+        with open(self._cache, "w") as cache:
+            cache.write("{\"not\": \"the index\"}")
+        names = _FakeNames(cache=self._cache)
+        self.assertEqual(_FakeNames.unpacked, 2)
+        self.assertEqual(names._letters, ["l", "s"])
+
+    def test_unique(self):
+        """
+        Names never collide with the history, even when the dictionary is exhausted.
+
+        :return: void
+        """
+        names = _FakeNames(cache=self._cache)
+        names.add_history("lazy-lamp.example.com")
+        generated = [names() for idx in range(20)]
+        self.assertEqual(len(set(generated)), 20)
+        self.assertFalse("lazy-lamp" in generated)
+        self.assertTrue("sunny-salt" in generated)
+        self.assertTrue("lazy-lamp-2" in generated)
+
+    def test_stub(self):
+        """
+        Stub names skip the names in the history.
+
+        :return: void
+        """
+        _FakeNames.CRACKLIB = os.path.join(self._tmp, "missing")
+        names = _FakeNames(cache=self._cache)
+        names.add_history("base-0")
+        names.add_history("base-2")
+        self.assertEqual([names() for idx in range(3)], ["base-1", "base-3", "base-4"])
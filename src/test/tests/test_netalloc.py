@@ -0,0 +1,61 @@
+"""
+Network address allocator tests
+"""
+__author__ = 'bo'
+
+import unittest
+
+from infaketure import netalloc
+
+
+class TestAddressAllocator(unittest.TestCase):
+    def test_unique(self):
+        """
+        Every host in the range gets its own addresses.
+
+        :return: void
+        """
+        allocator = netalloc.AddressAllocator(mac_prefix="de:af:be:ef:00", ipv4_range="192.168.1.0/24",
+                                              ipv6_range="fd00::/120")
+        ipv4 = set([allocator.get_ipv4(idx) for idx in range(254)])
+        self.assertEqual(len(ipv4), 254)
+        self.assertFalse("192.168.1.0" in ipv4)
+        self.assertFalse("192.168.1.255" in ipv4)
+        self.assertEqual(len(set([allocator.get_ipv6(idx) for idx in range(255)])), 255)
+        self.assertEqual(len(set([allocator.get_mac(idx) for idx in range(256)])), 256)
+
+    def test_deterministic(self):
+        """
+        Same seed gives the same addresses, other seed gives other ones.
+
+        :return: void
+        """
+        allocator = netalloc.AddressAllocator(seed=42)
+        self.assertEqual(allocator.get_mac(100000), netalloc.AddressAllocator(seed=42).get_mac(100000))
+        self.assertEqual(allocator.get_ipv4(100000), netalloc.AddressAllocator(seed=42).get_ipv4(100000))
+        self.assertNotEqual(allocator.get_ipv4(100000), netalloc.AddressAllocator(seed=43).get_ipv4(100000))
+        self.assertTrue(allocator.get_mac(100000).startswith("de:af:be:"))
+        self.assertTrue(allocator.get_ipv4(100000).startswith("10."))
+        self.assertTrue(allocator.get_ipv6(100000).startswith("fd00:dead:beef:0:"))
+
+    def test_exhausted(self):
+        """
+        Hosts beyond the range are refused.
+
+        :return: void
+        """
+        allocator = netalloc.AddressAllocator(ipv4_range="192.168.1.0/30")
+        self.assertEqual(sorted([allocator.get_ipv4(idx) for idx in range(2)]), ["192.168.1.1", "192.168.1.2"])
+        self.assertRaises(ValueError, allocator.get_ipv4, 2)
+
+    def test_wrong_ranges(self):
+        """
+        Wrong ranges are refused.
+
+        :return: void
+        """
+        self.assertRaises(ValueError, netalloc.AddressAllocator, mac_prefix="01:00:5e")
+        self.assertRaises(ValueError, netalloc.AddressAllocator, mac_prefix="de:af:be:ef:00:01")
+        self.assertRaises(ValueError, netalloc.AddressAllocator, ipv4_range="10.0.0.0")
+        self.assertRaises(ValueError, netalloc.AddressAllocator, ipv4_range="10.0.0.0/33")
+        self.assertRaises(ValueError, netalloc.AddressAllocator, ipv6_range="fd00::/zz")
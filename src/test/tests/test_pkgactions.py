@@ -0,0 +1,166 @@
+"""
+Package actions tests
+"""
+__author__ = 'bo'
+
+import unittest
+import tempfile
+import os
+import shutil
+import xmlrpclib
+from mock import Mock
+from mock import patch
+
+from infaketure import store
+from infaketure import pkgactions
+from infaketure.store import CMDBBaseProfile
+
+
+class _CommunicationError(Exception):
+    """
+    Server fault, as RhnServer raises it.
+    """
+
+
+class TestPackageActions(unittest.TestCase):
+    def setUp(self):
+        """
+        Setup the test case with one stored host.
+
+        :return: void
+        """
+        self._db_location = tempfile.mkdtemp()
+        self.db = store.DBOperations(os.path.join(self._db_location, "store.db"))
+        self.db.open()
+
+        profile = CMDBBaseProfile()
+        profile.sid = "10001002"
+        profile.src = "src"
+        profile.name = "name"
+        profile.hardware = "hardware"
+        profile.login_info = {"login": "info"}
+        profile.packages = [self._get_package("bash"), self._get_package("kernel", version="1.0"),
+                            self._get_package("kernel", version="2.0"), self._get_package("vim")]
+        self.db.create_profile(profile, config={})
+        self.db.commit()
+
+        self.caller = Mock()
+        self.caller.db = self.db
+        self.caller.profile = None
+        self.caller.verbose = False
+
+    def tearDown(self):
+        """
+        Teardown the test case.
+
+        :return: void
+        """
+        self.db.close()
+        shutil.rmtree(self._db_location)
+
+    def _get_package(self, name, version="1.0", arch="x86_64"):
+        """
+        Get a fake package.
+
+        :return: package dictionary
+        """
+        return {"name": name, "epoch": "", "version": version, "release": "1", "arch": arch}
+
+    def _get_stored(self):
+        """
+        Get stored packages of the host.
+
+        :return: sorted (name, version) pairs
+        """
+        return sorted([(pkg["name"], pkg["version"]) for pkg in
+                       self.db.get_host_profiles(host_id="10001002").packages])
+
+    def test_update(self):
+        """
+        Test updated packages replace the installed ones of the same name, in the cached profile and the store.
+
+        :return: void
+        """
+        actions = pkgactions.PackageActions(self.caller, "10001002")
+        self.assertEqual(actions.update([["kernel", "3.0", "1", "", "x86_64"], ["emacs", "1.0", "1", "", "x86_64"],
+                                         ["emacs", "2.0", "1", "", "x86_64"]])[0], 0)
+        self.assertEqual(self._get_stored(), [("bash", "1.0"), ("emacs", "2.0"), ("kernel", "3.0"), ("vim", "1.0")])
+        registration = self.caller.get_rhn_server.return_value.registration
+        self.assertEqual(registration.update_packages.call_count, 1)  # Too big change for a delta
+        self.assertFalse(self.caller.get_server.called)  # Server of the check-in is reused
+
+        profile = self.caller.profile
+        self.assertEqual(actions.update([["bash", "2.0", "1", "", "x86_64"]])[0], 0)
+        self.assertTrue(self.caller.profile is profile)
+        self.assertEqual(self._get_stored(), [("bash", "2.0"), ("emacs", "2.0"), ("kernel", "3.0"), ("vim", "1.0")])
+        self.assertEqual(registration.update_packages.call_count, 1)
+        self.assertEqual([(pkg["name"], pkg["version"]) for pkg in registration.delete_packages.call_args[0][1]],
+                         [("bash", "1.0")])
+        self.assertEqual(registration.add_packages.call_args[0][1], [self._get_package("bash", version="2.0")])
+        self.assertEqual(actions.update()[0], 1)
+
+    def test_remove(self):
+        """
+        Test packages are removed by their name, and by their version, if given.
+
+        :return: void
+        """
+        actions = pkgactions.PackageActions(self.caller, "10001002")
+        registration = self.caller.get_rhn_server.return_value.registration
+        self.assertEqual(actions.remove([["kernel", "1.0", "1", "", "x86_64"], ["missing", "", "", "", ""]])[0], 0)
+        self.assertEqual(self._get_stored(), [("bash", "1.0"), ("kernel", "2.0"), ("vim", "1.0")])
+        self.assertEqual([(pkg["name"], pkg["version"]) for pkg in registration.delete_packages.call_args[0][1]],
+                         [("kernel", "1.0")])
+        self.assertFalse([key for key in registration.delete_packages.call_args[0][1][0] if key.startswith("__")])
+
+        self.assertEqual(actions.remove([["vim", "", "", "", ""]])[0], 0)
+        self.assertEqual(self._get_stored(), [("bash", "1.0"), ("kernel", "2.0")])
+        self.assertEqual(registration.delete_packages.call_args[0][1][0]["name"], "vim")
+        self.assertFalse(registration.add_packages.called)
+        self.assertFalse(registration.update_packages.called)
+
+        # Nothing to remove, nothing to upload
+        self.assertEqual(actions.remove([["missing", "", "", "", ""]])[0], 0)
+        self.assertEqual(registration.delete_packages.call_count, 2)
+        self.assertEqual(actions.remove()[0], 1)
+
+    @patch("infaketure.pkgactions.up2dateErrors.Error", _CommunicationError, create=True)
+    def test_delta_fault(self):
+        """
+        Test the whole package list is uploaded, if the server does not take the delta,
+        whether its fault comes as it is or turned into an up2date error by RhnServer.
+
+        :return: void
+        """
+        registration = self.caller.get_rhn_server.return_value.registration
+        actions = pkgactions.PackageActions(self.caller, "10001002")
+        for version, fault in [("2.0", xmlrpclib.Fault(-1, "Not supported")), ("3.0", _CommunicationError())]:
+            registration.add_packages.side_effect = fault
+            self.assertEqual(actions.update([["vim", version, "1", "", "x86_64"]])[0], 0)
+            self.assertEqual(len(registration.update_packages.call_args[0][1]), 4)
+        self.assertEqual(registration.update_packages.call_count, 2)
+
+    @patch("infaketure.pkgactions.up2dateErrors.Error", _CommunicationError, create=True)
+    def test_queued_profile(self):
+        """
+        Test the caller's profile is used, while the stored one still waits in the writer queue,
+        and the store finds it by SID.
+
+        :return: void
+        """
+        profile = CMDBBaseProfile()
+        profile.sid = "10001002"
+        profile.id = "hostname"
+        profile.src = "src"
+        profile.login_info = {"login": "info"}
+        profile.packages = [self._get_package("bash"), self._get_package("vim")]
+        self.caller.profile = profile
+
+        actions = pkgactions.PackageActions(self.caller, "10001002")
+        with patch.object(self.db, "get_host_profiles", Mock(return_value=None)):
+            self.assertEqual(actions.update([["zsh", "1.0", "1", "", "x86_64"]])[0], 0)
+        self.assertTrue(self.caller.profile is profile)
+        self.assertEqual(self._get_stored(), [("bash", "1.0"), ("vim", "1.0"), ("zsh", "1.0")])
+
+        self.caller.profile = None
+        self.assertEqual(pkgactions.PackageActions(self.caller, "10001003").remove([["bash", "", "", "", ""]])[0], 1)
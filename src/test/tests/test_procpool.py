@@ -0,0 +1,137 @@
+"""
+Process pool tests
+"""
+__author__ = 'bo'
+
+import unittest
+import multiprocessing
+import time
+import os
+import signal
+
+from infaketure import procpool
+
+
+class TestProcessPool(unittest.TestCase):
+    def setUp(self):
+        """
+        Setup the process pool test.
+
+        :return: void
+        """
+        procpool.Singleton._instances.pop(procpool.Pool, None)
+        self.pool = procpool.Pool(size=2)
+        self.running = multiprocessing.Value('i', 0)
+        self.peak = multiprocessing.Value('i', 0)
+        self.done = multiprocessing.Value('i', 0)
+
+    def tearDown(self):
+        """
+        Teardown the process pool test.
+
+        :return: void
+        """
+        procpool.Singleton._instances.pop(procpool.Pool, None)
+
+    def _worker(self):
+        """
+        Track how many workers are running at once.
+        """
+        with self.running.get_lock():
+            self.running.value += 1
+            self.peak.value = max(self.peak.value, self.running.value)
+        time.sleep(0.05)
+        with self.running.get_lock():
+            self.running.value -= 1
+            self.done.value += 1
+
+    def _killed(self):
+        """
+        Die without a chance to clean up.
+        """
+        os.kill(os.getpid(), signal.SIGKILL)
+
+    def test_singleton(self):
+        """
+        Pool is the same object across the calls.
+
+        :return: void
+        """
+        self.assertTrue(procpool.Pool() is self.pool)
+        self.assertEqual(procpool.Pool().size, 2)
+
+    def test_bounded(self):
+        """
+        Pool never runs more processes than its size.
+
+        :return: void
+        """
+        for idx in range(6):
+            self.pool.run(multiprocessing.Process(target=self._worker))
+        self.pool.join()
+
+        self.assertEqual(self.done.value, 6)
+        self.assertTrue(0 < self.peak.value <= 2)
+
+    def test_killed(self):
+        """
+        Processes that are killed give their slots back.
+
+        :return: void
+        """
+        self.pool.REAP_INTERVAL = 0.05
+        for idx in range(4):
+            self.pool.run(multiprocessing.Process(target=self._killed))
+        self.pool.run(multiprocessing.Process(target=self._worker))
+        self.pool.join()
+
+        self.assertEqual(self.done.value, 1)
+
+    def test_join(self):
+        """
+        Process that is ran with join is finished after the call.
+
+        :return: void
+        """
+        self.pool.run(multiprocessing.Process(target=self._worker), join=True)
+        self.assertEqual(self.done.value, 1)
+
+
+class TestWorkerPool(unittest.TestCase):
+    def setUp(self):
+        """
+        Setup the worker pool test.
+
+        :return: void
+        """
+        self.results = multiprocessing.Queue()
+        self.pool = procpool.WorkerPool(self._handler, initializer=self._initializer, size=2)
+
+    def _initializer(self):
+        """
+        Worker state: the PID of the worker.
+        """
+        return os.getpid()
+
+    def _handler(self, state, item):
+        """
+        Report what worker has handled the item.
+        """
+        self.results.put((state, os.getpid(), item))
+
+    def test_workers(self):
+        """
+        Items are handled by long-lived workers that keep their state.
+
+        :return: void
+        """
+        self.pool.start()
+        for item in range(10):
+            self.pool.put(item)
+        self.pool.join()
+
+        results = [self.results.get(timeout=5) for item in range(10)]
+        self.assertEqual(sorted([item for state, pid, item in results]), range(10))
+        self.assertTrue(len(set([pid for state, pid, item in results])) <= 2)
+        for state, pid, item in results:
+            self.assertEqual(state, pid)
@@ -0,0 +1,68 @@
+"""
+Timer scheduler tests
+"""
+__author__ = 'bo'
+
+import unittest
+import threading
+import time
+
+from infaketure import scheduler
+
+
+class TestScheduler(unittest.TestCase):
+    def test_order(self):
+        """
+        Timers fire in the order of their time, timers of the same time in the order they were scheduled.
+
+        :return: void
+        """
+        fired = list()
+        timers = scheduler.Scheduler()
+        now = time.time()
+        for when, name in [(0.03, "c"), (0.01, "a"), (0.02, "b1"), (0.02, "b2"), (-1, "late")]:
+            timers.schedule(now + when, fired.append, name)
+        self.assertEqual(len(timers), 5)
+        timers.run()
+
+        self.assertEqual(fired, ["late", "a", "b1", "b2", "c"])
+        self.assertEqual(len(timers), 0)
+
+    def test_reschedule(self):
+        """
+        Timers may schedule timers, running stops at the given time and keeps the pending timers.
+
+        :return: void
+        """
+        fired = list()
+        timers = scheduler.Scheduler()
+
+        def tick(idx):
+            fired.append(idx)
+            timers.schedule_in(0.01, tick, idx + 1)
+
+        timers.schedule_in(0, tick, 0)
+        timers.run(until=time.time() + 0.1)
+
+        self.assertTrue(3 < len(fired) < 12)
+        self.assertEqual(fired, range(len(fired)))
+        self.assertEqual(len(timers), 1)
+
+    def test_background(self):
+        """
+        Timers scheduled from other threads wake up the running scheduler, errors do not stop it.
+
+        :return: void
+        """
+        fired = threading.Event()
+        timers = scheduler.Scheduler()
+        worker = timers.start()
+        time.sleep(0.05)
+        timers.schedule_in(0, lambda: 1 / 0)
+        timers.schedule_in(0.01, fired.set)
+        fired.wait(1)
+        self.assertTrue(fired.is_set())
+
+        timers.stop()
+        worker.join(2)
+        self.assertFalse(worker.is_alive())
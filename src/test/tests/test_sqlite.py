@@ -9,8 +9,17 @@ import random
 import string
 import os
 import shutil
+import pickle
+import base64
+import json
+import marshal
+import sqlite3
+import multiprocessing
+from mock import Mock
+from mock import patch
 
 from infaketure import store
+from infaketure import procpool
 from infaketure.store import CMDBBaseProfile
 
 
@@ -45,7 +54,8 @@ class TestSQLiteHandler(unittest.TestCase):
         """
         self.db.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
         self.assertEqual(sorted([tbl_name[0] for tbl_name in self.db.cursor.fetchall()]),
-                         ['configs', 'credentials', 'hardware', 'hosts'])
+                         ['base_packages', 'base_profiles', 'blobs', 'configs', 'credentials', 'hardware',
+                          'host_packages', 'hosts', 'journal', 'packages'])
 
     def test_close(self):
         """
@@ -66,7 +76,7 @@ class TestSQLiteHandler(unittest.TestCase):
         self.db.cursor.execute("SELECT HID FROM CREDENTIALS")
         self.assertEqual(0, len(self.db.cursor.fetchall()))
 
-        self.db.cursor.execute("INSERT INTO CREDENTIALS (HID, S_BODY) VALUES (?, ?)", (0, "DUMMY"))
+        self.db.cursor.execute("INSERT INTO CREDENTIALS (HID, DIGEST) VALUES (?, ?)", (0, "DUMMY"))
 
         self.db.cursor.execute("SELECT HID FROM CREDENTIALS")
         self.assertEqual(1, len(self.db.cursor.fetchall()))
@@ -85,13 +95,15 @@ class TestSQLiteHandler(unittest.TestCase):
         self.db.cursor.execute("CREATE TABLE dummy (id INTEGER, TEST CHAR(255))")
         self.db.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
         self.assertEqual(sorted([tbl_name[0] for tbl_name in self.db.cursor.fetchall()]),
-                         ['configs', 'credentials', 'dummy', 'hardware', 'hosts'])
+                         ['base_packages', 'base_profiles', 'blobs', 'configs', 'credentials', 'dummy', 'hardware',
+                          'host_packages', 'hosts', 'journal', 'packages'])
 
         self.db.purge()
 
         self.db.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
         self.assertEqual(sorted([tbl_name[0] for tbl_name in self.db.cursor.fetchall()]),
-                         ['configs', 'credentials', 'hardware', 'hosts'])
+                         ['base_packages', 'base_profiles', 'blobs', 'configs', 'credentials', 'hardware',
+                          'host_packages', 'hosts', 'journal', 'packages'])
 
     def test_next_id(self):
         """
@@ -137,7 +149,8 @@ class TestSQLiteHandler(unittest.TestCase):
         self.db.create_profile(profile)
         self.db.cursor.execute("SELECT name FROM sqlite_master WHERE type='table'")
         self.assertEqual(sorted([tbl_name[0] for tbl_name in self.db.cursor.fetchall()]),
-                         ['SYS10001000PKG', 'configs', 'credentials', 'hardware', 'hosts'])
+                         ['base_packages', 'base_profiles', 'blobs', 'configs', 'credentials', 'hardware',
+                          'host_packages', 'hosts', 'journal', 'packages'])
 
         profiles = self.db.get_host_profiles()
         self.assertEqual(len(profiles), 1)
@@ -150,3 +163,462 @@ class TestSQLiteHandler(unittest.TestCase):
         self.assertEqual(cmdb_profile.hardware, profile.hardware)
         self.assertEqual(cmdb_profile.login_info, profile.login_info)
         self.assertEqual(cmdb_profile.packages, profile.packages)
+
+    def _create_profile(self, sid):
+        """
+        Create a fake profile and commit it.
+        """
+        with self.db.lock:
+            self.db.create_profile(self._get_profile(sid, [self._get_package("bash")]), config={})
+            self.db.commit()
+
+    def test_concurrent_create(self):
+        """
+        Test forked processes create profiles over their own connections without taking the same IDs.
+
+        :return: void
+        """
+        self.db.create_profile(self._get_profile("10001001"), config={})
+        self.db.commit()
+        processes = [multiprocessing.Process(target=self._create_profile, args=(str(10002000 + idx),))
+                     for idx in range(8)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+
+        self.assertEqual([process.exitcode for process in processes], [0] * 8)
+        profiles = self.db.get_host_profiles()
+        self.assertEqual(len(profiles), 9)
+        self.assertEqual(len(set([profile.id for profile in profiles])), 9)
+        self.assertEqual([len(profile.packages) for profile in profiles], [0] + [1] * 8)
+        self.db.cursor.execute("SELECT count(*) FROM base_profiles")
+        self.assertEqual(self.db.cursor.fetchall()[0][0], 2)
+
+    def test_create_rollback(self):
+        """
+        Test profiles are created in the transaction of the caller, so pending writes are not committed with them.
+
+        :return: void
+        """
+        self.db.add_journal_hosts([(1, "host1")])
+        self.db.create_profile(self._get_profile("10001001", [self._get_package("bash")]), config={})
+        self.db.create_profile(self._get_profile("10001002", [self._get_package("bash")]), config={})
+        self.db.rollback()
+
+        self.assertEqual(self.db.get_journal_hosts(), [])
+        self.assertEqual(self.db.get_host_profiles(), [])
+        self.db.create_profile(self._get_profile("10001003", [self._get_package("bash")]), config={})
+        self.db.commit()
+        self.assertEqual([len(profile.packages) for profile in self.db.get_host_profiles()], [1])
+
+    def test_forked_connection(self):
+        """
+        Test a forked process only connects on its first access, without running the init queries again.
+
+        :return: void
+        """
+        inherited = self.db.connection
+        self.db._pid = -1  # As if forked
+        with patch.object(self.db, "_run_init_queries", Mock(side_effect=AssertionError("Init queries run"))):
+            self.assertEqual(self.db.get_host_profiles(), [])
+        self.assertFalse(self.db.connection is inherited)
+
+    def test_prefork_create(self):
+        """
+        Test pre-forked workers create profiles over their own connections without taking the same IDs.
+
+        :return: void
+        """
+        workers = procpool.WorkerPool(lambda state, sid: self._create_profile(sid), initializer=self.db.reconnect,
+                                      size=4)
+        workers.start()
+        for idx in range(20):
+            workers.put(str(10003000 + idx))
+        workers.join()
+
+        self.assertEqual(sorted([profile.sid for profile in self.db.get_host_profiles()]),
+                         [str(10003000 + idx) for idx in range(20)])
+
+    def test_shared_base_profile(self):
+        """
+        Test base profile added over another connection is reused, without adding its packages again.
+
+        :return: void
+        """
+        other = store.DBOperations(self._db_file)
+        other.open()
+        packages = [self._get_package("bash"), self._get_package("vim")]
+        base_id = other._get_base_id(packages)
+        other.commit()
+        other.close()
+
+        self.assertEqual(self.db._get_base_id(packages), base_id)
+        self.db.cursor.execute("SELECT count(*) FROM base_packages")
+        self.assertEqual(self.db.cursor.fetchall()[0][0], 2)
+
+    def _get_profile(self, sid, packages=None):
+        """
+        Get a fake profile.
+
+        :return: CMDBBaseProfile
+        """
+        profile = CMDBBaseProfile()
+        profile.sid = sid
+        profile.src = "src"
+        profile.name = "name"
+        profile.hardware = "hardware"
+        profile.login_info = {'login': 'info'}
+        profile.packages = packages or list()
+
+        return profile
+
+    def _get_package(self, name, version="1.0", arch="x86_64"):
+        """
+        Get a fake package.
+
+        :return: package dictionary
+        """
+        return {"name": name, "epoch": "", "version": version, "release": "1", "arch": arch, "installtime": 1}
+
+    def test_host_packages(self):
+        """
+        Test packages are shared in the catalog and hosts keep only the overlay over their base profile.
+
+        :return:
+        """
+        packages = [self._get_package("bash"), self._get_package("vim"), self._get_package("zsh")]
+        self.db.create_profile(self._get_profile("10001002", packages), config={})
+        self.db.create_profile(self._get_profile("10001003", packages), config={})
+
+        self.db.cursor.execute("SELECT count(*) FROM packages")
+        self.assertEqual(self.db.cursor.fetchall()[0][0], 3)
+        self.db.cursor.execute("SELECT count(*) FROM base_profiles")
+        self.assertEqual(self.db.cursor.fetchall()[0][0], 1)
+        self.db.cursor.execute("SELECT count(*) FROM host_packages")
+        self.assertEqual(self.db.cursor.fetchall()[0][0], 0)
+
+        profile = self.db.get_host_profiles(host_id="10001002")
+        self.assertEqual([pkg["name"] for pkg in profile.packages], ["bash", "vim", "zsh"])
+        self.assertEqual(profile.packages[0]["__host_id"], profile.id)
+
+        profile.packages = [self._get_package("bash"), self._get_package("vim", version="2.0"),
+                            self._get_package("emacs")]
+        self.db.update_profile(profile)
+
+        self.db.cursor.execute("SELECT P.NAME, P.VERSION, HP.OP FROM host_packages HP "
+                               "JOIN packages P ON P.ID = HP.PID WHERE HP.HID = ?", (profile.id,))
+        overlay = sorted(self.db.cursor.fetchall())
+        self.assertEqual(overlay, [("emacs", "1.0", "+"), ("vim", "1.0", "-"), ("vim", "2.0", "+"),
+                                   ("zsh", "1.0", "-")])
+
+        # Unchanged overlay is not rewritten
+        self.db.cursor.execute("SELECT ROWID FROM host_packages ORDER BY ROWID")
+        rows = self.db.cursor.fetchall()
+        self.db.update_profile(profile)
+        self.db.cursor.execute("SELECT ROWID FROM host_packages ORDER BY ROWID")
+        self.assertEqual(self.db.cursor.fetchall(), rows)
+
+        packages = dict([(pkg["name"], pkg) for pkg in self.db.get_host_profiles(host_id="10001002").packages])
+        self.assertEqual(sorted(packages.keys()), ["bash", "emacs", "vim"])
+        self.assertEqual(packages["vim"]["version"], "2.0")
+        self.assertEqual(len(self.db.get_host_profiles(host_id="10001003").packages), 3)
+        self.assertEqual([len(host.packages) for host in self.db.get_host_profiles()], [3, 3])
+
+        # Back to the base profile: overlay is empty again
+        profile.packages = [self._get_package("bash"), self._get_package("vim"), self._get_package("zsh")]
+        self.db.update_profile(profile)
+        self.db.cursor.execute("SELECT count(*) FROM host_packages")
+        self.assertEqual(self.db.cursor.fetchall()[0][0], 0)
+
+    def test_lazy_profiles(self):
+        """
+        Test related fields that are not requested are loaded on the first access.
+
+        :return:
+        """
+        self.db.create_profile(self._get_profile("10001005", [self._get_package("bash")]), config={})
+        self.db.create_profile(self._get_profile("10001006"), config={})
+
+        profiles = self.db.get_host_profiles(fields=())
+        self.assertEqual([profile.sid for profile in profiles], ["10001005", "10001006"])
+        for field in ["packages", "login_info", "hardware"]:
+            self.assertFalse(field in profiles[0].__dict__)
+
+        self.assertEqual([pkg["name"] for pkg in profiles[0].packages], ["bash"])
+        self.assertEqual(profiles[1].packages, [])
+        self.assertTrue("packages" in profiles[0].__dict__)
+        self.assertFalse("hardware" in profiles[0].__dict__)
+
+        profile = pickle.loads(pickle.dumps(profiles[0]))
+        self.assertEqual(profile.hardware, "hardware")
+        self.assertEqual(profile.login_info, {'login': 'info'})
+        self.assertRaises(AttributeError, getattr, profile, "dummy")
+
+        self.assertTrue(self.db.get_host_profiles(host_id="10001007") is None)
+
+    def test_iter_profiles(self):
+        """
+        Test hosts are streamed in chunks with their packages.
+
+        :return:
+        """
+        for idx in range(7):
+            self.db.create_profile(self._get_profile("1000200{0}".format(idx),
+                                                     [self._get_package("pkg{0}".format(idx))]), config={})
+        self.assertEqual(self.db.get_hosts_count(), 7)
+
+        profiles = self.db.iter_host_profiles(chunk_size=3)
+        self.assertFalse(isinstance(profiles, list))
+        for idx, profile in enumerate(profiles):
+            self.assertEqual(profile.sid, "1000200{0}".format(idx))
+            self.assertEqual([pkg["name"] for pkg in profile.packages], ["pkg{0}".format(idx)])
+            self.db.commit()  # Writing meanwhile does not break the iteration
+        self.assertEqual(idx, 6)
+
+    def test_migrate_packages(self):
+        """
+        Test per-host package tables are moved to the package catalog.
+
+        :return:
+        """
+        self.db.create_profile(self._get_profile("10001004"), config={})
+        self.db.cursor.execute("CREATE TABLE SYS10001004PKG (id INTEGER PRIMARY KEY, HID INTEGER, NAME CHAR(255), "
+                               "EPOCH CHAR(255), VERSION CHAR(255), RELEASE CHAR(255), ARCH CHAR(255), "
+                               "INSTALLTIME INTEGER)")
+        self.db.cursor.execute("INSERT INTO SYS10001004PKG (ID, HID, NAME, EPOCH, VERSION, RELEASE, ARCH, "
+                               "INSTALLTIME) VALUES (0, 1, 'bash', NULL, '4.2', '1', 'x86_64', 1)")
+        self.db.commit()
+        self.db.close()
+        self.db.open()
+
+        self.db.cursor.execute("SELECT name FROM sqlite_master WHERE type='table' AND name LIKE 'SYS%'")
+        self.assertFalse(self.db.cursor.fetchall())
+
+        packages = self.db.get_host_profiles(host_id="10001004").packages
+        self.assertEqual(len(packages), 1)
+        self.assertEqual(packages[0]["name"], "bash")
+        self.assertEqual(packages[0]["version"], "4.2")
+
+    def test_blobs(self):
+        """
+        Test configs, hardware and credentials are stored once per content.
+
+        :return:
+        """
+        for sid in ["10001008", "10001009"]:
+            self.db.create_profile(self._get_profile(sid), config={'cfg': 'test', 'serverURL': ['https://x']})
+
+        self.db.cursor.execute("SELECT count(*) FROM blobs")
+        self.assertEqual(self.db.cursor.fetchall()[0][0], 3)
+
+        profile = self.db.get_host_profiles(host_id="10001008")
+        self.assertEqual(self.db.get_host_config(profile.id), {'cfg': 'test', 'serverURL': ['https://x']})
+        self.assertEqual(self.db.get_host_hardware(profile.id), "hardware")
+
+        profile.login_info = {'login': 'other'}
+        self.db.update_profile(profile)
+        self.assertEqual(self.db.get_host_login_info(profile.id), {'login': 'other'})
+        self.assertEqual(self.db.get_host_profiles(host_id="10001009").login_info, {'login': 'info'})
+
+        self.db.delete_host_by_id("10001008")
+        self.db.delete_host_by_id("10001009")
+        self.db.vacuum()
+        self.db.cursor.execute("SELECT count(*) FROM blobs")
+        self.assertEqual(self.db.cursor.fetchall()[0][0], 0)
+
+    def test_migrate_blobs(self):
+        """
+        Test bodies of the older databases are moved to the blobs.
+
+        :return:
+        """
+        self.db.cursor.execute("DROP TABLE configs")
+        self.db.cursor.execute("DROP TABLE hardware")
+        self.db.cursor.execute("DROP TABLE credentials")
+        self.db.cursor.execute("CREATE TABLE configs (id INTEGER PRIMARY KEY, hid INTEGER, BODY BLOB)")
+        self.db.cursor.execute("CREATE TABLE hardware (id INTEGER PRIMARY KEY, hid INTEGER, BODY BLOB)")
+        self.db.cursor.execute("CREATE TABLE credentials (HID INTEGER, S_BODY BLOB)")
+        self.db.cursor.execute("INSERT INTO hosts (ID, SID, HOSTNAME, SID_XML) VALUES (1, '10001010', 'name', 'src')")
+        self.db.cursor.execute("INSERT INTO configs (ID, HID, BODY) VALUES (1, 1, ?)", (str({'cfg': 'test'}),))
+        self.db.cursor.execute("INSERT INTO hardware (ID, HID, BODY) VALUES (1, 1, ?)", (str([{'class': 'CPU'}]),))
+        self.db.cursor.execute("INSERT INTO credentials (HID, S_BODY) VALUES (1, ?)",
+                               (base64.encodestring(pickle.dumps({'login': 'info'}, 0)).replace("\n", ""),))
+        self.db.commit()
+        self.db.close()
+        self.db.open()
+
+        profile = self.db.get_host_profiles(host_id="10001010")
+        self.assertEqual(self.db.get_host_config(profile.id), {'cfg': 'test'})
+        self.assertEqual(profile.hardware, [{'class': 'CPU'}])
+        self.assertEqual(profile.login_info, {'login': 'info'})
+
+    def test_canonical_blobs(self):
+        """
+        Test blobs are JSON, addressed by their content regardless of the key order.
+
+        :return:
+        """
+        first, second = dict(), dict()
+        for key in ["serverURL", "sslCACert", "enableProxy", "noSSLServerURL"]:
+            first[key] = key.lower()
+        for key in reversed(sorted(first)):
+            second[key] = key.lower()
+        self.assertEqual(self.db._put_blob(first), self.db._put_blob(second))
+
+        self.db.cursor.execute("SELECT BODY FROM blobs")
+        self.assertEqual(json.loads(str(self.db.cursor.fetchall()[0][0])), first)
+        self.assertEqual(self.db._get_blob(json.dumps({u"login": [u"info", 1]})), {"login": ["info", 1]})
+        self.assertTrue(isinstance(self.db._get_blob(json.dumps(u"info")), str))
+
+    def test_migrate_marshal_blobs(self):
+        """
+        Test marshal blobs of the older databases are re-encoded as JSON.
+
+        :return:
+        """
+        self.db.create_profile(self._get_profile("10001011"), config={'cfg': 'test'})
+        profile = self.db.get_host_profiles(host_id="10001011")
+        self.db.cursor.execute("DELETE FROM blobs")
+        self.db.cursor.execute("INSERT INTO blobs (DIGEST, BODY) VALUES ('old', ?)",
+                               (sqlite3.Binary(marshal.dumps({'login': 'old'})),))
+        self.db.cursor.execute("UPDATE credentials SET DIGEST = 'old'")
+        self.db.cursor.execute("PRAGMA user_version = 0")
+        self.db.commit()
+        self.db.close()
+        self.db.open()
+
+        self.assertEqual(self.db.get_host_login_info(profile.id), {'login': 'old'})
+        self.db.cursor.execute("SELECT DIGEST FROM blobs")
+        self.assertNotEqual(self.db.cursor.fetchall(), [("old",)])
+        self.db.cursor.execute("PRAGMA user_version")
+        self.assertEqual(self.db.cursor.fetchall()[0][0], store.DBStorage.SCHEMA_VERSION)
+
+    def test_host_indexes(self):
+        """
+        Test hosts are looked up by their SID and ID without scanning the tables.
+
+        :return:
+        """
+        for query in ["SELECT ID FROM hosts WHERE SID = ?", "SELECT DIGEST FROM configs WHERE HID = ?",
+                      "SELECT DIGEST FROM hardware WHERE HID = ?", "SELECT DIGEST FROM credentials WHERE HID = ?"]:
+            self.db.cursor.execute("EXPLAIN QUERY PLAN " + query, ("1",))
+            self.assertTrue(" INDEX " in " ".join([str(row[-1]) for row in self.db.cursor.fetchall()]), query)
+
+    def test_queue_client(self):
+        """
+        Test profile writes are done by the writer process.
+
+        :return:
+        """
+        profile = self._get_profile("10001001")
+
+        self.db.close()
+        client = store.DBQueueClient(self._db_file)
+        client.open()
+        client.create_profile(profile, config={'cfg': 'test'})
+        client.commit()
+        client.close()
+
+        self.db.open()
+        self.db.cursor.execute("PRAGMA journal_mode")
+        self.assertEqual(self.db.cursor.fetchall()[0][0], "wal")
+
+        profiles = self.db.get_host_profiles()
+        self.assertEqual(len(profiles), 1)
+        self.assertEqual(profiles[0].sid, profile.sid)
+        self.assertEqual(profiles[0].login_info, profile.login_info)
+        self.assertEqual(self.db.get_host_config(profiles[0].id), {'cfg': 'test'})
+
+    def test_queue_failed_operation(self):
+        """
+        Test the writes of a failed operation are not committed with its batch, and the rest of the batch is.
+
+        :return:
+        """
+        broken = CMDBBaseProfile()
+        broken.sid = "10001001"
+        broken.id = "host"
+        broken.login_info = {"login": "broken"}  # Written before the missing packages fail the update
+
+        self.db.close()
+        client = store.DBQueueClient(self._db_file)
+        with patch("infaketure.store.cli_msg"):  # Error of the writer process
+            client.open()
+            client.create_profile(self._get_profile("10001001"), config={})
+            client.update_profile(broken)
+            client.create_profile(self._get_profile("10001002"), config={})
+            client.close()
+
+        self.db.open()
+        profiles = self.db.get_host_profiles()
+        self.assertEqual([profile.sid for profile in profiles], ["10001001", "10001002"])
+        self.assertEqual(profiles[0].login_info, self._get_profile("10001001").login_info)
+
+    def test_journal(self):
+        """
+        Test registration journal keeps the hosts until they are fully registered.
+
+        :return:
+        """
+        self.db.add_journal_hosts([(10, "host10"), (11, "host11"), (12, "host12")])
+        self.db.set_journal_stage(10, "register", sid="10001013")
+        self.db.set_journal_stage(10, "hardware")
+        self.db.delete_journal_host(11)
+        self.db.add_journal_attempt(12)
+        self.db.commit()
+
+        self.assertEqual(self.db.get_journal_hosts(), [(10, "host10", "hardware", "10001013", 1),
+                                                       (12, "host12", None, None, 2)])
+        self.assertEqual(self.db.get_next_id("journal", field="IDX"), 13)
+
+    def test_next_idx(self):
+        """
+        Test host indexes are not given again, once the registered hosts left the journal.
+
+        :return: void
+        """
+        self.assertEqual(self.db.get_next_idx(), 1)
+        self.db.add_journal_hosts([(1, "host1"), (2, "host2"), (3, "host3")])
+        self.assertEqual(self.db.get_next_idx(), 4)
+        for idx in range(1, 4):
+            profile = self._get_profile(str(10001000 + idx))
+            profile.idx = idx
+            self.db.create_profile(profile, config={})
+            self.db.delete_journal_host(idx)
+        self.db.commit()
+        self.assertEqual(self.db.get_next_idx(), 4)
+
+        self.db.create_profile(self._get_profile("10001004"), config={})  # Stored without the index: ID 4
+        self.db.add_journal_hosts([(2, "host2")])
+        self.db.commit()
+        self.assertEqual(self.db.get_next_idx(), 5)
+
+    def test_memory_store(self):
+        """
+        Test in-memory database is loaded from the file and saved back as snapshots.
+
+        :return:
+        """
+        self.db.create_profile(self._get_profile("10001011", [self._get_package("bash")]), config={})
+        self.db.commit()
+        self.db.close()
+
+        memdb = store.DBMemory(self._db_file, interval=3600)
+        memdb.open()
+        self.assertEqual([host.sid for host in memdb.get_host_profiles()], ["10001011"])
+        memdb.create_profile(self._get_profile("10001012", [self._get_package("zsh")]), config={})
+        memdb.commit()
+
+        self.db.open()
+        self.assertEqual(self.db.get_hosts_count(), 1)  # Not yet in the snapshot
+        self.db.close()
+
+        memdb.snapshot()
+        memdb.delete_host_by_id("10001011")
+        memdb.close()
+
+        self.db.open()
+        profiles = self.db.get_host_profiles()
+        self.assertEqual([host.sid for host in profiles], ["10001012"])
+        self.assertEqual([pkg["name"] for pkg in profiles[0].packages], ["zsh"])
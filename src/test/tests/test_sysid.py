@@ -0,0 +1,107 @@
+"""
+System ID document tests
+"""
+__author__ = 'bo'
+
+import unittest
+
+from infaketure.sysid import XMLData
+
+
+class TestXMLData(unittest.TestCase):
+    SYSTEM_ID = """<?xml version="1.0"?>
+<params>
+<param>
+<value><struct>
+<member>
+<name>username</name>
+<value><string>admin</string></value>
+</member>
+<member>
+<name>operating_system</name>
+<value><string>SLES</string></value>
+</member>
+<member>
+<name>description</name>
+<value><string>Initial Registration Parameters:
+OS: SLES
+Release: 12
+CPU Arch: x86_64-redhat-linux</string></value>
+</member>
+<member>
+<name>checksum</name>
+<value><string>8ca6bcbb3b7d6ad32a1346bc8d8f5cc7</string></value>
+</member>
+<member>
+<name>profile_name</name>
+<value><string>base-rennes.example.com</string></value>
+</member>
+<member>
+<name>system_id</name>
+<value><string>ID-1000010000</string></value>
+</member>
+<member>
+<name>architecture</name>
+<value><string>x86_64-redhat-linux</string></value>
+</member>
+<member>
+<name>os_release</name>
+<value><string>12</string></value>
+</member>
+<member>
+<name>fields</name>
+<value><array><data>
+<value><string>system_id</string></value>
+<value><string>os_release</string></value>
+<value><string>operating_system</string></value>
+<value><string>architecture</string></value>
+<value><string>username</string></value>
+<value><string>type</string></value>
+</data></array></value>
+</member>
+<member>
+<name>type</name>
+<value><string>REAL</string></value>
+</member>
+</struct></value>
+</param>
+</params>
+"""
+
+    def test_members(self):
+        """
+        Test string members of the system ID are read, also multi-line ones.
+
+        :return: void
+        """
+        xmldata = XMLData()
+        xmldata.load(self.SYSTEM_ID)
+        self.assertEqual(xmldata.get_member("system_id"), "ID-1000010000")
+        self.assertEqual(xmldata.get_member("profile_name"), "base-rennes.example.com")
+        self.assertEqual(xmldata.get_member("type"), "REAL")
+        self.assertEqual(xmldata.get_member("description").split("\n")[-1], "CPU Arch: x86_64-redhat-linux")
+        self.assertTrue(isinstance(xmldata.get_member("system_id"), str))
+
+    def test_array_member(self):
+        """
+        Test an array member takes its first string, and its strings do not override other members.
+
+        :return: void
+        """
+        xmldata = XMLData()
+        xmldata.load(self.SYSTEM_ID)
+        self.assertEqual(xmldata.get_member("fields"), "system_id")
+        self.assertEqual(xmldata.get_member("os_release"), "12")
+        self.assertEqual(len(xmldata.members), 10)
+
+    def test_missing_member(self):
+        """
+        Test missing members are returned as None, and empty ones as N/A.
+
+        :return: void
+        """
+        xmldata = XMLData()
+        xmldata.load("<params><param><value><struct><member><name>empty</name><value><string></string></value>"
+                     "</member></struct></value></param></params>")
+        self.assertEqual(xmldata.get_member("missing"), "None")
+        self.assertEqual(xmldata.get_member("empty"), "N/A")
@@ -0,0 +1,177 @@
+"""
+Keep-alive transport tests
+"""
+__author__ = 'bo'
+
+import unittest
+import threading
+import xmlrpclib
+import httplib
+import types
+import os
+
+from infaketure import transport
+
+
+class _Connection(object):
+    """
+    HTTP connection, as rhnlib opens it.
+    """
+    opened = list()
+
+    def __init__(self, host):
+        self.host = host
+        self.sock = None
+        self.connects = 0
+        self.fail = None
+        self.opened.append(self)
+
+    def connect(self):
+        self.sock = object()
+        self.connects += 1
+
+    def close(self):
+        self.sock = None
+
+
+class _RhnTransport:
+    """
+    Transport, as rhnlib connects and closes it for each request.
+    """
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+
+    def get_connection(self, host):
+        return _Connection(host)
+
+    def request(self, host, handler, request_body, verbose=0):
+        connection = self.get_connection(host)
+        connection.connect()
+        if connection.fail is not None:
+            error, connection.fail = connection.fail, None
+            raise error
+        return self._process_response(request_body, connection)
+
+    def _process_response(self, fd, connection):
+        connection.close()
+        return fd == "file" and xmlrpclib.Binary(fd) or (fd,)
+
+
+class _RhnServer:
+    """
+    Server, as rhnlib picks its transport class.
+    """
+    _transport_class = _RhnTransport
+    _transport_class_https = _RhnTransport
+
+    def __init__(self, uri):
+        self._transport = self._transport_class()
+
+
+class TestKeepAliveTransport(unittest.TestCase):
+    def test_shared(self):
+        """
+        API clients of the same scheme share one transport.
+
+        :return: void
+        """
+        self.assertTrue(transport.get_transport("http://localhost/rpc/api") is
+                        transport.get_transport("http://otherhost/rpc/api"))
+        self.assertFalse(transport.get_transport("http://localhost/rpc/api") is
+                         transport.get_transport("https://localhost/rpc/api"))
+        self.assertTrue(isinstance(transport.get_transport("https://localhost/rpc/api")._get_transport(),
+                                   xmlrpclib.SafeTransport))
+
+    def test_per_thread(self):
+        """
+        Each thread keeps its own connection, reused by all its calls.
+
+        :return: void
+        """
+        shared = transport.KeepAliveTransport()
+        transports = list()
+        thread = threading.Thread(target=lambda: transports.append(shared._get_transport()))
+        thread.start()
+        thread.join()
+
+        self.assertTrue(shared._get_transport() is shared._get_transport())
+        self.assertFalse(shared._get_transport() is transports[0])
+
+    def test_close_without_keep_alive(self):
+        """
+        Closing is a no-op for xmlrpclib transports that do not keep connections, as on Python 2.6.
+
+        :return: void
+        """
+        shared = transport.KeepAliveTransport()
+        shared._local.transport = object()
+        shared._local.pid = os.getpid()
+        shared.close()
+
+
+class TestKeepAliveRhnTransport(unittest.TestCase):
+    def setUp(self):
+        """
+        Setup the test case.
+
+        :return: void
+        """
+        del _Connection.opened[:]
+        self.transport = transport.keep_alive(_RhnServer)("https://localhost/XMLRPC")._transport
+
+    def test_server_class(self):
+        """
+        Server class is created once and stays old-style, as the rhnlib one.
+
+        :return: void
+        """
+        server_class = transport.keep_alive(_RhnServer)
+        self.assertTrue(server_class is transport.keep_alive(_RhnServer))
+        self.assertTrue(issubclass(server_class, _RhnServer))
+        self.assertTrue(isinstance(server_class, types.ClassType))
+        self.assertTrue(isinstance(self.transport, _RhnTransport))
+
+    def test_kept_connection(self):
+        """
+        Requests of the server go over one connection, connected once.
+
+        :return: void
+        """
+        for idx in range(3):
+            self.assertEqual(self.transport.request("localhost", "/XMLRPC", "body"), ("body",))
+        self.assertEqual(len(_Connection.opened), 1)
+        self.assertEqual(_Connection.opened[0].connects, 1)
+        self.assertTrue(_Connection.opened[0].sock is not None)
+
+        self.transport.request("otherhost", "/XMLRPC", "body")
+        self.assertEqual(len(_Connection.opened), 2)
+        self.assertTrue(_Connection.opened[0].sock is None)
+
+    def test_closed_by_server(self):
+        """
+        Request is sent again over a new connection, if the server has closed the kept one.
+        Failure of a new connection is raised.
+
+        :return: void
+        """
+        self.transport.request("localhost", "/XMLRPC", "body")
+        _Connection.opened[0].fail = httplib.BadStatusLine("")
+        self.assertEqual(self.transport.request("localhost", "/XMLRPC", "body"), ("body",))
+        self.assertEqual(len(_Connection.opened), 2)
+
+        self.transport._kept.shut()
+        _Connection.opened[1].fail = httplib.BadStatusLine("")
+        self.assertRaises(httplib.BadStatusLine, self.transport.request, "localhost", "/XMLRPC", "body")
+
+    def test_file_response(self):
+        """
+        Connection that streams a file is not kept, but closed with the file.
+
+        :return: void
+        """
+        response = self.transport.request("localhost", "/XMLRPC", "file")
+        self.assertTrue(_Connection.opened[0].sock is not None)
+        response.close()
+        self.assertTrue(_Connection.opened[0].sock is None)
+        self.transport.request("localhost", "/XMLRPC", "body")
+        self.assertEqual(len(_Connection.opened), 2)
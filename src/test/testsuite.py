@@ -37,12 +37,38 @@ def main():
     from tests.test_sqlite import TestSQLiteHandler
     from tests.test_scenario_loader import TestScenarioLoader
     from tests.test_cmdbmeta import TestCMDBMeta
+    from tests.test_procpool import TestProcessPool
+    from tests.test_procpool import TestWorkerPool
+    from tests.test_engine import TestConcurrentEngine
+    from tests.test_engine import TestPipeline
+    from tests.test_engine import TestAdaptiveLimiter
+    from tests.test_netalloc import TestAddressAllocator
+    from tests.test_hostnames import TestFakeNames
+    from tests.test_transport import TestKeepAliveTransport
+    from tests.test_transport import TestKeepAliveRhnTransport
+    from tests.test_checkin import TestCheckInEngine
+    from tests.test_scheduler import TestScheduler
+    from tests.test_pkgactions import TestPackageActions
+    from tests.test_sysid import TestXMLData
 
     unittest.TextTestRunner(verbosity=2).run(unittest.TestSuite([
         unittest.TestLoader().loadTestsFromTestCase(TestSQLiteHandler),
         unittest.TestLoader().loadTestsFromTestCase(TestActions),
         unittest.TestLoader().loadTestsFromTestCase(TestScenarioLoader),
         unittest.TestLoader().loadTestsFromTestCase(TestCMDBMeta),
+        unittest.TestLoader().loadTestsFromTestCase(TestProcessPool),
+        unittest.TestLoader().loadTestsFromTestCase(TestWorkerPool),
+        unittest.TestLoader().loadTestsFromTestCase(TestConcurrentEngine),
+        unittest.TestLoader().loadTestsFromTestCase(TestPipeline),
+        unittest.TestLoader().loadTestsFromTestCase(TestAdaptiveLimiter),
+        unittest.TestLoader().loadTestsFromTestCase(TestAddressAllocator),
+        unittest.TestLoader().loadTestsFromTestCase(TestFakeNames),
+        unittest.TestLoader().loadTestsFromTestCase(TestKeepAliveTransport),
+        unittest.TestLoader().loadTestsFromTestCase(TestKeepAliveRhnTransport),
+        unittest.TestLoader().loadTestsFromTestCase(TestCheckInEngine),
+        unittest.TestLoader().loadTestsFromTestCase(TestScheduler),
+        unittest.TestLoader().loadTestsFromTestCase(TestPackageActions),
+        unittest.TestLoader().loadTestsFromTestCase(TestXMLData),
     ]))
 
 if __name__ == "__main__":